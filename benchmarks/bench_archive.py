@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# Measures move_night and moveimages throughput on a generated archive laid out the
+# way picamserver writes it: python3 benchmarks/bench_archive.py [--json PATH] [--quick]
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from datetime import datetime, timedelta
+
+import benchutil
+import move_night
+import moveimages
+
+DAYS = 7
+IMAGES_PER_DAY = 288
+IMAGE_SIZE = 256*1024
+START_DAY = datetime(2020, 6, 1)
+
+def generate_archive(root, days, images_per_day, image_size):
+  payload = bytearray(os.urandom(image_size))
+  count = 0
+  for day in range(days):
+    for i in range(images_per_day):
+      time = START_DAY + timedelta(days=day, seconds=i * 86400 // images_per_day)
+      # Vary the content so every image has its own md5sum, like real captures
+      payload[:8] = count.to_bytes(8, 'little')
+      md5sum = hashlib.md5(payload).hexdigest()
+      folder = os.path.join(root, time.strftime('%Y%m%d'))
+      os.makedirs(folder, exist_ok=True)
+      with open(os.path.join(folder, 'img_%s_md5-%s.jpg' % (time.strftime('%Y%m%d_%H%M%S'), md5sum)), 'wb') as f:
+        f.write(payload)
+      count += 1
+  return count
+
+def timed(func):
+  wall_start = time.perf_counter()
+  cpu_start = time.process_time()
+  func()
+  return (time.perf_counter() - wall_start, time.process_time() - cpu_start)
+
+def run_move_night(archive, images):
+  journal_file = os.path.join(archive, '.move_night_journal.json')
+  results = []
+  for (name, incremental) in (('full', False), ('incremental-first', True), ('incremental-unchanged', True)):
+    (wall, cpu) = timed(lambda: move_night.run(incremental=incremental, src_path=archive, journal_file=journal_file))
+    results.append({
+      'benchmark': 'move_night',
+      'variant': name,
+      'images': images,
+      'wall_s': round(wall, 3),
+      'cpu_s': round(cpu, 3),
+      'images_per_s': round(images / wall, 1)})
+  return results
+
+def run_moveimages(archive, images, image_size, concurrent, copy_engine):
+  root = tempfile.mkdtemp(prefix='bench-moveimages-')
+  try:
+    src = os.path.join(root, 'src')
+    shutil.copytree(archive, src)
+    dsts = [os.path.join(root, 'dst0'), os.path.join(root, 'dst1')]
+    for dst in dsts:
+      os.makedirs(dst)
+    mover = moveimages.FileMover([src + os.sep], [dst + os.sep for dst in dsts], [], concurrent=concurrent, copy_engine=copy_engine)
+    (wall, cpu) = timed(mover.run)
+  finally:
+    shutil.rmtree(root)
+  return {
+    'benchmark': 'moveimages',
+    'concurrent': concurrent,
+    'copy_engine': copy_engine,
+    'images': images,
+    'destinations': len(dsts),
+    'wall_s': round(wall, 3),
+    'cpu_s': round(cpu, 3),
+    'images_per_s': round(images / wall, 1),
+    'mb_s': round(images * image_size / wall / (1024*1024), 1)}
+
+def run_benchmarks(quick=False):
+  days = 2 if quick else DAYS
+  images_per_day = IMAGES_PER_DAY // 4 if quick else IMAGES_PER_DAY
+  # Both tools log every file, which would dominate the numbers
+  logging.getLogger().setLevel(logging.WARNING)
+  move_night.CALENDAR.cache_file = None
+  archive = tempfile.mkdtemp(prefix='bench-archive-')
+  try:
+    images = generate_archive(archive, days, images_per_day, IMAGE_SIZE)
+    results = run_move_night(archive, images)
+    for concurrent in (False, True):
+      for copy_engine in ('copy2', 'tee'):
+        results.append(run_moveimages(archive, images, IMAGE_SIZE, concurrent, copy_engine))
+  finally:
+    shutil.rmtree(archive)
+  return results
+
+if __name__ == "__main__":
+  benchutil.main("move_night and moveimages throughput on a generated archive", run_benchmarks)
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# Measures capture-to-disk latency of the time lapse, with and without the capture
+# spool, and how long each capture keeps the capture loop busy. A destination can be
+# made slow to see the spool absorb it: python3 benchmarks/bench_capture_latency.py [--json PATH] [--quick]
+import os
+import time
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+
+import benchutil
+import picamserver
+from syntheticcamera import SyntheticCamera
+
+CAPTURES = 40
+DESTINATIONS = 2
+SLOW_DESTINATION_DELAY = 0.2 # seconds added to every write to the first destination in the 'slow' scenarios
+
+class InstrumentedTimelapse(picamserver.Timelapse):
+  def __init__(self, *args, slow_folder=None, **kwargs):
+    super(InstrumentedTimelapse, self).__init__(*args, **kwargs)
+    self.slow_folder = slow_folder
+    self.written = {}
+    self.cond = threading.Condition()
+
+  def _write_capture(self, root_folder, capture):
+    if root_folder == self.slow_folder:
+      time.sleep(SLOW_DESTINATION_DELAY)
+    filename = super(InstrumentedTimelapse, self)._write_capture(root_folder, capture)
+    with self.cond:
+      self.written.setdefault(capture.time, []).append(time.monotonic())
+      self.cond.notify_all()
+    return filename
+
+  def wait_written(self, capture_time, count, timeout=30):
+    with self.cond:
+      self.cond.wait_for(lambda: len(self.written.get(capture_time, ())) >= count, timeout)
+      return list(self.written.get(capture_time, ()))
+
+def run(use_spool, slow, captures):
+  root = tempfile.mkdtemp(prefix='bench-capture-latency-')
+  try:
+    root_folders = [os.path.join(root, 'dst%d' % i) for i in range(DESTINATIONS)]
+    spool = None
+    if use_spool:
+      spool = picamserver.CaptureSpool(picamserver.TIMELAPSE_SPOOL_MEMORY_SIZE, None, 0, 'drop_oldest', timedelta(seconds=30), picamserver.TIMELAPSE_SPOOL_FALLBACK_SIZE, timedelta(seconds=1))
+    camera = SyntheticCamera()
+    timelapse = InstrumentedTimelapse(camera, picamserver.STILL_RESOLUTION, picamserver.TIMELAPSE_INTERVAL, benchutil.timelapse_location(), spool=spool, slow_folder=root_folders[0] if slow else None)
+    if spool is not None:
+      for f in root_folders:
+        spool.add_destination(f, timelapse._write_capture)
+      spool.start()
+
+    # Mirrors the body of the capture loop in Timelapse, without waiting for the next interval
+    loop_durations = []
+    pending = []
+    now = timelapse._now()
+    for i in range(captures):
+      start_time = time.monotonic()
+      stream = picamserver.HashingBytesIO()
+      timelapse._capture(stream)
+      capture = picamserver.Capture(now + timedelta(seconds=i), stream.getbuffer(), stream.md5sum())
+      if spool is not None:
+        spool.submit(capture)
+      else:
+        timelapse._write_to_file(stream, root_folders, capture.time)
+      loop_durations.append(time.monotonic() - start_time)
+      pending.append((start_time, capture.time))
+
+    latencies = []
+    for (start_time, capture_time) in pending:
+      written = timelapse.wait_written(capture_time, DESTINATIONS)
+      if len(written) == DESTINATIONS:
+        latencies.append(max(written) - start_time)
+    if spool is not None:
+      spool.stop()
+  finally:
+    shutil.rmtree(root)
+
+  result = {
+    'benchmark': 'capture_latency',
+    'spool': use_spool,
+    'slow_destination': slow,
+    'captures': captures,
+    'destinations': DESTINATIONS,
+    'still_kb': len(camera.stills[0]) // 1024,
+    'complete': len(latencies)}
+  result.update(benchutil.latency_summary(loop_durations, 'capture_loop'))
+  result.update(benchutil.latency_summary(latencies, 'capture_to_disk'))
+  return result
+
+def run_benchmarks(quick=False):
+  captures = CAPTURES // 4 if quick else CAPTURES
+  return [run(use_spool, slow, captures) for slow in (False, True) for use_spool in (False, True)]
+
+if __name__ == "__main__":
+  benchutil.main("Capture-to-disk latency of the time lapse", run_benchmarks)
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+# Compares the old per-destination hash/copy write path with the single-pass
+# one in Timelapse._write_to_file. Run from anywhere: python3 benchmarks/bench_capture_write.py [--json PATH]
+import os
+import io
+import time
+import hashlib
+import shutil
+import tempfile
+from datetime import timedelta
+from functools import partial
+
+import benchutil
+import picamserver
+
+CAPTURE_SIZE = 1024*1024
+CHUNK_SIZE = 64*1024
+DESTINATIONS = 2
+ITERATIONS = 50
+
+class NullCamera:
+  resolution = picamserver.STILL_RESOLUTION
+
+def legacy_write_to_file(timelapse, input, root_folders, now):
+  for root_folder in root_folders:
+    d = hashlib.md5()
+    input.seek(0)
+    for buf in iter(partial(input.read, 4096), b''):
+      d.update(buf)
+    filename = timelapse.generate_filename(root_folder, now, d.hexdigest())
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as f:
+      f.write(input.getvalue())
+
+def single_pass_write_to_file(timelapse, input, root_folders, now):
+  timelapse._write_to_file(input, root_folders, now)
+
+def fake_encode(stream, payload):
+  for i in range(0, len(payload), CHUNK_SIZE):
+    stream.write(payload[i:i+CHUNK_SIZE])
+  return stream
+
+def run(name, stream_factory, write_func, payload, iterations):
+  root = tempfile.mkdtemp(prefix='bench-capture-write-')
+  try:
+    timelapse = picamserver.Timelapse(NullCamera(), picamserver.STILL_RESOLUTION, picamserver.TIMELAPSE_INTERVAL, benchutil.timelapse_location())
+    root_folders = [os.path.join(root, 'dst%d' % i) for i in range(DESTINATIONS)]
+    start = timelapse._now()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for i in range(iterations):
+      stream = fake_encode(stream_factory(), payload)
+      write_func(timelapse, stream, root_folders, start + timedelta(seconds=i))
+      del stream
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+  finally:
+    shutil.rmtree(root)
+  return {
+    'benchmark': 'capture_write',
+    'variant': name,
+    'capture_kb': len(payload) // 1024,
+    'destinations': DESTINATIONS,
+    'iterations': iterations,
+    'wall_ms_per_capture': round(wall * 1000 / iterations, 3),
+    'cpu_ms_per_capture': round(cpu * 1000 / iterations, 3),
+    'throughput_mb_s': round(len(payload) * iterations / wall / (1024*1024), 1)}
+
+def run_md5(payload, iterations):
+  wall_start = time.perf_counter()
+  for i in range(iterations):
+    hashlib.md5(payload).hexdigest()
+  wall = time.perf_counter() - wall_start
+  return {
+    'benchmark': 'capture_write',
+    'variant': 'md5-only',
+    'capture_kb': len(payload) // 1024,
+    'iterations': iterations,
+    'wall_ms_per_capture': round(wall * 1000 / iterations, 3),
+    'throughput_mb_s': round(len(payload) * iterations / wall / (1024*1024), 1)}
+
+def run_benchmarks(quick=False):
+  payload = os.urandom(CAPTURE_SIZE)
+  iterations = ITERATIONS // 10 if quick else ITERATIONS
+  return [
+    run_md5(payload, iterations),
+    run('legacy', io.BytesIO, legacy_write_to_file, payload, iterations),
+    run('single-pass', picamserver.HashingBytesIO, single_pass_write_to_file, payload, iterations)]
+
+if __name__ == "__main__":
+  benchutil.main("Capture hash and write throughput", run_benchmarks)
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# Measures how the video stream fan-out scales with the number of clients, some of
+# which read slower than the stream bit rate. Uses the synthetic camera, so it runs
+# off a Pi: python3 benchmarks/bench_stream_fanout.py [--json PATH] [--quick]
+import time
+import socket
+import threading
+
+import benchutil
+import picamserver
+from syntheticcamera import SyntheticCamera
+
+FRAMERATE = 30
+SPEED = 4 # replay the stream this many times faster than real time
+BITRATE = 2000000
+DURATION = 5
+SLOW_CLIENT_RATE = 64*1024 # bytes/s
+CONFIGURATIONS = [(1, 0), (4, 0), (8, 2), (16, 4), (32, 8)] # (clients, of which slow)
+
+class StreamClient:
+  def __init__(self, address, rate=None):
+    self.rate = rate
+    self.received = 0
+    self.keep_running = True
+    self.sock = socket.create_connection(address)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16*1024)
+    self.thread = threading.Thread(target=self.__run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.keep_running = False
+    self.sock.close()
+    self.thread.join()
+
+  def __run(self):
+    start_time = time.monotonic()
+    try:
+      while self.keep_running:
+        data = self.sock.recv(4096 if self.rate else 256*1024)
+        if not data:
+          return
+        self.received += len(data)
+        if self.rate:
+          delay = start_time + self.received / self.rate - time.monotonic()
+          if delay > 0:
+            time.sleep(delay)
+    except OSError:
+      pass
+
+# Times every camera write, which is what stalls the encoder when fan-out is slow
+class TimedTee:
+  def __init__(self, tee):
+    self.tee = tee
+    self.durations = []
+    self.bytes = 0
+
+  def write(self, b):
+    start_time = time.perf_counter()
+    self.tee.write(b)
+    self.durations.append(time.perf_counter() - start_time)
+    self.bytes += len(b)
+
+  def flush(self):
+    self.tee.flush()
+
+def run(server_class, clients, slow_clients, duration):
+  camera = SyntheticCamera(speed=SPEED)
+  server = server_class(camera, ('127.0.0.1', 0), picamserver.VIDEO_RESOLUTION, FRAMERATE, BITRATE)
+  timed_tee = TimedTee(server.tee)
+  server._start_recording = lambda: camera.start_recording(timed_tee, format='h264', bitrate=BITRATE, intra_period=picamserver.VIDEO_INTRA_PERIOD)
+  server.start()
+  stream_clients = [StreamClient(server.server_address[:2], SLOW_CLIENT_RATE if i < slow_clients else None) for i in range(clients)]
+  cpu_start = time.process_time()
+  time.sleep(duration)
+  cpu = time.process_time() - cpu_start
+  stats = [stats for (address, stats) in server.client_stats() if address is not None]
+  for client in stream_clients:
+    client.stop()
+  server.stop()
+  if hasattr(server, 'server_close'):
+    server.server_close()
+
+  fast = stream_clients[slow_clients:]
+  slow = stream_clients[:slow_clients]
+  result = {
+    'benchmark': 'stream_fanout',
+    'server': server_class.__name__,
+    'clients': clients,
+    'slow_clients': slow_clients,
+    'duration_s': duration,
+    'stream_kb_s': round(timed_tee.bytes / duration / 1024, 1),
+    'fast_client_kb_s': round(sum(c.received for c in fast) / len(fast) / duration / 1024, 1) if fast else None,
+    'slow_client_kb_s': round(sum(c.received for c in slow) / len(slow) / duration / 1024, 1) if slow else None,
+    'dropped_kb': sum(s['dropped_bytes'] for s in stats) // 1024,
+    'cpu_percent': round(cpu / duration * 100, 1)}
+  result.update(benchutil.latency_summary(timed_tee.durations, 'tee_write'))
+  return result
+
+def run_benchmarks(quick=False):
+  results = []
+  duration = 1 if quick else DURATION
+  configurations = CONFIGURATIONS[:2] if quick else CONFIGURATIONS
+  for server_class in (picamserver.TcpVideoStreamServer, picamserver.AsyncTcpVideoStreamServer):
+    for (clients, slow_clients) in configurations:
+      results.append(run(server_class, clients, slow_clients, duration))
+  return results
+
+if __name__ == "__main__":
+  benchutil.main("Video stream fan-out with fast and slow clients", run_benchmarks)
@@ -0,0 +1,65 @@
+# Shared helpers for the benchmarks: timing statistics and machine-readable output.
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, REPO_DIR)
+
+def percentile(values, p):
+  if not values:
+    return None
+  ordered = sorted(values)
+  index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+  return ordered[index]
+
+def latency_summary(values, prefix):
+  return {
+    prefix + '_p50_ms': round(percentile(values, 50) * 1000, 3) if values else None,
+    prefix + '_p99_ms': round(percentile(values, 99) * 1000, 3) if values else None,
+    prefix + '_max_ms': round(max(values) * 1000, 3) if values else None}
+
+def timelapse_location():
+  # Prepared the way PiCamServer.run does it before creating the time lapse
+  import picamserver
+  location = picamserver.TIMELAPSE_ASTRAL_LOCATION
+  location.solar_depression = picamserver.TIMELAPSE_ASTRAL_SOLAR_DEPRESSION
+  return location
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def parse_args(description):
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('--json', metavar='PATH', help="also write the results as JSON to PATH ('-' for stdout)")
+  parser.add_argument('--quick', action='store_true', help="run smaller workloads, e.g. as a smoke test")
+  return parser.parse_args()
+
+def report(results, json_path=None):
+  for result in results:
+    print(' '.join('%s=%s' % (k, v) for (k, v) in result.items()))
+  if json_path is None:
+    return
+  document = {
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    'revision': git_revision(),
+    'python': platform.python_version(),
+    'machine': platform.machine(),
+    'results': results}
+  if json_path == '-':
+    json.dump(document, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+  else:
+    with open(json_path, 'w') as f:
+      json.dump(document, f, indent=1)
+
+def main(description, run_benchmarks):
+  args = parse_args(description)
+  report(run_benchmarks(quick=args.quick), args.json)
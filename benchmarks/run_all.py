@@ -0,0 +1,19 @@
+#!/usr/bin/python3
+# Runs every benchmark and writes all results as one JSON document, so runs can be
+# compared over time: python3 benchmarks/run_all.py --json results.json [--quick]
+import benchutil
+import bench_capture_write
+import bench_capture_latency
+import bench_stream_fanout
+import bench_archive
+
+BENCHMARKS = [bench_capture_write, bench_capture_latency, bench_stream_fanout, bench_archive]
+
+def run_benchmarks(quick=False):
+  results = []
+  for benchmark in BENCHMARKS:
+    results.extend(benchmark.run_benchmarks(quick=quick))
+  return results
+
+if __name__ == "__main__":
+  benchutil.main("All picamserver benchmarks", run_benchmarks)
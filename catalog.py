@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+import os
+import re
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+import collections
+import logsetup
+
+DEFAULT_CATALOG_FILE = os.path.expanduser('~/.local/share/picamserver/catalog.sqlite')
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 5.0 # seconds
+NIGHT_SUBDIR = 'night'
+FILE_NAME_PATTERN = re.compile(r'^img_(([0-9]{8})_[0-9]{6})(?:_md5-([0-9a-f]{32}))?(?:_[0-9]+)?\.jpg$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captures (
+  path TEXT PRIMARY KEY,
+  root_folder TEXT NOT NULL,
+  day TEXT NOT NULL,
+  time TEXT NOT NULL,
+  md5sum TEXT,
+  size INTEGER,
+  night INTEGER NOT NULL,
+  verified INTEGER NOT NULL DEFAULT 0,
+  updated REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS captures_by_day ON captures (root_folder, day, time);
+CREATE INDEX IF NOT EXISTS captures_by_verified ON captures (root_folder, verified);
+'''
+
+def parse_file_name(path):
+  m = FILE_NAME_PATTERN.match(os.path.basename(path))
+  if m is None:
+    return None
+  return m.groups()
+
+# Changes are written in batches by a background thread, so the capture path never waits for SQLite
+class CaptureCatalog:
+  def __init__(self, path=DEFAULT_CATALOG_FILE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.path = path
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.executescript(SCHEMA)
+    self.db_lock = threading.Lock()
+    self.flush_lock = threading.Lock()
+    self.pending = collections.deque()
+    self.cond = threading.Condition()
+    self.keep_running = False
+    self.writer_thread = None
+
+  def start(self):
+    self.keep_running = True
+    self.writer_thread = threading.Thread(target=self.__run)
+    self.writer_thread.daemon = True
+    self.writer_thread.start()
+
+  def close(self):
+    with self.cond:
+      self.keep_running = False
+      self.cond.notify_all()
+    if self.writer_thread is not None:
+      self.writer_thread.join()
+      self.writer_thread = None
+    self.flush()
+    with self.db_lock:
+      self.db.close()
+
+  def add(self, root_folder, path, capture_time, md5sum, size, night, verified=False):
+    self.__queue(('add', (os.path.normpath(path), os.path.normpath(root_folder), capture_time.strftime('%Y%m%d'), capture_time.strftime('%Y%m%d_%H%M%S'), md5sum, size, int(night), int(verified))))
+
+  def moved(self, src_path, dst_paths, verified=True):
+    self.__queue(('moved', (os.path.normpath(src_path), [(os.path.normpath(r), os.path.normpath(p)) for (r, p) in dst_paths], int(verified))))
+
+  def renamed(self, src_path, dst_path, night):
+    self.__queue(('renamed', (os.path.normpath(src_path), os.path.normpath(dst_path), int(night))))
+
+  def removed(self, path):
+    self.__queue(('removed', (os.path.normpath(path),)))
+
+  def flush(self):
+    # Batches must be applied in the order they were queued, whichever thread flushes
+    with self.flush_lock:
+      while True:
+        with self.cond:
+          batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.batch_size))]
+        if not batch:
+          return
+        self.__apply(batch)
+
+  def frames(self, root_folder, day, night=None):
+    query = 'SELECT path FROM captures WHERE root_folder = ? AND day = ?'
+    args = [os.path.normpath(root_folder), day]
+    if night is not None:
+      query += ' AND night = ?'
+      args.append(int(night))
+    return [path for (path,) in self.__query(query + ' ORDER BY time, path', args)]
+
+  def days(self, root_folder):
+    return [day for (day,) in self.__query('SELECT DISTINCT day FROM captures WHERE root_folder = ? ORDER BY day', (os.path.normpath(root_folder),))]
+
+  def unverified(self, root_folder):
+    # Not yet copied to and verified on a destination
+    return [path for (path,) in self.__query('SELECT path FROM captures WHERE root_folder = ? AND verified = 0 ORDER BY time, path', (os.path.normpath(root_folder),))]
+
+  def lookup(self, path):
+    rows = self.__query('SELECT root_folder, day, time, md5sum, size, night, verified FROM captures WHERE path = ?', (os.path.normpath(path),))
+    return rows[0] if rows else None
+
+  def stats(self):
+    return self.__query('SELECT root_folder, COUNT(*), COUNT(DISTINCT day), SUM(size), SUM(verified) FROM captures GROUP BY root_folder ORDER BY root_folder', ())
+
+  def rebuild(self, root_folder, verified=False):
+    root_folder = os.path.normpath(root_folder)
+    self.flush()
+    rows = []
+    now = time.time()
+    for (dirpath, dirnames, filenames) in os.walk(root_folder):
+      dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+      night = int(os.path.basename(dirpath) == NIGHT_SUBDIR)
+      for filename in filenames:
+        parsed = parse_file_name(filename)
+        if parsed is None:
+          continue
+        (datetime_str, date_str, md5sum) = parsed
+        path = os.path.join(dirpath, filename)
+        try:
+          size = os.stat(path).st_size
+        except OSError as e:
+          self.logger.warning("Skipping '%s': %s", path, str(e))
+          continue
+        rows.append((path, root_folder, date_str, datetime_str, md5sum, size, night, int(verified), now))
+    with self.db_lock, self.db:
+      self.db.execute('DELETE FROM captures WHERE root_folder = ?', (root_folder,))
+      self.db.executemany('INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    self.logger.info("Rebuilt catalog of '%s' with %d captures", root_folder, len(rows))
+    return len(rows)
+
+  def __queue(self, change):
+    with self.cond:
+      self.pending.append(change)
+      if self.writer_thread is not None:
+        if len(self.pending) >= self.batch_size:
+          self.cond.notify_all()
+        return
+    self.flush()
+
+  def __query(self, query, args):
+    self.flush()
+    with self.db_lock:
+      return self.db.execute(query, args).fetchall()
+
+  def __apply(self, batch):
+    now = time.time()
+    try:
+      with self.db_lock, self.db:
+        for (kind, args) in batch:
+          if kind == 'add':
+            self.db.execute('INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', args + (now,))
+          elif kind == 'moved':
+            (src_path, dst_paths, verified) = args
+            row = self.db.execute('SELECT day, time, md5sum, size, night FROM captures WHERE path = ?', (src_path,)).fetchone()
+            if row is None:
+              parsed = parse_file_name(src_path)
+              if parsed is None:
+                continue
+              row = (parsed[1], parsed[0], parsed[2], None, int(os.path.basename(os.path.dirname(src_path)) == NIGHT_SUBDIR))
+            self.db.execute('DELETE FROM captures WHERE path = ?', (src_path,))
+            self.db.executemany('INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [(path, root_folder) + tuple(row) + (verified, now) for (root_folder, path) in dst_paths])
+          elif kind == 'renamed':
+            (src_path, dst_path, night) = args
+            self.db.execute('UPDATE OR REPLACE captures SET path = ?, night = ?, updated = ? WHERE path = ?', (dst_path, night, now, src_path))
+          elif kind == 'removed':
+            self.db.execute('DELETE FROM captures WHERE path = ?', args)
+    except sqlite3.Error as e:
+      # The catalog is an index that can be rebuilt from disk, losing a batch must never break a capture or a move
+      self.logger.error("Unable to update capture catalog '%s', dropped %d change(s): %s", self.path, len(batch), str(e))
+
+  def __run(self):
+    while True:
+      with self.cond:
+        if self.keep_running and len(self.pending) < self.batch_size:
+          self.cond.wait(self.flush_interval)
+        if not self.keep_running:
+          return
+      self.flush()
+
+def main():
+  parser = argparse.ArgumentParser(description="Maintain the capture catalog")
+  parser.add_argument('--catalog', default=DEFAULT_CATALOG_FILE, help="catalog file (default: %(default)s)")
+  subparsers = parser.add_subparsers(dest='command')
+  rebuild_parser = subparsers.add_parser('rebuild', help="re-index one or more destination folders from disk")
+  rebuild_parser.add_argument('root_folders', nargs='+')
+  rebuild_parser.add_argument('--verified', action='store_true', help="mark the captures as verified copies")
+  subparsers.add_parser('stats', help="print the number of captures per destination folder")
+  args = parser.parse_args()
+  if args.command is None:
+    parser.error("a command is required")
+
+  logsetup.setup_logging(None, logging.INFO)
+  catalog = CaptureCatalog(args.catalog)
+  try:
+    if args.command == 'rebuild':
+      for root_folder in args.root_folders:
+        catalog.rebuild(root_folder, args.verified)
+    for (root_folder, captures, days, size, verified) in catalog.stats():
+      print("%s: %d captures over %d days, %d MB, %d verified" % (root_folder, captures, days, (size or 0) // (1024*1024), verified))
+  finally:
+    catalog.close()
+
+if __name__ == "__main__":
+  main()
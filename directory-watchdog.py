@@ -5,78 +5,252 @@ from datetime import datetime, timedelta
 import os
 import sys
 import stat
+import ctypes
+import ctypes.util
+import select
+import struct
 import logging
-from logging.handlers import RotatingFileHandler
+import logsetup
 
 
 LOG_FILE = 'image-watchdog.log'
+LOG_LEVEL = logging.DEBUG
 
 ROOT_DIR = '/mnt/usb/timelapse'
 TIMEOUT = timedelta(seconds=120)
 INTERVAL_SECONDS = 120
+USE_INOTIFY = True
+RUN_FOREVER = False # Keep running and react to new images, otherwise check once and exit (e.g. from cron)
+INOTIFY_MAX_RETRY_DELAY = timedelta(hours=1) # retries of a lost root watch back off up to this delay
+DATESTR_FORMAT = '%Y%m%d'
+NIGHT_SUBDIR = 'night'
+
+class Inotify:
+  IN_MODIFY = 0x00000002
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE_SELF = 0x00000400
+  IN_UNMOUNT = 0x00002000
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  IN_ONLYDIR = 0x01000000
+  IN_ISDIR = 0x40000000
+  IN_NONBLOCK = os.O_NONBLOCK
+  IN_CLOEXEC = os.O_CLOEXEC
+
+  EVENT_HEADER = struct.Struct('iIII')
+
+  def __init__(self):
+    library = ctypes.util.find_library('c')
+    self.libc = ctypes.CDLL(library, use_errno=True)
+    if not hasattr(self.libc, 'inotify_init1'):
+      raise OSError("inotify is not available in '%s'" % library)
+    self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+  def add_watch(self, path, mask):
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask | self.IN_ONLYDIR)
+    if wd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno), path)
+    return wd
+
+  def rm_watch(self, wd):
+    self.libc.inotify_rm_watch(self.fd, wd)
+
+  def read_events(self, timeout):
+    (readable, _, _) = select.select([self.fd], [], [], timeout)
+    if not readable:
+      return []
+    try:
+      data = os.read(self.fd, 64*1024)
+    except BlockingIOError:
+      return []
+    events = []
+    offset = 0
+    while offset < len(data):
+      (wd, mask, _, name_len) = self.EVENT_HEADER.unpack_from(data, offset)
+      offset += self.EVENT_HEADER.size
+      name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+      offset += name_len
+      events.append((wd, mask, name))
+    return events
+
+  def close(self):
+    os.close(self.fd)
 
 class DirectoryWatchdog:
-  def __init__(self, root_dir, timeout, interval_seconds):
+  def __init__(self, root_dir, timeout, interval_seconds, use_inotify=USE_INOTIFY):
     self.root_dir = root_dir
     self.timeout = timeout
     self.interval_seconds = interval_seconds
+    self.use_inotify = use_inotify
     self.logger = logging.getLogger(type(self).__name__)
+    self.inotify = None
+    self.watches = {}
+    self.last_write_time = None
+    self.inotify_retry_delay = None
+    self.inotify_retry_time = None
+    self.faulted = False
+
+  def _day_dirs(self, now):
+    # Only the current day (and yesterday, right after midnight) can receive new images
+    return [os.path.join(self.root_dir, (now - timedelta(days=days)).strftime(DATESTR_FORMAT)) for days in (0, 1)]
 
   def _get_last_dir_modification_datetime(self):
+    # Stats a fixed number of folders, so the cost does not grow with the size of the archive
     latest_modification_time = None
-    try:
-      for root, sub_folders, files in os.walk(self.root_dir):
-        for sub_folder in sub_folders:
-          foldername = os.path.join(root, sub_folder)
-          try:
-            modification_time = datetime.fromtimestamp(os.stat(foldername)[stat.ST_MTIME])
-            if latest_modification_time is None or modification_time > latest_modification_time:
-              latest_modification_time = modification_time
-          except:
-            self.logger.exception("Error getting modification time of folder '%s'", foldername)
-    except:
-      self.logger.exception("Error walking '%s'", self.root_dir)
+    for day_dir in self._day_dirs(datetime.now()):
+      for foldername in (day_dir, os.path.join(day_dir, NIGHT_SUBDIR)):
+        try:
+          modification_time = datetime.fromtimestamp(os.stat(foldername)[stat.ST_MTIME])
+        except FileNotFoundError:
+          continue
+        except:
+          self.logger.exception("Error getting modification time of folder '%s'", foldername)
+          continue
+        if latest_modification_time is None or modification_time > latest_modification_time:
+          latest_modification_time = modification_time
     return latest_modification_time
 
-  def _on_fault(self):
-    os.system('/sbin/shutdown -r +1')
+  def _start_inotify(self):
+    if self.inotify_retry_time is not None and time.monotonic() < self.inotify_retry_time:
+      return False
+    try:
+      self.inotify = Inotify()
+    except OSError as e:
+      # Not supported by this system, retrying would not help
+      self.logger.warning("Falling back to polling '%s' every %d seconds: %s", self.root_dir, self.interval_seconds, str(e))
+      self.use_inotify = False
+      return False
+    try:
+      self._watch(self.root_dir)
+    except OSError as e:
+      self._stop_inotify()
+      if self.inotify_retry_delay is None:
+        self.logger.warning("Falling back to polling '%s' every %d seconds: %s", self.root_dir, self.interval_seconds, str(e))
+        self.inotify_retry_delay = self.interval_seconds
+      else:
+        self.logger.debug("Unable to watch '%s' yet: %s", self.root_dir, str(e))
+        self.inotify_retry_delay = min(self.inotify_retry_delay * 2, INOTIFY_MAX_RETRY_DELAY.total_seconds())
+      self.inotify_retry_time = time.monotonic() + self.inotify_retry_delay
+      return False
+    self.inotify_retry_delay = None
+    self.inotify_retry_time = None
+    for day_dir in self._day_dirs(datetime.now()):
+      self._watch_day_dir(day_dir)
+    self.logger.info("Watching '%s' for new images using inotify", self.root_dir)
+    return True
 
-  def run_forever(self):
-    while True:
-      self.logger.debug("Sleeping for %d seconds", self.interval_seconds)
-      time.sleep(self.interval_seconds)
-      self.run_one()
+  def _stop_inotify(self):
+    if self.inotify is not None:
+      self.inotify.close()
+    self.inotify = None
+    self.watches = {}
 
-  def run_once(self):
-    last_mod_time = self._get_last_dir_modification_datetime()
+  def _watch(self, path):
+    wd = self.inotify.add_watch(path, Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_CLOSE_WRITE | Inotify.IN_MODIFY | Inotify.IN_DELETE_SELF | Inotify.IN_UNMOUNT)
+    self.watches[wd] = path
+
+  def _watch_day_dir(self, day_dir):
+    for foldername in (day_dir, os.path.join(day_dir, NIGHT_SUBDIR)):
+      try:
+        self._watch(foldername)
+      except FileNotFoundError:
+        pass
+      except OSError:
+        self.logger.exception("Error watching folder '%s'", foldername)
+
+  def _prune_watches(self, now):
+    keep = set(self._day_dirs(now))
+    for (wd, path) in list(self.watches.items()):
+      if path != self.root_dir and path not in keep and os.path.dirname(path) not in keep:
+        self.logger.debug("No longer watching '%s'", path)
+        self.inotify.rm_watch(wd)
+        del self.watches[wd]
+
+  def _process_events(self, events):
+    now = datetime.now()
+    for (wd, mask, name) in events:
+      if mask & Inotify.IN_Q_OVERFLOW:
+        self.last_write_time = now
+        continue
+      path = self.watches.get(wd)
+      if path is None:
+        continue
+      if mask & (Inotify.IN_IGNORED | Inotify.IN_DELETE_SELF | Inotify.IN_UNMOUNT):
+        self.watches.pop(wd, None)
+        if path == self.root_dir:
+          self.logger.warning("Lost watch on '%s', falling back to polling", self.root_dir)
+          self._stop_inotify()
+          return
+        continue
+      self.last_write_time = now
+      if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+        if path == self.root_dir:
+          self._watch_day_dir(os.path.join(path, name))
+          self._prune_watches(now)
+        elif name == NIGHT_SUBDIR:
+          self._watch_day_dir(path)
+
+  def _check(self, last_mod_time):
+    # The reboot is scheduled a minute ahead, the checks until then must not schedule it again
+    if self.faulted:
+      return
     if last_mod_time is None:
       self.logger.error("Last modification time is None, rebooting system.")
+      self.faulted = True
       self._on_fault()
-      continue
+      return
 
     timediff = (datetime.now() - last_mod_time)
     self.logger.debug("Time since last dir modification: %s", str(timediff))
     if (timediff > self.timeout):
       self.logger.warning("Time since last modification %s exceeds timeout of %s, rebooting system.", str(timediff), str(self.timeout))
+      self.faulted = True
       self._on_fault()
 
-def setup_logging():
-  root_log = logging.getLogger('')
-  root_log.setLevel(logging.DEBUG)
-  formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(name)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+  def _on_fault(self):
+    os.system('/sbin/shutdown -r +1')
 
-  stream_handler = logging.StreamHandler(sys.stdout)
-  stream_handler.setFormatter(formatter)
-  root_log.addHandler(stream_handler)
+  def run_forever(self):
+    # Images written before we started count, otherwise give the camera one timeout from now
+    self.last_write_time = self._get_last_dir_modification_datetime() or datetime.now()
+    next_check = time.monotonic() + self.interval_seconds
+    try:
+      while True:
+        if self.inotify is None and self.use_inotify:
+          self._start_inotify()
+        if self.inotify is not None:
+          self._process_events(self.inotify.read_events(max(0, next_check - time.monotonic())))
+          if time.monotonic() < next_check:
+            continue
+        else:
+          self.logger.debug("Sleeping for %d seconds", self.interval_seconds)
+          time.sleep(max(0, next_check - time.monotonic()))
+          polled_time = self._get_last_dir_modification_datetime()
+          if polled_time is not None and polled_time > self.last_write_time:
+            self.last_write_time = polled_time
+        next_check = time.monotonic() + self.interval_seconds
+        self._check(self.last_write_time)
+    finally:
+      self._stop_inotify()
 
-  file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=(1024*1024*10), backupCount=7)
-  file_handler.setFormatter(formatter)
-  root_log.addHandler(file_handler)
+  def run_once(self):
+    self._check(self._get_last_dir_modification_datetime())
+
+def setup_logging():
+  logsetup.setup_logging(LOG_FILE, LOG_LEVEL)
 
 def main():
   setup_logging()
   watchdog = DirectoryWatchdog(ROOT_DIR, TIMEOUT, INTERVAL_SECONDS)
-  watchdog.run_once()
+  if RUN_FOREVER:
+    watchdog.run_forever()
+  else:
+    watchdog.run_once()
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,87 @@
+import sys
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+LOG_DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+LOG_FILE_MAX_BYTES = 1024*1024*10
+LOG_FILE_BACKUP_COUNT = 7
+LOG_QUEUE_SIZE = 10000
+
+# Drops and counts records when the queue is full instead of waiting
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+  def __init__(self, queue):
+    super(NonBlockingQueueHandler, self).__init__(queue)
+    self.dropped = 0
+
+  def enqueue(self, record):
+    try:
+      if self.dropped:
+        self.queue.put_nowait(logging.makeLogRecord({'name': type(self).__name__, 'levelno': logging.WARNING, 'levelname': 'WARNING', 'msg': "Dropped %d log messages because the log queue was full" % self.dropped}))
+        self.dropped = 0
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+class LogListener(logging.handlers.QueueListener):
+  def stop(self):
+    # Also registered at exit, so stopping twice must be harmless
+    if self._thread is not None:
+      super(LogListener, self).stop()
+
+# At most `burst` records per message template and logger every `interval` seconds
+class RateLimitFilter(logging.Filter):
+  def __init__(self, burst=10, interval=60):
+    super(RateLimitFilter, self).__init__()
+    self.burst = burst
+    self.interval = interval
+    self.windows = {}
+    self.lock = threading.Lock()
+
+  def filter(self, record):
+    if record.levelno >= logging.WARNING:
+      return True
+    key = (record.name, record.msg)
+    now = time.monotonic()
+    with self.lock:
+      window = self.windows.get(key)
+      if window is None or now - window[0] >= self.interval:
+        suppressed = window[2] if window is not None else 0
+        self.windows[key] = [now, 1, 0]
+      elif window[1] < self.burst:
+        window[1] += 1
+        suppressed = 0
+      else:
+        window[2] += 1
+        return False
+    if suppressed:
+      record.msg = '%s [%d similar messages suppressed]' % (record.getMessage(), suppressed)
+      record.args = None
+    return True
+
+def setup_logging(log_file=None, level=logging.INFO, stream=sys.stdout):
+  # Records are written by a listener thread, so callers never wait on console or SD card I/O
+  root_log = logging.getLogger('')
+  root_log.setLevel(level)
+  formatter = logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+
+  handlers = []
+  stream_handler = logging.StreamHandler(stream)
+  stream_handler.setFormatter(formatter)
+  handlers.append(stream_handler)
+
+  if log_file is not None:
+    file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUP_COUNT)
+    file_handler.setFormatter(formatter)
+    handlers.append(file_handler)
+
+  log_queue = queue.Queue(LOG_QUEUE_SIZE)
+  root_log.addHandler(NonBlockingQueueHandler(log_queue))
+  listener = LogListener(log_queue, *handlers, respect_handler_level=True)
+  listener.start()
+  atexit.register(listener.stop)
+  return listener
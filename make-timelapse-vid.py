@@ -2,12 +2,30 @@
 import os
 import tempfile
 import logging
-from logging.handlers import RotatingFileHandler
+import logsetup
 import sys
 import shutil
-from subprocess import call
+import threading
+import queue
+import time
+import re
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import call, check_output, Popen, PIPE, STDOUT, CalledProcessError
+from functools import partial
+import io
+from datetime import datetime
+from catalog import CaptureCatalog, DEFAULT_CATALOG_FILE
+try:
+  import numpy
+  from PIL import Image
+except ImportError:
+  numpy = None
+  Image = None
 
 LOG_FILE = 'timelapse-video-builder.log'
+LOG_LEVEL = logging.INFO
 SRC_FOLDER = '/mnt/constructioncam/timelapse'
 DST_FOLDER = '/mnt/constructioncam-vids/timelapse'
 
@@ -15,69 +33,491 @@ AVCONV_BIN = '/usr/bin/avconv'
 IMG_FMT = 'img_%04d.jpg'
 FRAMERATE = 30
 QUALITY = 22 # lower is better, 23 is default, 0 is lossless, sensible is between 18 and 28
+INPUT_MODE = 'pipe' # 'pipe' streams the frames to avconv's stdin, 'symlinks' builds a temporary symlink dir
+INCLUDE_NIGHT = False
+NIGHT_SUBDIR = 'night'
+READ_AHEAD_FRAMES = 32
+MAX_JOBS = 2
+THREADS_PER_JOB = 2 # 0 lets avconv decide
+INCREMENTAL = True # encode hourly segments and assemble each day by stream copy
+SEGMENT_FOLDER = os.path.join(DST_FOLDER, '.segments')
+FRAME_HOUR_PATTERN = re.compile(r'img_([0-9]{8}_[0-9]{2})')
+CULL_FRAMES = True # requires numpy and PIL
+CULL_BLACK_LUMA = 12.0 # mean luminance (0-255) below which a frame counts as black
+CULL_DUPLICATE_DIFF = 1.5 # mean absolute thumbnail difference below which a frame counts as a duplicate
+ANALYSIS_THUMBNAIL_SIZE = (64, 48)
+ANALYSIS_WORKERS = 4
+FRAME_STATS_FOLDER = os.path.join(DST_FOLDER, '.framestats')
+SUMMARIES = ['week', 'month', 'project'] # built from the daily videos in DST_FOLDER
+SUMMARY_FOLDER = os.path.join(DST_FOLDER, 'summaries')
+SUMMARY_MODE = 'keyframes' # 'concat' stream copies the daily videos, 'keyframes' re-encodes only their keyframes
+DAILY_VIDEO_PATTERN = re.compile(r'^([0-9]{8})\.mkv$')
+CATALOG_FILE = DEFAULT_CATALOG_FILE # list frames from the capture catalog instead of the day folders, None to always scan
+
+class FrameReader:
+  def __init__(self, paths, read_ahead):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.paths = paths
+    self.frames = queue.Queue(maxsize=read_ahead)
+    self.keep_running = True
+
+  def start(self):
+    reader_thread = threading.Thread(target=self.__run)
+    reader_thread.daemon = True
+    reader_thread.start()
+
+  def stop(self):
+    self.keep_running = False
+    try:
+      while True:
+        self.frames.get_nowait()
+    except queue.Empty:
+      pass
+
+  def __iter__(self):
+    return iter(self.frames.get, None)
+
+  def __run(self):
+    for path in self.paths:
+      if not self.keep_running:
+        break
+      try:
+        with open(path, 'rb') as f:
+          data = f.read()
+      except OSError as e:
+        self.logger.error("Skipping frame '%s': %s", path, str(e))
+        continue
+      self.__put(data)
+    self.__put(None)
+
+  def __put(self, item):
+    while self.keep_running:
+      try:
+        self.frames.put(item, timeout=1)
+        return
+      except queue.Full:
+        pass
+
+
+class FrameAnalyzer:
+  def __init__(self, stats_folder, thumbnail_size=ANALYSIS_THUMBNAIL_SIZE, workers=ANALYSIS_WORKERS, black_luma=CULL_BLACK_LUMA, duplicate_diff=CULL_DUPLICATE_DIFF):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.stats_folder = stats_folder
+    self.thumbnail_size = thumbnail_size
+    self.workers = workers
+    self.black_luma = black_luma
+    self.duplicate_diff = duplicate_diff
+
+  def cull(self, day, frames):
+    if not frames:
+      return frames
+    (thumbs, ok) = self.analyze(day, frames)
+    pixels = thumbs.reshape(len(frames), -1).astype(numpy.float32)
+    luma = pixels.mean(axis=1)
+    diff = numpy.full(len(frames), numpy.inf, dtype=numpy.float32)
+    diff[1:] = numpy.abs(pixels[1:] - pixels[:-1]).mean(axis=1)
+
+    black = ok & (luma < self.black_luma)
+    keep = ok & ~black
+    candidates = keep.sum()
+    # Frames that barely differ from their predecessor are only dropped if they also barely differ
+    # from the last frame that was kept, so slow changes are not culled away entirely
+    last_kept = None
+    for i in numpy.flatnonzero(keep):
+      if last_kept is not None and diff[i] < self.duplicate_diff and numpy.abs(pixels[i] - pixels[last_kept]).mean() < self.duplicate_diff:
+        keep[i] = False
+      else:
+        last_kept = i
+
+    self.logger.info("Kept %d of %d frames of '%s' [%d corrupt, %d black, %d duplicate]", keep.sum(), len(frames), day, (~ok).sum(), black.sum(), candidates - keep.sum())
+    return [frame for (frame, k) in zip(frames, keep) if k]
+
+  def analyze(self, day, frames):
+    keys = []
+    for frame in frames:
+      st = os.stat(frame)
+      keys.append('%s:%d:%d' % (os.path.basename(frame), st.st_size, st.st_mtime_ns))
+    cache = self._load(day)
+    missing = [i for (i, key) in enumerate(keys) if key not in cache]
+    if missing:
+      self.logger.info("Analyzing %d frames of '%s'", len(missing), day)
+      with ThreadPoolExecutor(max_workers=self.workers) as executor:
+        for (i, result) in zip(missing, executor.map(self._analyze_frame, [frames[i] for i in missing])):
+          cache[keys[i]] = result
+      self._save(day, keys, cache)
+    thumbs = numpy.stack([cache[key][0] for key in keys])
+    ok = numpy.array([cache[key][1] for key in keys], dtype=bool)
+    return (thumbs, ok)
+
+  def _analyze_frame(self, path):
+    blank = numpy.zeros((self.thumbnail_size[1], self.thumbnail_size[0]), dtype=numpy.uint8)
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+      # A JPEG cut short by a power loss lacks its end-of-image marker
+      if not data.rstrip(b'\x00').endswith(b'\xff\xd9'):
+        self.logger.warning("Frame '%s' is truncated", path)
+        return (blank, False)
+      img = Image.open(io.BytesIO(data))
+      img.draft('L', (self.thumbnail_size[0] * 2, self.thumbnail_size[1] * 2))
+      img = img.convert('L').resize(self.thumbnail_size)
+      return (numpy.asarray(img, dtype=numpy.uint8), True)
+    except Exception as e:
+      self.logger.warning("Unable to decode frame '%s': %s", path, str(e))
+      return (blank, False)
+
+  def _cache_path(self, day):
+    return os.path.join(self.stats_folder, '%s.npz' % day)
+
+  def _load(self, day):
+    try:
+      with numpy.load(self._cache_path(day)) as npz:
+        return {key: (thumb, bool(ok)) for (key, thumb, ok) in zip(npz['keys'].tolist(), npz['thumbs'], npz['ok'])}
+    except (OSError, KeyError, ValueError):
+      return {}
+
+  def _save(self, day, keys, cache):
+    os.makedirs(self.stats_folder, exist_ok=True)
+    tmp_path = self._cache_path(day) + '.tmp.npz'
+    numpy.savez_compressed(tmp_path, keys=numpy.array(keys), thumbs=numpy.stack([cache[key][0] for key in keys]), ok=numpy.array([cache[key][1] for key in keys], dtype=bool))
+    os.replace(tmp_path, self._cache_path(day))
+
 
 class TimelapseVideoBuilder:
-  def __init__(self, src_folder, dst_folder, framerate, quality):
+  def __init__(self, src_folder, dst_folder, framerate, quality, input_mode=INPUT_MODE, include_night=INCLUDE_NIGHT, max_jobs=MAX_JOBS, threads_per_job=THREADS_PER_JOB, incremental=INCREMENTAL, segment_folder=SEGMENT_FOLDER, cull_frames=CULL_FRAMES, summaries=SUMMARIES, summary_folder=SUMMARY_FOLDER, summary_mode=SUMMARY_MODE, catalog=None):
+    self.logger = logging.getLogger(type(self).__name__)
     self.src_folder = src_folder
     self.dst_folder = dst_folder
     self.framerate = framerate
     self.quality = quality
-    self.logger = logging.getLogger(type(self).__name__)
+    self.input_mode = input_mode
+    self.include_night = include_night
+    self.max_jobs = max_jobs
+    self.threads_per_job = threads_per_job
+    self.incremental = incremental
+    self.segment_folder = segment_folder
+    self.summaries = summaries
+    self.summary_folder = summary_folder
+    self.summary_mode = summary_mode
+    self.catalog = catalog
+    self.concat_supported = None
+    self.analyzer = None
+    if cull_frames:
+      if numpy is None:
+        self.logger.warning("Not culling frames because numpy and PIL are not available")
+      else:
+        self.analyzer = FrameAnalyzer(FRAME_STATS_FOLDER)
 
-  def _make_symlinks(self, input_folder):
+  def _list_frames(self, input_folder):
+    day = os.path.basename(os.path.normpath(input_folder))
+    folders = [input_folder]
+    if self.include_night:
+      folders.append(os.path.join(input_folder, NIGHT_SUBDIR))
+    folders = [folder for folder in folders if os.path.isdir(folder)]
+    frames = self._list_frames_from_catalog(day, folders)
+    if frames is None:
+      frames = []
+      for folder in folders:
+        frames.extend(os.path.join(folder, f) for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)))
+      frames = sorted(frames, key=os.path.basename)
+    if self.analyzer is not None:
+      frames = self.analyzer.cull(day, frames)
+    return frames
+
+  def _list_frames_from_catalog(self, day, folders):
+    if self.catalog is None:
+      return None
+    try:
+      frames = self.catalog.frames(self.src_folder, day, night=None if self.include_night else False)
+    except Exception as e:
+      self.logger.warning("Unable to query capture catalog, scanning folders instead: %s", str(e))
+      return None
+    # Days the catalog does not know about (e.g. before it existed) are scanned
+    if not frames:
+      return None
+    # The catalog can miss captures (e.g. a dropped batch) or still list moved ones, so it is only used when it names
+    # exactly what is in the folders. Listing them is cheap, it is the per file checks of a scan that are saved.
+    on_disk = set()
+    for folder in folders:
+      on_disk.update(os.path.normpath(os.path.join(folder, f)) for f in os.listdir(folder) if f != NIGHT_SUBDIR)
+    if on_disk != set(os.path.normpath(f) for f in frames):
+      self.logger.info("Capture catalog does not match the folders of '%s' [catalog: %d, on disk: %d], scanning folders instead", day, len(frames), len(on_disk))
+      return None
+    return frames
+
+  def _make_symlinks(self, frames):
     tmp_dir = tempfile.mkdtemp(prefix='tmp-timelapse-symlinks-')
-    files = sorted([f for f in os.listdir(input_folder) if os.path.isfile(os.path.join(input_folder, f))])
     i = 0
-    for fn in files:
-      src_file = os.path.join(input_folder, fn)
+    for src_file in frames:
       dst_file = os.path.join(tmp_dir, IMG_FMT % i)
       os.symlink(src_file, dst_file)
       self.logger.debug("Created symlink from '%s' to '%s'", src_file, dst_file)
       i += 1
     return tmp_dir
 
+  def _check_concat(self):
+    # Segments and summaries are joined with the concat demuxer and its 'safe' option, which older avconv builds lack
+    if self.concat_supported is None:
+      try:
+        output = check_output([AVCONV_BIN, '-h', 'demuxer=concat'], stderr=STDOUT)
+        self.concat_supported = b'safe' in output
+      except (OSError, CalledProcessError) as e:
+        self.logger.debug("Unable to query the concat demuxer: %s", str(e))
+        self.concat_supported = False
+      if not self.concat_supported:
+        self.logger.error("'%s' does not support the concat demuxer with '-safe 0'", AVCONV_BIN)
+    return self.concat_supported
+
   def run(self):
-    for name in os.listdir(self.src_folder):
-      path = os.path.join(self.src_folder, name)
-      if os.path.isdir(path):
-        self.handle_dir(path)
+    if self.incremental and not self._check_concat():
+      self.logger.warning("Encoding whole days because incremental encoding needs the concat demuxer, install a newer avconv/ffmpeg to enable it")
+      self.incremental = False
+    # Newest days first, so recent footage is available soonest
+    paths = [os.path.join(self.src_folder, name) for name in sorted(os.listdir(self.src_folder), reverse=True)]
+    paths = [path for path in paths if os.path.isdir(path)]
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+      results = list(executor.map(self.handle_dir, paths))
+    encoded = [r for r in results if r is not None]
+    self.logger.info("Encoded %d videos (%d failed) in %.1f seconds using %d parallel jobs", sum(1 for (_, ok) in encoded if ok), sum(1 for (_, ok) in encoded if not ok), time.monotonic() - start_time, self.max_jobs)
+    if self.summaries:
+      if self._check_concat():
+        self.build_summaries()
+      else:
+        self.logger.error("Not building summaries because they need the concat demuxer")
+
+  def _summary_groups(self):
+    groups = {}
+    for name in sorted(os.listdir(self.dst_folder)):
+      m = DAILY_VIDEO_PATTERN.match(name)
+      if m is None:
+        continue
+      day = datetime.strptime(m.group(1), '%Y%m%d')
+      keys = {
+        'week': 'week-%04dW%02d' % day.isocalendar()[:2],
+        'month': 'month-%s' % day.strftime('%Y%m'),
+        'project': 'project'}
+      for summary in self.summaries:
+        groups.setdefault(keys[summary], []).append(os.path.join(self.dst_folder, name))
+    return groups
+
+  def build_summaries(self):
+    os.makedirs(self.summary_folder, exist_ok=True)
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+      results = list(executor.map(lambda item: self.handle_summary(*item), sorted(self._summary_groups().items(), reverse=True)))
+    built = [r for r in results if r is not None]
+    self.logger.info("Built %d summary videos (%d failed) in %.1f seconds", sum(1 for (_, ok) in built if ok), sum(1 for (_, ok) in built if not ok), time.monotonic() - start_time)
+
+  def handle_summary(self, name, inputs):
+    output_path = os.path.join(self.summary_folder, '%s.mkv' % name)
+    state_path = os.path.join(self.summary_folder, '.%s.json' % name)
+    # Only rebuild when one of the daily videos it is made of was added or changed
+    state = [self.summary_mode, self._summary_filter(), self.framerate, self.quality] + [[os.path.basename(p), os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in inputs]
+    try:
+      with open(state_path, 'r') as f:
+        if os.path.exists(output_path) and json.load(f) == state:
+          self.logger.debug("Skipping summary '%s' because its inputs did not change", name)
+          return None
+    except (OSError, ValueError):
+      pass
+
+    def save_state():
+      with open(state_path, 'w') as f:
+        json.dump(state, f)
+    return self._build(name, output_path, partial(self.make_summary_video, inputs), save_state)
+
+  def make_summary_video(self, inputs, name, output_filename):
+    list_path = os.path.join(self.summary_folder, '.%s.concat.txt' % name)
+    with open(list_path, 'w') as f:
+      for path in inputs:
+        f.write("file '%s'\n" % path.replace("'", "'\\''"))
+    self.logger.info("Building summary '%s' from %d daily videos [mode: %s]", name, len(inputs), self.summary_mode)
+    if self.summary_mode == 'concat':
+      return call([AVCONV_BIN, '-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', '-f', 'matroska', '-y', output_filename])
+    # Only keyframes are decoded, so a month of footage is sampled without decoding every frame
+    # The keyframes keep their original timestamps, they are re-timed to consecutive frames or the summary lasts as long as its inputs
+    return call([AVCONV_BIN, '-skip_frame', 'nokey', '-f', 'concat', '-safe', '0', '-i', list_path, '-vf', self._summary_filter()] + self._encoder_output_args(output_filename))
+
+  def _summary_filter(self):
+    return 'setpts=N/(%s*TB)' % self.framerate
 
   def handle_dir(self, input_folder):
     (_, output_filename) = os.path.split(input_folder)
     output_path = os.path.join(self.dst_folder, "%s.mkv" % output_filename)
+    if self.incremental:
+      state = self._dir_state(input_folder)
+      saved_state = self._load_state(output_filename)
+      if os.path.exists(output_path) and saved_state == state:
+        self.logger.debug("Skipping '%s' because it did not change since '%s' was assembled", input_folder, output_path)
+        return None
+      # Videos encoded before incremental mode have no state, they are adopted unless the day changed after them
+      if os.path.exists(output_path) and saved_state is None and max(t for t in state[:2] if t is not None) <= os.stat(output_path).st_mtime_ns:
+        self.logger.info("Adopting '%s' as the video of '%s'", output_path, input_folder)
+        self._save_state(output_filename, state)
+        return None
+      return self._build(input_folder, output_path, self.assemble_timelapse_video, partial(self._save_state, output_filename, state))
+
     if os.path.exists(output_path):
       self.logger.debug("Skipping '%s' because output file '%s' already exists", input_folder, output_path)
-      return
+      return None
+    return self._build(input_folder, output_path, self.make_timelapse_video)
+
+  def _build(self, input_folder, output_path, build_func, on_success=None):
+    # Encode to a temporary file and rename it when done, so a crash never leaves a partial output behind
+    (output_dir, output_filename) = os.path.split(output_path)
+    tmp_path = os.path.join(output_dir, ".%s.tmp" % output_filename)
+    start_time = time.monotonic()
+    returncode = None
+    try:
+      returncode = build_func(input_folder, tmp_path)
+      # Nothing to encode (e.g. a day without frames) is skipped rather than counted and retried as a failure
+      if returncode is None:
+        self.logger.info("Skipping '%s' because there is nothing to encode", input_folder)
+        return None
+    except Exception:
+      self.logger.exception("Error encoding '%s'", input_folder)
+    elapsed = time.monotonic() - start_time
+
+    if returncode == 0:
+      os.replace(tmp_path, output_path)
+      if on_success is not None:
+        on_success()
+      self.logger.info("Encoded '%s' to '%s' in %.1f seconds", input_folder, output_path, elapsed)
+      return (elapsed, True)
+
+    self.logger.error("Encoding '%s' failed after %.1f seconds [return code: %s]", input_folder, elapsed, returncode)
+    try:
+      os.remove(tmp_path)
+    except FileNotFoundError:
+      pass
+    return (elapsed, False)
+
+  def _dir_state(self, input_folder):
+    folders = [input_folder, os.path.join(input_folder, NIGHT_SUBDIR)]
+    return [os.stat(f).st_mtime_ns if os.path.isdir(f) else None for f in folders] + [self.framerate, self.quality, self.include_night]
+
+  def _state_path(self, day):
+    return os.path.join(self.segment_folder, day, 'state.json')
 
-    self.make_timelapse_video(input_folder, output_path)
+  def _load_state(self, day):
+    try:
+      with open(self._state_path(day), 'r') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def _save_state(self, day, state):
+    os.makedirs(os.path.dirname(self._state_path(day)), exist_ok=True)
+    with open(self._state_path(day), 'w') as f:
+      json.dump(state, f)
+
+  def _segment_key(self, frames):
+    d = hashlib.sha1(('%d:%d\n' % (self.framerate, self.quality)).encode())
+    for frame in frames:
+      st = os.stat(frame)
+      d.update(('%s:%d:%d\n' % (os.path.basename(frame), st.st_size, st.st_mtime_ns)).encode())
+    return d.hexdigest()[:16]
+
+  def _group_by_hour(self, frames):
+    hours = {}
+    for frame in frames:
+      m = FRAME_HOUR_PATTERN.match(os.path.basename(frame))
+      if m is None:
+        self.logger.warning("Skipping frame '%s' because its hour cannot be determined", frame)
+        continue
+      hours.setdefault(m.group(1), []).append(frame)
+    return hours
+
+  def assemble_timelapse_video(self, input_folder, output_filename):
+    (_, day) = os.path.split(input_folder)
+    segment_dir = os.path.join(self.segment_folder, day)
+    os.makedirs(segment_dir, exist_ok=True)
+
+    segments = []
+    for (hour, frames) in sorted(self._group_by_hour(self._list_frames(input_folder)).items()):
+      # Segments are keyed by their frame list, so only hours that gained or lost frames are re-encoded
+      segment_path = os.path.join(segment_dir, '%s-%s.mkv' % (hour, self._segment_key(frames)))
+      if not os.path.exists(segment_path):
+        tmp_path = os.path.join(segment_dir, '.%s.tmp' % os.path.basename(segment_path))
+        returncode = self.stream_timelapse_video(frames, tmp_path)
+        if returncode != 0:
+          self.logger.error("Encoding segment '%s' failed [return code: %s]", segment_path, returncode)
+          return returncode
+        os.replace(tmp_path, segment_path)
+      else:
+        self.logger.debug("Reusing segment '%s'", segment_path)
+      segments.append(segment_path)
+
+    for name in os.listdir(segment_dir):
+      path = os.path.join(segment_dir, name)
+      if name.endswith('.mkv') and path not in segments:
+        self.logger.debug("Removing stale segment '%s'", path)
+        os.remove(path)
+
+    if not segments:
+      self.logger.warning("No frames found in '%s'", input_folder)
+      return None
+    list_path = os.path.join(segment_dir, 'concat.txt')
+    with open(list_path, 'w') as f:
+      for segment_path in segments:
+        f.write("file '%s'\n" % segment_path.replace("'", "'\\''"))
+    self.logger.info("Concatenating %d segments to '%s'", len(segments), output_filename)
+    return call([AVCONV_BIN, '-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', '-f', 'matroska', '-y', output_filename])
+
+  def _encoder_output_args(self, output_filename):
+    return ['-r', str(self.framerate), '-vcodec', 'libx264', '-preset', 'slow', '-crf', str(self.quality), '-threads', str(self.threads_per_job), '-f', 'matroska', '-y', output_filename]
 
   def make_timelapse_video(self, input_folder, output_filename):
+    frames = self._list_frames(input_folder)
+    if not frames:
+      self.logger.warning("No frames found in '%s'", input_folder)
+      return None
+    if self.input_mode == 'pipe':
+      return self.stream_timelapse_video(frames, output_filename)
+
     self.logger.info("Creating symlinks for '%s'", input_folder)
-    tmp_dir = self._make_symlinks(input_folder)
+    tmp_dir = self._make_symlinks(frames)
     input_filename = os.path.join(tmp_dir, IMG_FMT)
 
     self.logger.info("Encoding video to '%s'", output_filename)
-    call([AVCONV_BIN, '-f', 'image2', '-r', str(self.framerate), '-i', input_filename, '-r', str(self.framerate), '-vcodec', 'libx264', '-preset', 'slow', '-crf', str(self.quality), output_filename])
+    returncode = call([AVCONV_BIN, '-f', 'image2', '-r', str(self.framerate), '-i', input_filename] + self._encoder_output_args(output_filename))
     self.logger.info("Removing temporary dir '%s'", tmp_dir)
     shutil.rmtree(tmp_dir)
+    return returncode
 
-def setup_logging():
-  root_log = logging.getLogger('')
-  root_log.setLevel(logging.INFO)
-  formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(name)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
-
-  stream_handler = logging.StreamHandler(sys.stdout)
-  stream_handler.setFormatter(formatter)
-  root_log.addHandler(stream_handler)
+  def stream_timelapse_video(self, frames, output_filename):
+    self.logger.info("Encoding %d frames to '%s'", len(frames), output_filename)
+    reader = FrameReader(frames, READ_AHEAD_FRAMES)
+    reader.start()
+    process = Popen([AVCONV_BIN, '-f', 'image2pipe', '-vcodec', 'mjpeg', '-r', str(self.framerate), '-i', '-'] + self._encoder_output_args(output_filename), stdin=PIPE)
+    try:
+      for data in reader:
+        process.stdin.write(data)
+    except BrokenPipeError:
+      self.logger.error("Encoder exited before all frames were written to '%s'", output_filename)
+    finally:
+      reader.stop()
+      try:
+        process.stdin.close()
+      except BrokenPipeError:
+        pass
+    return process.wait()
 
-  file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=(1024*1024*10), backupCount=7)
-  file_handler.setFormatter(formatter)
-  root_log.addHandler(file_handler)
+def setup_logging():
+  logsetup.setup_logging(LOG_FILE, LOG_LEVEL)
 
 def main():
   setup_logging()
-  builder = TimelapseVideoBuilder(SRC_FOLDER, DST_FOLDER, FRAMERATE, QUALITY)
-  builder.run()
+  catalog = None
+  if CATALOG_FILE is not None and os.path.exists(CATALOG_FILE):
+    catalog = CaptureCatalog(CATALOG_FILE)
+  try:
+    builder = TimelapseVideoBuilder(SRC_FOLDER, DST_FOLDER, FRAMERATE, QUALITY, catalog=catalog)
+    builder.run()
+  finally:
+    if catalog is not None:
+      catalog.close()
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,182 @@
+import bisect
+import logging
+import math
+import threading
+import http.server
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_value(value):
+  if math.isinf(value):
+    return '+Inf' if value > 0 else '-Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _format_labels(labelnames, labelvalues, extra=()):
+  pairs = list(zip(labelnames, labelvalues)) + list(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (name, value) in pairs)
+
+class Metric:
+  TYPE = None
+
+  def __init__(self, name, help, labelnames=()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def _key(self, labels):
+    if len(labels) != len(self.labelnames):
+      raise ValueError("Metric '%s' expects labels %s" % (self.name, ', '.join(self.labelnames)))
+    return tuple(labels[name] for name in self.labelnames)
+
+  def remove(self, **labels):
+    with self.lock:
+      self.values.pop(self._key(labels), None)
+
+  def clear(self):
+    with self.lock:
+      self.values.clear()
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.TYPE)]
+    with self.lock:
+      for (key, value) in self.values.items():
+        lines.append('%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value)))
+    return lines
+
+class Counter(Metric):
+  TYPE = 'counter'
+
+  def inc(self, amount=1, **labels):
+    key = self._key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+  TYPE = 'gauge'
+
+  def set(self, value, **labels):
+    key = self._key(labels)
+    with self.lock:
+      self.values[key] = value
+
+  def inc(self, amount=1, **labels):
+    key = self._key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+class Histogram(Metric):
+  TYPE = 'histogram'
+
+  def __init__(self, name, help, buckets=DEFAULT_BUCKETS, labelnames=()):
+    super(Histogram, self).__init__(name, help, labelnames)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, **labels):
+    key = self._key(labels)
+    index = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      series = self.values.get(key)
+      if series is None:
+        # Bucket counts are allocated once per label set, so observing never allocates
+        series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+      series[0][index] += 1
+      series[1] += value
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.TYPE)]
+    with self.lock:
+      snapshot = [(key, list(counts), total) for (key, (counts, total)) in self.values.items()]
+    for (key, counts, total) in snapshot:
+      cumulative = 0
+      for (bound, count) in zip(self.buckets + (math.inf,), counts):
+        cumulative += count
+        lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))]), cumulative))
+      lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(total)))
+      lines.append('%s_count%s %d' % (self.name, _format_labels(self.labelnames, key), cumulative))
+    return lines
+
+class MetricsRegistry:
+  def __init__(self):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.metrics = []
+    self.collectors = []
+    self.lock = threading.Lock()
+    # Collectors advance counters by what changed since they last ran, concurrent scrapes must not both apply it
+    self.collect_lock = threading.Lock()
+
+  def counter(self, name, help, labelnames=()):
+    return self.register(Counter(name, help, labelnames))
+
+  def gauge(self, name, help, labelnames=()):
+    return self.register(Gauge(name, help, labelnames))
+
+  def histogram(self, name, help, buckets=DEFAULT_BUCKETS, labelnames=()):
+    return self.register(Histogram(name, help, buckets, labelnames))
+
+  def register(self, metric):
+    with self.lock:
+      self.metrics.append(metric)
+    return metric
+
+  def add_collector(self, func):
+    with self.lock:
+      self.collectors.append(func)
+
+  def remove_collector(self, func):
+    with self.lock:
+      self.collectors.remove(func)
+
+  def render(self):
+    with self.lock:
+      collectors = list(self.collectors)
+      metrics = list(self.metrics)
+    with self.collect_lock:
+      for collector in collectors:
+        try:
+          collector()
+        except Exception:
+          self.logger.exception("Error running metrics collector %r", collector)
+    lines = []
+    for metric in metrics:
+      lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = self.server.registry.render().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, server_address, registry=REGISTRY):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.registry = registry
+    super(MetricsServer, self).__init__(server_address, MetricsRequestHandler)
+
+  def start(self):
+    server_thread = threading.Thread(target=self.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    self.logger.info("Serving metrics on http://%s:%d/metrics", self.server_address[0], self.server_address[1])
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+import time
+import logging
+import argparse
+import threading
+import metrics
+import logsetup
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+MOTION_VECTOR_THRESHOLD = 10 # vector length above which a macroblock counts as moving
+MOTION_MIN_FRACTION = 0.005 # fraction of a region that must move on top of its baseline
+MOTION_ACTIVITY_FACTOR = 3.0 # how many times its baseline a region must move to be active
+MOTION_BASELINE_SECONDS = 300 # time constant of the rolling baseline
+MOTION_MAX_FPS = 2 # frames analyzed per second, the rest is skipped to bound the cost
+
+MOTION_ANALYSIS_DURATION = metrics.REGISTRY.histogram('picamserver_motion_analysis_duration_seconds', 'Time taken to analyze the motion vectors of a frame', (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05))
+MOTION_FRAMES_SKIPPED = metrics.REGISTRY.counter('picamserver_motion_frames_skipped_total', 'Frames of motion vectors not analyzed because of the analysis rate limit')
+MOTION_ACTIVITY = metrics.REGISTRY.gauge('picamserver_motion_activity_ratio', 'Fraction of the macroblocks of a region that moved in the last analyzed frame', ('region',))
+MOTION_BASELINE = metrics.REGISTRY.gauge('picamserver_motion_baseline_ratio', 'Rolling baseline of the moving fraction of a region', ('region',))
+MOTION_ACTIVE = metrics.REGISTRY.gauge('picamserver_motion_active', 'Whether a region currently shows activity above its baseline', ('region',))
+
+def motion_frame_shape(resolution):
+  # The encoder writes an extra column of vectors
+  (width, height) = resolution
+  return ((height + 15) // 16, (width + 15) // 16 + 1)
+
+if numpy is not None:
+  MOTION_DTYPE = numpy.dtype([('x', 'i1'), ('y', 'i1'), ('sad', 'u2')])
+
+class ActivitySchedule:
+  def __init__(self, base_interval, active_interval, idle_interval, hold, idle_after):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.base_interval = base_interval
+    self.active_interval = active_interval
+    self.idle_interval = idle_interval
+    self.hold = hold.total_seconds()
+    self.idle_after = idle_after.total_seconds()
+    self.started = time.monotonic()
+    self.last_activity = None
+    self.on_activity = None
+    self.lock = threading.Lock()
+
+  def activity(self, active):
+    if not active:
+      return
+    with self.lock:
+      was_active = self.is_active()
+      self.last_activity = time.monotonic()
+    if not was_active:
+      self.logger.info("Activity detected, capturing every %d seconds", self.active_interval.total_seconds())
+      if self.on_activity is not None:
+        self.on_activity()
+
+  def is_active(self):
+    return self.last_activity is not None and time.monotonic() - self.last_activity < self.hold
+
+  def interval(self):
+    if self.is_active():
+      return self.active_interval
+    if time.monotonic() - (self.last_activity or self.started) > self.idle_after:
+      return self.idle_interval
+    return self.base_interval
+
+# A region is active when more of it moves than MOTION_ACTIVITY_FACTOR times its rolling baseline, so swaying trees are learned away
+class MotionAnalyzer:
+  def __init__(self, resolution, regions, schedule=None, vector_threshold=MOTION_VECTOR_THRESHOLD, min_fraction=MOTION_MIN_FRACTION, activity_factor=MOTION_ACTIVITY_FACTOR, baseline_seconds=MOTION_BASELINE_SECONDS, max_fps=MOTION_MAX_FPS):
+    self.logger = logging.getLogger(type(self).__name__)
+    if numpy is None:
+      raise RuntimeError("numpy is required for motion analysis")
+    (self.rows, self.cols) = motion_frame_shape(resolution)
+    self.frame_bytes = self.rows * self.cols * MOTION_DTYPE.itemsize
+    self.region_names = list(regions)
+    self.masks = numpy.zeros((len(regions), self.rows, self.cols), dtype=bool)
+    for (i, name) in enumerate(self.region_names):
+      (x0, y0, x1, y1) = regions[name]
+      # The last column holds no vector, it is never part of a region
+      self.masks[i, int(y0 * self.rows):int(numpy.ceil(y1 * self.rows)), int(x0 * (self.cols - 1)):int(numpy.ceil(x1 * (self.cols - 1)))] = True
+    self.mask_sizes = numpy.maximum(self.masks.sum(axis=(1, 2)), 1)
+    self.schedule = schedule
+    self.threshold_squared = vector_threshold * vector_threshold
+    self.min_fraction = min_fraction
+    self.activity_factor = activity_factor
+    self.baseline_seconds = baseline_seconds
+    self.min_frame_interval = 1.0 / max_fps if max_fps else 0
+    self.baseline = None
+    self.last_analysis = None
+    self.analyzed = 0
+    self.skipped = 0
+
+  def write(self, b):
+    now = time.monotonic()
+    if self.last_analysis is not None and now - self.last_analysis < self.min_frame_interval:
+      self.skipped += 1
+      MOTION_FRAMES_SKIPPED.inc()
+      return len(b)
+    start_time = time.perf_counter()
+    active = self.analyze(b, now)
+    MOTION_ANALYSIS_DURATION.observe(time.perf_counter() - start_time)
+    if self.schedule is not None:
+      self.schedule.activity(bool(active))
+    return len(b)
+
+  def flush(self):
+    pass
+
+  def analyze(self, data, now=None):
+    if now is None: now = time.monotonic()
+    if len(data) < self.frame_bytes:
+      self.logger.debug("Ignoring short motion frame of %d bytes, expected %d", len(data), self.frame_bytes)
+      return []
+    vectors = numpy.frombuffer(data, dtype=MOTION_DTYPE, count=self.rows * self.cols).reshape(self.rows, self.cols)
+    x = vectors['x'].astype(numpy.int16)
+    y = vectors['y'].astype(numpy.int16)
+    moving = (x * x + y * y) > self.threshold_squared
+    fractions = (self.masks & moving).sum(axis=(1, 2)) / self.mask_sizes
+
+    if self.baseline is None:
+      self.baseline = fractions.copy()
+    active = fractions > self.baseline * self.activity_factor + self.min_fraction
+    elapsed = now - self.last_analysis if self.last_analysis is not None else 0
+    alpha = min(1.0, elapsed / self.baseline_seconds)
+    self.baseline += alpha * (fractions - self.baseline)
+    self.last_analysis = now
+    self.analyzed += 1
+
+    for (i, name) in enumerate(self.region_names):
+      MOTION_ACTIVITY.set(float(fractions[i]), region=name)
+      MOTION_BASELINE.set(float(self.baseline[i]), region=name)
+      MOTION_ACTIVE.set(int(active[i]), region=name)
+    return [name for (name, a) in zip(self.region_names, active) if a]
+
+class MotionDumpWriter:
+  def __init__(self, output, path, max_bytes=64*1024*1024):
+    self.output = output
+    self.path = path
+    self.max_bytes = max_bytes
+    self.written = 0
+    self.file = open(path, 'ab')
+
+  def write(self, b):
+    if self.written + len(b) <= self.max_bytes:
+      self.file.write(b)
+      self.written += len(b)
+    return self.output.write(b)
+
+  def flush(self):
+    self.file.flush()
+    self.output.flush()
+
+  def close(self):
+    self.file.close()
+
+def read_dump(path, resolution):
+  (rows, cols) = motion_frame_shape(resolution)
+  frame_bytes = rows * cols * 4
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(frame_bytes)
+      if len(data) < frame_bytes:
+        return
+      yield data
+
+def replay(path, resolution, regions, framerate, **kwargs):
+  analyzer = MotionAnalyzer(resolution, regions, **kwargs)
+  timeline = []
+  durations = []
+  for (i, data) in enumerate(read_dump(path, resolution)):
+    now = i / float(framerate)
+    if analyzer.last_analysis is not None and now - analyzer.last_analysis < analyzer.min_frame_interval:
+      analyzer.skipped += 1
+      continue
+    start_time = time.perf_counter()
+    active = analyzer.analyze(data, now)
+    durations.append(time.perf_counter() - start_time)
+    timeline.append((now, active))
+  return (analyzer, timeline, durations)
+
+def main():
+  parser = argparse.ArgumentParser(description="Replay a recorded motion vector dump through the motion analysis")
+  parser.add_argument('dump')
+  parser.add_argument('--resolution', default='947x720', help="resolution the vectors were recorded at (default: %(default)s)")
+  parser.add_argument('--framerate', type=float, default=7)
+  parser.add_argument('--max-fps', type=float, default=MOTION_MAX_FPS)
+  parser.add_argument('--threshold', type=int, default=MOTION_VECTOR_THRESHOLD)
+  args = parser.parse_args()
+  logsetup.setup_logging(None, logging.INFO)
+  resolution = tuple(int(v) for v in args.resolution.split('x'))
+  (analyzer, timeline, durations) = replay(args.dump, resolution, {'frame': (0.0, 0.0, 1.0, 1.0)}, args.framerate, max_fps=args.max_fps, vector_threshold=args.threshold)
+  previous = None
+  for (t, active) in timeline:
+    if active != previous:
+      print("%8.1fs %s" % (t, ', '.join(active) or '-'))
+      previous = active
+  if durations:
+    durations.sort()
+    print("Analyzed %d frames, skipped %d: %.3f ms median, %.3f ms max per frame" % (analyzer.analyzed, analyzer.skipped, durations[len(durations) // 2] * 1000, durations[-1] * 1000))
+
+if __name__ == "__main__":
+  main()
@@ -1,22 +1,40 @@
 #!/usr/bin/python3
 from datetime import datetime, timedelta
 import logging
-from logging.handlers import RotatingFileHandler
+import logsetup
 import os
 import astral
 import pytz
 import re
 import sys
+import json
+from suncalendar import SunCalendar
+from catalog import CaptureCatalog, DEFAULT_CATALOG_FILE
 
 TZ = pytz.timezone('Europe/Brussels')
 DIR = '/mnt/storage0/timelapse/'
 IMG_PATTERN = re.compile('img_([0-9_]+)(\.jpg|_md5-)')
 LOC = astral.Location(('Eksel', 'Europe', 51.15, 5.3833, 'Europe/Brussels', 0))
 LOC.solar_depression = 8.5
+SUN_CALENDAR_CACHE_FILE = os.path.expanduser('~/.cache/picamserver/sun-calendar.json')
+CALENDAR = SunCalendar(LOC, cache_file=SUN_CALENDAR_CACHE_FILE)
+INCREMENTAL = True
+JOURNAL_FILE = os.path.join(DIR, '.move_night_journal.json')
+LOG_LEVEL = logging.INFO
+CATALOG_FILE = DEFAULT_CATALOG_FILE # None to not keep the capture catalog up to date
 
-def move_files(day, path, base_dir):
-  global logger
+logger = logging.getLogger('move_night')
+
+class DestinationExistsError(Exception):
+  def __init__(self, path):
+    self.path = path
+
+  def __str__(self):
+    return repr(self.path)
+
+def plan_moves(day, path, base_dir):
   logger.info("Handling dir '%s' as date '%s' with base dir '%s'", path, day, base_dir)
+  files = []
   for name in os.listdir(path):
     filepath = os.path.join(path, name)
     if os.path.isfile(filepath):
@@ -26,48 +44,133 @@ def move_files(day, path, base_dir):
         continue
 
       timestr = m.group(1)
-      time = TZ.localize(datetime.strptime(timestr, '%Y%m%d_%H%M%S'))
-      if is_night(time):
-        dst_dir = os.path.join(base_dir, 'night')
-      else:
-        dst_dir = base_dir
-      dst_path = os.path.join(dst_dir, name)
-      if filepath != dst_path:
-        if os.path.exists(dst_path):
-          logging.error("Destination file '%s' already exists!", dst_path)
-          sys.exit('Abort!')
-        os.makedirs(dst_dir, exist_ok=True)
-        logging.info("Moving '%s' to '%s'", filepath, dst_path)
-        os.rename(filepath, dst_path)
+      files.append((name, filepath, TZ.localize(datetime.strptime(timestr, '%Y%m%d_%H%M%S'))))
+
+  moves = []
+  night_flags = CALENDAR.is_night_many(time for (_, _, time) in files)
+  for ((name, filepath, time), night) in zip(files, night_flags):
+    if night:
+      dst_dir = os.path.join(base_dir, 'night')
+    else:
+      dst_dir = base_dir
+    dst_path = os.path.join(dst_dir, name)
+    if filepath != dst_path:
+      moves.append((filepath, dst_path))
+  return moves
+
+def apply_moves(moves, catalog=None):
+  # Check all destinations first so a conflict never leaves a directory half moved
+  for (_, dst_path) in moves:
+    if os.path.exists(dst_path):
+      logger.error("Destination file '%s' already exists!", dst_path)
+      raise DestinationExistsError(dst_path)
+  for dst_dir in set(os.path.dirname(dst_path) for (_, dst_path) in moves):
+    os.makedirs(dst_dir, exist_ok=True)
+  for (filepath, dst_path) in moves:
+    logger.info("Moving '%s' to '%s'", filepath, dst_path)
+    os.rename(filepath, dst_path)
+    if catalog is not None:
+      catalog.renamed(filepath, dst_path, os.path.basename(os.path.dirname(dst_path)) == 'night')
+  if moves:
+    logger.info("Moved %d file(s)", len(moves))
+
+def move_files(day, path, base_dir):
+  apply_moves(plan_moves(day, path, base_dir))
 
 def is_night(time):
-  return time < LOC.dawn(date=time, local=True) or LOC.dusk(date=time, local=True) < time
+  return CALENDAR.is_night(time)
+
+def dir_state(path):
+  state = {'params': CALENDAR.key()}
+  for (key, p) in (('day', path), ('night', os.path.join(path, 'night'))):
+    try:
+      state[key + '_mtime'] = os.stat(p).st_mtime_ns
+      state[key + '_files'] = len(os.listdir(p))
+    except FileNotFoundError:
+      state[key + '_mtime'] = None
+      state[key + '_files'] = 0
+  return state
+
+def dir_files(path):
+  files = set()
+  for p in (path, os.path.join(path, 'night')):
+    try:
+      files.update(name for name in os.listdir(p) if os.path.isfile(os.path.join(p, name)))
+    except FileNotFoundError:
+      pass
+  return files
 
-def run():
-  src_path = DIR
-  for name in os.listdir(src_path):
+def load_journal(journal_file):
+  try:
+    with open(journal_file, 'r') as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {}
+  except Exception as e:
+    logger.warning("Ignoring unreadable journal '%s': %s", journal_file, str(e))
+    return {}
+
+def save_journal(journal_file, journal):
+  tmp_file = journal_file + '.tmp'
+  with open(tmp_file, 'w') as f:
+    json.dump(journal, f, indent=1, sort_keys=True)
+  os.replace(tmp_file, journal_file)
+
+def run(incremental=INCREMENTAL, src_path=DIR, journal_file=JOURNAL_FILE, catalog=None):
+  journal = load_journal(journal_file) if incremental else {}
+  skipped = 0
+  for name in sorted(os.listdir(src_path)):
     path = os.path.join(src_path, name)
     if os.path.isdir(path):
-      day = TZ.localize(datetime.strptime(name, '%Y%m%d'))
+      try:
+        day = TZ.localize(datetime.strptime(name, '%Y%m%d'))
+      except ValueError:
+        logger.info("Skipping '%s' because it is not a day directory", path)
+        continue
+      state = dir_state(path)
+      if incremental and journal.get(name) == state:
+        skipped += 1
+        continue
+
+      # Sampled before the moves, so a capture written while they run is never recorded as handled
+      files = dir_files(path)
       night_path = os.path.join(path, 'night')
-      if os.path.isdir(night_path):
-        move_files(day, night_path, path)
-      if os.path.isdir(path):
-        move_files(day, path, path)
+      try:
+        if os.path.isdir(night_path):
+          apply_moves(plan_moves(day, night_path, path), catalog)
+        apply_moves(plan_moves(day, path, path), catalog)
+      except DestinationExistsError:
+        logger.error("Not recording '%s' in the journal, it will be retried on the next run", path)
+        continue
 
-def setup_logging():
-  global logger
-  logger = logging.getLogger('')
-  logger.setLevel(logging.INFO)
-  formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(name)s - %(message)s', datefmt='%d/%m/%Y %H:    %M:%S')
+      # The moves themselves change the state, it is only recorded when they are the only change
+      new_state = dir_state(path)
+      if new_state != state and dir_files(path) != files:
+        logger.info("Not recording '%s' in the journal because it changed while being handled", path)
+        continue
 
-  stream_handler = logging.StreamHandler(sys.stdout)
-  stream_handler.setFormatter(formatter)
-  logger.addHandler(stream_handler)
+      # Saved after every directory so an aborted run resumes where it stopped
+      journal[name] = new_state
+      if incremental:
+        save_journal(journal_file, journal)
+  if skipped:
+    logger.info("Skipped %d unchanged day directories", skipped)
+  CALENDAR.save()
+
+def setup_logging():
+  logsetup.setup_logging(None, LOG_LEVEL)
 
 def main():
   setup_logging()
-  run()
+  catalog = None
+  if CATALOG_FILE is not None:
+    catalog = CaptureCatalog(CATALOG_FILE)
+    catalog.start()
+  try:
+    run(catalog=catalog)
+  finally:
+    if catalog is not None:
+      catalog.close()
 
 if __name__ == "__main__":
   main()
@@ -7,16 +7,41 @@ import hashlib
 import sys
 import functools
 import subprocess
-from logging.handlers import RotatingFileHandler
+import threading
+import time
+import sqlite3
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import logsetup
 from functools import partial
+from catalog import CaptureCatalog, DEFAULT_CATALOG_FILE
 
 LOG_FILE = 'moveimages.log'
+LOG_LEVEL = logging.INFO
+LOG_RATE_LIMIT_BURST = 20 # per-file messages of one kind logged per interval, the rest is counted
+LOG_RATE_LIMIT_INTERVAL = 60
 
 SOURCE_FOLDERS = ['/mnt/usb/timelapse/', '/mnt/sdcard/timelapse/']
 TARGET_FOLDERS = ['/mnt/storage0/timelapse/']
 MOUNT_POINTS   = ['/mnt/storage0/']
 
-MD5SUM_REGEX = re.compile(r"_md5-(?P<md5sum>[0-9A-Fa-f]32)[_\.]")
+CONCURRENT = True
+WORKERS_PER_DEVICE = 2
+MAX_FILES_IN_FLIGHT = 64
+
+COPY_ENGINE = 'tee' # 'tee' reads each source once for all destinations, 'copy2' copies and re-reads per destination
+COPY_BUFFER_SIZE = 1024*1024
+VERIFY_MODE = 'size' # 'size' checks the fsynced size of each copy, 'md5' re-reads it
+
+MANIFEST_NAME = '.moveimages-manifest.sqlite'
+MANIFEST_COMMIT_INTERVAL = 100
+SCRUB_MIN_AGE = timedelta(days=30)
+SCRUB_RATE = 2*1024*1024 # bytes/s
+SCRUB_MAX_DURATION = timedelta(minutes=30) # per destination and run of 'moveimages.py --scrub'
+CATALOG_FILE = DEFAULT_CATALOG_FILE # None to not keep the capture catalog up to date
+
+MD5SUM_REGEX = re.compile(r"_md5-(?P<md5sum>[0-9A-Fa-f]{32})[_\.]")
 
 def is_subdir_of(path, directory):
     path = os.path.realpath(path)
@@ -24,14 +49,20 @@ def is_subdir_of(path, directory):
     relative = os.path.relpath(path, directory)
     return not relative.startswith(os.pardir + os.sep)
 
+def get_md5sum_from_basename(path):
+  match = MD5SUM_REGEX.search(os.path.basename(path))
+  if match:
+    md5sum = match.group('md5sum')
+    if md5sum:
+      logging.debug('Found MD5 sum in filename %s: %s', path, md5sum)
+      return md5sum.lower()
+  return None
+
 def get_md5sum(path, try_from_basename=False):
   if try_from_basename:
-    match = MD5SUM_REGEX.search(os.path.basename(path))
-    if match:
-      md5sum = match.group('md5sum')
-      if md5sum:
-        logging.debug('Found MD5 sum in filename %s: %s', path, md5sum)
-        return md5sum
+    md5sum = get_md5sum_from_basename(path)
+    if md5sum:
+      return md5sum
 
   d = hashlib.md5()
   with open(path, mode='rb') as f:
@@ -42,6 +73,76 @@ def get_md5sum(path, try_from_basename=False):
   logging.debug("Calculated MD5 sum %s for '%s'", md5sum, path)
   return md5sum
 
+def tee_copy(src_path, dst_paths, buffer_size=COPY_BUFFER_SIZE):
+  # Reads the source once, writing every buffer to all destinations and hashing it on the way.
+  # Returns the MD5 sum of the source and a dict with the error of each failed destination.
+  d = hashlib.md5()
+  errors = {}
+  outputs = {}
+  with open(src_path, mode='rb') as src:
+    try:
+      for dst_path in dst_paths:
+        try:
+          outputs[dst_path] = open(dst_path, mode='wb')
+        except OSError as e:
+          errors[dst_path] = e
+
+      buf = bytearray(buffer_size)
+      view = memoryview(buf)
+      for n in iter(partial(src.readinto, buf), 0):
+        chunk = view[:n]
+        d.update(chunk)
+        for (dst_path, f) in list(outputs.items()):
+          try:
+            f.write(chunk)
+          except OSError as e:
+            errors[dst_path] = e
+            del outputs[dst_path]
+            f.close()
+
+      for (dst_path, f) in list(outputs.items()):
+        try:
+          f.flush()
+          os.fsync(f.fileno())
+        except OSError as e:
+          errors[dst_path] = e
+    finally:
+      for f in outputs.values():
+        f.close()
+
+  for dst_path in dst_paths:
+    if dst_path not in errors:
+      shutil.copystat(src_path, dst_path)
+  return (d.hexdigest(), errors)
+
+def kernel_copy(src_path, dst_path, buffer_size=COPY_BUFFER_SIZE):
+  # Copies without passing the data through user space, only used when the copies are re-read to verify them
+  with open(src_path, mode='rb') as src, open(dst_path, mode='wb') as dst:
+    remaining = os.fstat(src.fileno()).st_size
+    if hasattr(os, 'copy_file_range'):
+      copy_chunk = lambda count: os.copy_file_range(src.fileno(), dst.fileno(), count)
+    else:
+      offset = [0]
+      def copy_chunk(count):
+        n = os.sendfile(dst.fileno(), src.fileno(), offset[0], count)
+        offset[0] += n
+        return n
+    try:
+      while remaining > 0:
+        n = copy_chunk(min(remaining, 64*buffer_size))
+        if n == 0:
+          break
+        remaining -= n
+    except OSError:
+      # e.g. EXDEV or EINVAL on older kernels and some file systems
+      src.seek(0)
+      dst.seek(0)
+      dst.truncate()
+      shutil.copyfileobj(src, dst, buffer_size)
+    dst.flush()
+    os.fsync(dst.fileno())
+  shutil.copystat(src_path, dst_path)
+
 def mount(path):
   subprocess.call(["/bin/mount", path], timeout=10)
 
@@ -54,12 +155,193 @@ class InvalidPathException(Exception):
     return repr(self.path)
 
 
+class TransferManifest():
+  def __init__(self, root_folder, name=MANIFEST_NAME, commit_interval=MANIFEST_COMMIT_INTERVAL):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.root_folder = root_folder
+    self.path = os.path.join(root_folder, name)
+    self.commit_interval = commit_interval
+    self.uncommitted = 0
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(self.path, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, md5 TEXT NOT NULL, verified_at REAL NOT NULL)')
+    self.db.execute('CREATE INDEX IF NOT EXISTS files_verified_at ON files (verified_at)')
+    self.db.commit()
+
+  def relpath(self, path):
+    return os.path.relpath(os.path.realpath(path), os.path.realpath(self.root_folder))
+
+  def lookup(self, path, st=None):
+    # Returns the recorded MD5 sum of path if the file is unchanged since it was verified
+    if st is None:
+      st = os.stat(path)
+    with self.lock:
+      row = self.db.execute('SELECT size, mtime_ns, md5 FROM files WHERE path = ?', (self.relpath(path),)).fetchone()
+    if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+      return row[2]
+    return None
+
+  def record(self, path, md5sum, st=None):
+    if st is None:
+      st = os.stat(path)
+    with self.lock:
+      self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime_ns, md5, verified_at) VALUES (?, ?, ?, ?, ?)', (self.relpath(path), st.st_size, st.st_mtime_ns, md5sum, time.time()))
+      self.__maybe_commit()
+
+  def forget(self, path):
+    with self.lock:
+      self.db.execute('DELETE FROM files WHERE path = ?', (self.relpath(path),))
+      self.__maybe_commit()
+
+  def stale_entries(self, min_age, limit=100):
+    with self.lock:
+      return self.db.execute('SELECT path, md5 FROM files WHERE verified_at < ? ORDER BY verified_at LIMIT ?', (time.time() - min_age.total_seconds(), limit)).fetchall()
+
+  def close(self):
+    with self.lock:
+      self.db.commit()
+      self.db.close()
+
+  def __maybe_commit(self):
+    self.uncommitted += 1
+    if self.uncommitted >= self.commit_interval:
+      self.db.commit()
+      self.uncommitted = 0
+
+
+class ManifestScrubber():
+  def __init__(self, manifest, min_age, rate, max_duration):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.manifest = manifest
+    self.min_age = min_age
+    self.rate = rate
+    self.max_duration = max_duration
+    self.stop_event = threading.Event()
+    self.scrubbed = 0
+
+  def start(self):
+    self.thread = threading.Thread(target=self.__run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.stop_event.set()
+    self.thread.join()
+
+  def join(self):
+    self.thread.join()
+
+  def __run(self):
+    self.logger.info("Scrubbing entries older than %s in '%s' at %d KB/s for at most %s", str(self.min_age), self.manifest.path, self.rate // 1024, str(self.max_duration))
+    deadline = time.monotonic() + self.max_duration.total_seconds()
+    while not self.stop_event.is_set():
+      entries = self.manifest.stale_entries(self.min_age)
+      if not entries:
+        break
+      for (relpath, md5sum) in entries:
+        if self.stop_event.is_set() or time.monotonic() >= deadline:
+          self.stop_event.set()
+          break
+        path = os.path.join(self.manifest.root_folder, relpath)
+        start_time = time.monotonic()
+        try:
+          st = os.stat(path)
+          actual_md5sum = get_md5sum(path, try_from_basename=False)
+        except FileNotFoundError:
+          self.logger.warning("Scrubbed file '%s' no longer exists", path)
+          self.manifest.forget(path)
+          continue
+        except Exception as e:
+          # Forgotten, so the entry can't keep coming back in this run; it is recorded again on the next copy
+          self.logger.error("Error scrubbing '%s': %s", path, str(e))
+          self.manifest.forget(path)
+          continue
+        if actual_md5sum == md5sum:
+          self.manifest.record(path, md5sum, st)
+        else:
+          self.logger.error("Scrub of '%s' found MD5 sum %s instead of %s", path, actual_md5sum, md5sum)
+          self.manifest.forget(path)
+        self.scrubbed += 1
+        # Rate limit: spend at least size/rate seconds per file
+        self.stop_event.wait(max(0, st.st_size / self.rate - (time.monotonic() - start_time)))
+    self.logger.info("Scrubbed %d files in '%s'", self.scrubbed, self.manifest.path)
+
+
+class TransferStats():
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start_time = time.monotonic()
+    self.files = 0
+    self.bytes = 0
+    self.failed = 0
+
+  def add(self, filesize, ok):
+    with self.lock:
+      if ok:
+        self.files += 1
+        self.bytes += filesize
+      else:
+        self.failed += 1
+
+  def log(self, printfunc):
+    elapsed = max(time.monotonic() - self.start_time, 1e-6)
+    printfunc("Moved %d files (%.1f MB) in %.1f seconds: %.1f files/s, %.2f MB/s [%d files not moved]", self.files, self.bytes / (1024*1024), elapsed, self.files / elapsed, self.bytes / (1024*1024) / elapsed, self.failed)
+
+
+class DevicePools():
+  def __init__(self, workers_per_device):
+    self.workers_per_device = workers_per_device
+    self.lock = threading.Lock()
+    self.pools = {}
+
+  def get(self, path):
+    device = os.stat(path).st_dev
+    with self.lock:
+      if device not in self.pools:
+        self.pools[device] = ThreadPoolExecutor(max_workers=self.workers_per_device)
+      return self.pools[device]
+
+  def shutdown(self):
+    for pool in self.pools.values():
+      pool.shutdown(wait=True)
+
+
+class FileTransfer():
+  def __init__(self, src_path, dst_paths, filesize, pending):
+    self.src_path = src_path
+    self.dst_paths = dst_paths
+    self.filesize = filesize
+    self.pending = pending
+    self.all_ok = True
+    self.lock = threading.Lock()
+
+  def done(self, ok):
+    with self.lock:
+      self.all_ok = self.all_ok and ok
+      self.pending -= 1
+      return self.pending == 0
+
+
 class FileMover():
-  def __init__(self, src_folders, dst_folders, mountpoints):
+  def __init__(self, src_folders, dst_folders, mountpoints, concurrent=False, workers_per_device=WORKERS_PER_DEVICE, max_files_in_flight=MAX_FILES_IN_FLIGHT, copy_engine=COPY_ENGINE, verify_mode=VERIFY_MODE, use_manifest=True, catalog=None):
     self.logger = logging.getLogger(type(self).__name__)
     self.src_folders = src_folders
     self.dst_folders = dst_folders
     self.mountpoints = mountpoints
+    self.concurrent = concurrent
+    self.copy_engine = copy_engine
+    self.verify_mode = verify_mode
+    self.use_manifest = use_manifest
+    self.catalog = catalog
+    self.manifests = {}
+    self.stats = TransferStats()
+    if concurrent:
+      self.pools = DevicePools(workers_per_device)
+      self.max_files_in_flight = max_files_in_flight
+      self.in_flight = threading.BoundedSemaphore(max_files_in_flight)
+      self.dirs_to_remove = []
 
   def is_src_path(self, path):
     return any([is_subdir_of(path, x) for x in self.src_folders])
@@ -67,6 +349,9 @@ class FileMover():
   def is_dst_path(self, path):
     return any([is_subdir_of(path, x) for x in self.dst_folders])
 
+  def _dst_folder_of(self, path):
+    return next(x for x in self.dst_folders if is_subdir_of(path, x))
+
   def _check_src_path(self, src_path):
     if not self.is_src_path(src_path):
       logging.error("Path '%s' is not a file or subdirectory of any configured source folder", src_path)
@@ -80,6 +365,29 @@ class FileMover():
     return dst_path
   
   def run(self):
+    self._mount_all()
+    if self.use_manifest:
+      self._open_manifests()
+    try:
+      self._move_all()
+    finally:
+      self._close_manifests()
+
+  def scrub(self, min_age=SCRUB_MIN_AGE, rate=SCRUB_RATE, max_duration=SCRUB_MAX_DURATION):
+    # Re-hashes the copies verified longest ago, all destinations at once since they are separate disks
+    self._mount_all()
+    self._open_manifests()
+    try:
+      scrubbers = [ManifestScrubber(m, min_age, rate, max_duration) for m in self.manifests.values()]
+      for scrubber in scrubbers:
+        scrubber.start()
+      for scrubber in scrubbers:
+        scrubber.join()
+      return sum(scrubber.scrubbed for scrubber in scrubbers)
+    finally:
+      self._close_manifests()
+
+  def _mount_all(self):
     # First try to mount all destination folders
     for path in self.mountpoints:
       self.logger.info("Mounting '%s'", path)
@@ -88,9 +396,25 @@ class FileMover():
       except Exception as e:
         self.logger.error("Error mounting folder '%s': %s", path, str(e))
 
+  def _open_manifests(self):
+    for dst_folder in self.dst_folders:
+      try:
+        self.manifests[dst_folder] = TransferManifest(dst_folder)
+      except Exception as e:
+        self.logger.error("Unable to open transfer manifest in '%s': %s", dst_folder, str(e))
+
+  def _close_manifests(self):
+    for manifest in self.manifests.values():
+      manifest.close()
+    self.manifests = {}
+
+  def _move_all(self):
     # Start moving files
+    self.stats = TransferStats()
     for src_path in self.src_folders:
       self.logger.info("Handling source folder '%s'", src_path)
+      if self.catalog is not None:
+        self.logger.info("Capture catalog lists %d unverified captures in '%s'", len(self.catalog.unverified(src_path)), src_path)
       for name in os.listdir(src_path):
         path = os.path.join(src_path, name)
         if os.path.isdir(path):
@@ -98,6 +422,14 @@ class FileMover():
         elif os.path.isfile(path):
           self.move_file(src_path, name, self.dst_folders)
 
+    if self.concurrent:
+      self._wait_for_transfers()
+      self.pools.shutdown()
+      # Source dirs can only be removed once all transfers out of them have finished
+      for src_path in self.dirs_to_remove:
+        self._remove_src_dir(src_path)
+    self.stats.log(self.logger.info)
+
   def move_dir(self, base_src_path, rel_src_path, base_dst_paths):
     src_path = self._check_src_path(os.path.join(base_src_path, rel_src_path))
     dst_paths = list(map(lambda base_dst_path: self._check_dst_path(os.path.join(base_dst_path, rel_src_path)), base_dst_paths))
@@ -124,6 +456,12 @@ class FileMover():
       elif os.path.isfile(path):
         self.move_file(src_path, name, dst_paths)
 
+    if self.concurrent:
+      self.dirs_to_remove.append(src_path)
+    else:
+      self._remove_src_dir(src_path)
+
+  def _remove_src_dir(self, src_path):
     try:
       os.rmdir(src_path)
       self.logger.info("Removed empty source dir '%s'", src_path)
@@ -136,82 +474,266 @@ class FileMover():
       raise ValueError("List of destination dirs cannot be empty")
 
     src_path = self._check_src_path(os.path.join(src_dir_path, filename))
-    for dst_dir_path in dst_dir_paths:
-      self._check_dst_path(os.path.join(dst_dir_path, filename))
-    
-    # Calculate or retreive MD5 sum
-    try:
-      src_md5sum = get_md5sum(src_path, try_from_basename=True)
-    except Exception as e:
-      self.logger.error("Error retrieving MD5 sum of '%s': %s", src_path, str(e))
+    dst_paths = [self._check_dst_path(os.path.join(dst_dir_path, filename)) for dst_dir_path in dst_dir_paths]
+
+    if self.concurrent:
+      self.in_flight.acquire()
+      try:
+        job = self._tee_and_complete if self.copy_engine == 'tee' else self._hash_and_dispatch
+        self.pools.get(src_dir_path).submit(job, src_path, dst_paths)
+      except:
+        self.in_flight.release()
+        raise
+      return
+
+    if self.copy_engine == 'tee':
+      (filesize, all_ok) = self._tee_transfer(src_path, dst_paths)
+      self._finish_file(src_path, dst_paths, filesize, all_ok)
       return
 
+    src_md5sum = self._src_md5sum(src_path)
+    if src_md5sum is None:
+      self.stats.add(0, False)
+      return
     filesize = os.stat(src_path).st_size
     all_ok = True
-    for dst_dir_path in dst_dir_paths:
-      dst_path = os.path.join(dst_dir_path, filename)
+    for dst_path in dst_paths:
+      all_ok = self._copy_to_destination(src_path, src_md5sum, dst_path, filesize) and all_ok
+    self._finish_file(src_path, dst_paths, filesize, all_ok)
+
+  def _tee_transfer(self, src_path, dst_paths):
+    try:
+      filesize = os.stat(src_path).st_size
+    except OSError as e:
+      self.logger.error("Unable to stat '%s': %s", src_path, str(e))
+      return (0, False)
+    src_md5sum = get_md5sum_from_basename(src_path)
+    trusted_md5sum = src_md5sum is not None
 
+    todo = []
+    for dst_path in dst_paths:
       if os.path.isfile(dst_path):
+        if src_md5sum is None:
+          src_md5sum = self._src_md5sum(src_path)
+        if self._is_existing_copy(src_path, src_md5sum, dst_path, filesize):
+          continue
+      todo.append(dst_path)
+    if not todo:
+      return (filesize, True)
+
+    self.logger.info("Copying file '%s' to %s [filesize: %d KB, md5sum: %s]", src_path, ', '.join("'%s'" % p for p in todo), filesize // 1024, src_md5sum)
+    errors = {}
+    hashed = False
+    # The source is removed afterwards, so the copied bytes must be hashed on one side: a kernel copy
+    # is only safe when every destination is re-read, otherwise the source is hashed while copying
+    if trusted_md5sum and self.verify_mode == 'md5':
+      for dst_path in todo:
         try:
-          dst_md5sum = get_md5sum(dst_path, try_from_basename=False)
+          kernel_copy(src_path, dst_path)
         except Exception as e:
-          self.logger.error("Unable to calculate MD5 sum of existing file '%s': %s", dst_path, str(e))
-          dst_md5sum = None
-
-        if dst_md5sum is not None and dst_md5sum == src_md5sum:
-          self.logger.info("Not copying file '%s' to '%s' because destination file already exists and MD5 sum matches source", src_path, dst_path)
-          continue
-        else:
-          self.logger.warning("Destination file '%s' already exists, but MD5 sum does not match source. Will overwrite...", dst_path)
-
-      # Perform copy
-      self.logger.info("Copying file '%s' to '%s' [filesize: %d KB, md5sum: %s]", src_path, dst_path, filesize // 1024, src_md5sum)
+          errors[dst_path] = e
+    else:
       try:
-        shutil.copy2(src_path, dst_path)
-        self.logger.debug("Copied file '%s' to '%s'", src_path, dst_path)
+        (copied_md5sum, errors) = tee_copy(src_path, todo)
       except Exception as e:
+        self.logger.error("Unable to read '%s': %s", src_path, str(e))
+        return (filesize, False)
+      if src_md5sum is not None and copied_md5sum != src_md5sum:
+        # For a trusted MD5 sum from the file name this also catches a source that was corrupted since the capture
+        self.logger.error("MD5 sum of '%s' changed while copying. Found %s instead of %s", src_path, copied_md5sum, src_md5sum)
+        return (filesize, False)
+      src_md5sum = copied_md5sum
+      hashed = True
+
+    all_ok = True
+    for dst_path in todo:
+      if dst_path in errors:
         all_ok = False
-        self.logger.error("Unable to copy file '%s' to '%s': %s", src_path, dst_path, str(e))
-        continue
+        self.logger.error("Unable to copy file '%s' to '%s': %s", src_path, dst_path, str(errors[dst_path]))
+      elif not self._verify_copy(src_path, src_md5sum, dst_path, filesize, hashed):
+        all_ok = False
+    return (filesize, all_ok)
 
-      # Calculate and compare MD5 sum
-      try:
+  def _tee_and_complete(self, src_path, dst_paths):
+    try:
+      (filesize, all_ok) = self._tee_transfer(src_path, dst_paths)
+      self._finish_file(src_path, dst_paths, filesize, all_ok)
+    except:
+      self.logger.exception("Error transferring '%s'", src_path)
+    finally:
+      self.in_flight.release()
+
+  def _manifest_for(self, path):
+    for (dst_folder, manifest) in self.manifests.items():
+      if is_subdir_of(path, dst_folder):
+        return manifest
+    return None
+
+  def _record_verified(self, dst_path, md5sum):
+    manifest = self._manifest_for(dst_path)
+    if manifest is None or md5sum is None:
+      return
+    try:
+      manifest.record(dst_path, md5sum)
+    except Exception as e:
+      self.logger.error("Unable to record '%s' in transfer manifest: %s", dst_path, str(e))
+
+  def _is_existing_copy(self, src_path, src_md5sum, dst_path, filesize):
+    try:
+      st = os.stat(dst_path)
+      manifest = self._manifest_for(dst_path)
+      dst_md5sum = manifest.lookup(dst_path, st) if manifest is not None else None
+      if dst_md5sum is not None:
+        self.logger.debug("Using MD5 sum of '%s' from transfer manifest", dst_path)
+      elif st.st_size != filesize:
+        dst_md5sum = None
+      else:
         dst_md5sum = get_md5sum(dst_path, try_from_basename=False)
-      except Exception as e:
-        all_ok = False
-        self.logger.error("Error calculating MD5 sum of '%s': %s", dst_path, str(e))
+        if dst_md5sum == src_md5sum:
+          self._record_verified(dst_path, dst_md5sum)
+    except Exception as e:
+      self.logger.error("Unable to calculate MD5 sum of existing file '%s': %s", dst_path, str(e))
+      dst_md5sum = None
+
+    if dst_md5sum is not None and dst_md5sum == src_md5sum:
+      self.logger.info("Not copying file '%s' to '%s' because destination file already exists and MD5 sum matches source", src_path, dst_path)
+      return True
+    self.logger.warning("Destination file '%s' already exists, but MD5 sum does not match source. Will overwrite...", dst_path)
+    return False
+
+  def _verify_copy(self, src_path, src_md5sum, dst_path, filesize, hashed=False):
+    # `hashed` tells that src_md5sum was computed from the very bytes written to dst_path
+    try:
+      if self.verify_mode == 'md5':
+        dst_md5sum = get_md5sum(dst_path, try_from_basename=False)
+        ok = dst_md5sum == src_md5sum
+      else:
+        dst_size = os.stat(dst_path).st_size
+        ok = dst_size == filesize
+    except Exception as e:
+      self.logger.error("Error verifying '%s': %s", dst_path, str(e))
+      return False
+    if not ok:
+      self.logger.error("Copy '%s' of '%s' failed verification [verify mode: %s]", dst_path, src_path, self.verify_mode)
+    elif self.verify_mode == 'md5' or hashed:
+      # The manifest is trusted on later runs and by the scrubber, so it only gets hashes of the copied bytes
+      self._record_verified(dst_path, src_md5sum)
+    return ok
+
+  def _wait_for_transfers(self):
+    for _ in range(self.max_files_in_flight):
+      self.in_flight.acquire()
+    for _ in range(self.max_files_in_flight):
+      self.in_flight.release()
+
+  def _hash_and_dispatch(self, src_path, dst_paths):
+    try:
+      src_md5sum = self._src_md5sum(src_path)
+      filesize = os.stat(src_path).st_size if src_md5sum is not None else 0
+    except Exception as e:
+      self.logger.error("Unable to stat '%s': %s", src_path, str(e))
+      src_md5sum = None
+    if src_md5sum is None:
+      self.stats.add(0, False)
+      self.in_flight.release()
+      return
+
+    transfer = FileTransfer(src_path, dst_paths, filesize, len(dst_paths))
+    for dst_path in dst_paths:
+      try:
+        pool = self.pools.get(os.path.dirname(dst_path))
+      except OSError as e:
+        self.logger.error("Unable to copy file '%s' to '%s': %s", src_path, dst_path, str(e))
+        self._complete(transfer, False)
         continue
+      pool.submit(self._copy_and_complete, transfer, src_md5sum, dst_path)
 
-      if src_md5sum != dst_md5sum:
-        all_ok = False
-        self.logger.error("MD5 sum of '%s' does NOT match that '%s'. Found %s instead of %s", dst_path, src_path, dst_md5sum, src_md5sum)
+  def _copy_and_complete(self, transfer, src_md5sum, dst_path):
+    try:
+      ok = self._copy_to_destination(transfer.src_path, src_md5sum, dst_path, transfer.filesize)
+    except:
+      self.logger.exception("Error copying '%s' to '%s'", transfer.src_path, dst_path)
+      ok = False
+    self._complete(transfer, ok)
+
+  def _complete(self, transfer, ok):
+    if not transfer.done(ok):
+      return
+    try:
+      self._finish_file(transfer.src_path, transfer.dst_paths, transfer.filesize, transfer.all_ok)
+    except:
+      self.logger.exception("Error finishing transfer of '%s'", transfer.src_path)
+    finally:
+      self.in_flight.release()
+
+  def _src_md5sum(self, src_path):
+    # Calculate or retreive MD5 sum
+    try:
+      return get_md5sum(src_path, try_from_basename=True)
+    except Exception as e:
+      self.logger.error("Error retrieving MD5 sum of '%s': %s", src_path, str(e))
+      return None
+
+  def _copy_to_destination(self, src_path, src_md5sum, dst_path, filesize):
+    if os.path.isfile(dst_path) and self._is_existing_copy(src_path, src_md5sum, dst_path, filesize):
+      return True
+
+    # Perform copy
+    self.logger.info("Copying file '%s' to '%s' [filesize: %d KB, md5sum: %s]", src_path, dst_path, filesize // 1024, src_md5sum)
+    try:
+      shutil.copy2(src_path, dst_path)
+      self.logger.debug("Copied file '%s' to '%s'", src_path, dst_path)
+    except Exception as e:
+      self.logger.error("Unable to copy file '%s' to '%s': %s", src_path, dst_path, str(e))
+      return False
+
+    # Calculate and compare MD5 sum
+    try:
+      dst_md5sum = get_md5sum(dst_path, try_from_basename=False)
+    except Exception as e:
+      self.logger.error("Error calculating MD5 sum of '%s': %s", dst_path, str(e))
+      return False
+
+    if src_md5sum != dst_md5sum:
+      self.logger.error("MD5 sum of '%s' does NOT match that '%s'. Found %s instead of %s", dst_path, src_path, dst_md5sum, src_md5sum)
+      return False
+    self._record_verified(dst_path, dst_md5sum)
+    return True
 
+  def _finish_file(self, src_path, dst_paths, filesize, all_ok):
     # Remove if all MD5 sums matched
     if all_ok:
       self.logger.info("Removing '%s'", src_path)
       os.remove(src_path)
+      if self.catalog is not None:
+        self.catalog.moved(src_path, [(self._dst_folder_of(p), p) for p in dst_paths])
     else:
       self.logger.warning("Not removing '%s' because not all destination MD5 sums matched", src_path)
+    self.stats.add(filesize, all_ok)
 
 
 def setup_logging():
-  root_log = logging.getLogger('')
-  root_log.setLevel(logging.DEBUG)
-  formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(name)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
-
-  stream_handler = logging.StreamHandler(sys.stdout)
-  stream_handler.setFormatter(formatter)
-  root_log.addHandler(stream_handler)
-
-  file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=(1024*1024*10), backupCount=7)
-  file_handler.setFormatter(formatter)
-  root_log.addHandler(file_handler)
-
+  logsetup.setup_logging(LOG_FILE, LOG_LEVEL)
+  logging.getLogger('FileMover').addFilter(logsetup.RateLimitFilter(LOG_RATE_LIMIT_BURST, LOG_RATE_LIMIT_INTERVAL))
 
 def main():
+  parser = argparse.ArgumentParser(description="Move captures from the source folders to the destination folders")
+  parser.add_argument('--scrub', action='store_true', help="instead of moving, re-hash copies verified more than SCRUB_MIN_AGE ago, for at most SCRUB_MAX_DURATION")
+  args = parser.parse_args()
   setup_logging()
-  fm = FileMover(SOURCE_FOLDERS, TARGET_FOLDERS, MOUNT_POINTS)
-  fm.run()
+  if args.scrub:
+    FileMover(SOURCE_FOLDERS, TARGET_FOLDERS, MOUNT_POINTS).scrub()
+    return
+  catalog = None
+  if CATALOG_FILE is not None:
+    catalog = CaptureCatalog(CATALOG_FILE)
+    catalog.start()
+  try:
+    fm = FileMover(SOURCE_FOLDERS, TARGET_FOLDERS, MOUNT_POINTS, concurrent=CONCURRENT, catalog=catalog)
+    fm.run()
+  finally:
+    if catalog is not None:
+      catalog.close()
 
 
 if __name__ == "__main__":
@@ -1,36 +1,104 @@
 #!/usr/bin/python3
 import socketserver
+import asyncio
 import time
 from datetime import datetime, timedelta
-import picamera
+try:
+  import picamera
+except ImportError:
+  picamera = None
 import logging
-from logging.handlers import RotatingFileHandler
+import logsetup
 import threading
 import os
 import queue
 import io
 import sys
+import collections
 import hashlib
 import functools
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 import astral
 from functools import partial
+from suncalendar import SunCalendar
+from syntheticcamera import SyntheticCamera
+from catalog import CaptureCatalog, DEFAULT_CATALOG_FILE
+import previews
+import metrics
+import motion
+
+CAMERA_TYPE = 'picamera' # 'picamera' or 'synthetic' to run without camera hardware
+SYNTHETIC_CAMERA_VIDEO_FILE = None # recorded H.264 stream to replay, generated when None
+SYNTHETIC_CAMERA_STILLS_FOLDER = None # folder of JPEG stills to serve, generated when None
+SYNTHETIC_CAMERA_MOTION_FILE = None # recorded motion vector dump to replay, still vectors when None
 
 BIND_ADDRESS = '192.168.0.12'
 BIND_PORT = 8000
+VIDEO_SERVER_MODE = 'threaded' # 'threaded' or 'asyncio'
 LOG_FILE = 'picamserver.log'
+LOG_LEVEL = logging.INFO
 
 TIMELAPSE_INTERVAL = timedelta(seconds=60)
 TIMELAPSE_FOLDERS = ['/mnt/usb/timelapse/']
 TIMELAPSE_FOLDERS_FALLBACK = ['/mnt/sdcard/timelapse/']
 TIMELAPSE_ASTRAL_LOCATION = astral.Location(('Eksel', 'Europe', 51.15, 5.3833, 'Europe/Brussels', 0))
 TIMELAPSE_ASTRAL_SOLAR_DEPRESSION = 8.5
+TIMELAPSE_CAPTURE_MODE = 'still' # 'still' reconfigures the camera for the still port, 'video_port' captures from a splitter port without interrupting the stream
+TIMELAPSE_SPLITTER_PORT = 0
+TIMELAPSE_SPOOL_ENABLED = True
+TIMELAPSE_SPOOL_MEMORY_SIZE = 32*1024*1024
+TIMELAPSE_SPOOL_OVERFLOW_FOLDER = '/run/picamserver/spool/' # should be on tmpfs
+TIMELAPSE_SPOOL_OVERFLOW_SIZE = 64*1024*1024
+TIMELAPSE_SPOOL_DROP_POLICY = 'drop_oldest' # 'drop_oldest', 'drop_newest' or 'block'
+TIMELAPSE_SPOOL_FALLBACK_LATENCY = timedelta(seconds=30)
+TIMELAPSE_SPOOL_FALLBACK_SIZE = 8*1024*1024
+TIMELAPSE_SPOOL_RETRY_INTERVAL = timedelta(seconds=10)
+TIMELAPSE_CATALOG_FILE = DEFAULT_CATALOG_FILE # None to not index captures
+TIMELAPSE_PREVIEW_FOLDER = '/mnt/usb/timelapse-previews/' # downscaled copies of every capture, None to disable (requires PIL)
+TIMELAPSE_PREVIEW_MAX_AGE = timedelta(days=3) # the previews are not moved off the USB stick, older ones are removed
+TIMELAPSE_ADAPTIVE_INTERVAL = False # capture faster on motion in the video stream and slower when nothing changes (requires numpy)
+TIMELAPSE_ACTIVE_INTERVAL = timedelta(seconds=15)
+TIMELAPSE_IDLE_INTERVAL = timedelta(minutes=5)
+TIMELAPSE_ACTIVITY_HOLD = timedelta(minutes=2) # keep the active interval this long after the last motion
+TIMELAPSE_IDLE_AFTER = timedelta(minutes=30) # switch to the idle interval after this long without motion
 TZ=pytz.timezone('Europe/Brussels')
  
 STILL_RESOLUTION = (1640,1232) #(3240,2464)
 VIDEO_RESOLUTION = (947,720)
 VIDEO_FRAMERATE = 7 
 VIDEO_BITRATE = 400000
+VIDEO_INTRA_PERIOD = VIDEO_FRAMERATE * 4
+STREAM_PROFILES = [
+  # Every profile is encoded once on its own splitter port (1-3, port 0 is left to the time lapse) and served on its own port
+  {'name': 'main', 'splitter_port': 1, 'resolution': VIDEO_RESOLUTION, 'bitrate': VIDEO_BITRATE, 'port': BIND_PORT},
+  # {'name': 'local', 'splitter_port': 2, 'resolution': (1640,1232), 'bitrate': 3000000, 'port': 8002},
+  # {'name': 'lte', 'splitter_port': 3, 'resolution': (480,360), 'bitrate': 100000, 'port': 8003},
+]
+ENCODER_MACROBLOCKS_PER_SECOND = 244800 # 1080p30, what the hardware H.264 encoder sustains across all splitter ports
+CLIENT_BUFFER_SIZE = 1024*1024
+GOP_CACHE_SIZE = 768*1024
+CLIENT_SOCKET_BUFFER_SIZE = 64*1024
+STATS_LOG_INTERVAL = timedelta(minutes=5)
+METRICS_ENABLED = True
+METRICS_BIND_ADDRESS = '127.0.0.1'
+METRICS_PORT = 9180
+CLIP_BUFFER_ENABLED = True
+CLIP_BUFFER_SIZE = 8*1024*1024 # bytes of video kept in memory, about 2.5 minutes at VIDEO_BITRATE
+CLIP_PROFILE = 'main' # stream profile to keep and write clips of
+CLIP_BIND_ADDRESS = '127.0.0.1'
+CLIP_PORT = 8001 # 'clip [SECONDS_BEFORE [SECONDS_AFTER]]' writes a clip, 'status' reports the buffer
+CLIP_FOLDER = '/mnt/usb/clips/'
+CLIP_DEFAULT_BEFORE = timedelta(seconds=30)
+CLIP_DEFAULT_AFTER = timedelta(seconds=30)
+CLIP_MAX_AFTER = timedelta(minutes=5)
+CLIP_FOLDER_MAX_BYTES = 1024*1024*1024 # oldest clips are removed beyond this, the clips are not moved off the USB stick
+CLIP_FOLLOWER_QUEUE_SIZE = 512 # NAL units a clip being written may fall behind by before it is cut short
+MOTION_PROFILE = 'main' # stream profile whose encoder provides the motion vectors
+MOTION_REGIONS = {'frame': (0.0, 0.0, 1.0, 1.0)} # (x0, y0, x1, y1) in fractions of the video frame
+MOTION_VECTOR_THRESHOLD = motion.MOTION_VECTOR_THRESHOLD
+MOTION_MAX_FPS = motion.MOTION_MAX_FPS
+MOTION_DUMP_FILE = None # also append the raw motion vectors to this file, for replaying with motion.py
 
 DAYTIME_EXPOSURE_MODE = 'verylong'
 DAYTIME_METER_MODE = 'backlit'
@@ -42,38 +110,311 @@ SUBDIR_TEMPLATE = '%(datestr)s' + os.sep + '%(night)s'
 DATETIMESTR_FORMAT = '%Y%m%d_%H%M%S' 
 FILE_NAME_TEMPLATE  = 'img_%(datetimestr)s_md5-%(md5sum)s%(suffix)s.jpg'
 
+NAL_TYPE_NON_IDR = 1
+NAL_TYPE_IDR = 5
+NAL_TYPE_SPS = 7
+
+CAPTURE_DURATION = metrics.REGISTRY.histogram('picamserver_capture_duration_seconds', 'Time taken to capture an image', (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32))
+CAPTURE_JITTER = metrics.REGISTRY.histogram('picamserver_capture_jitter_seconds', 'Difference between the scheduled and the actual start of a capture', (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10))
+WRITE_DURATION = metrics.REGISTRY.histogram('picamserver_write_duration_seconds', 'Time taken to write a captured image to a destination', (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30), ('root_folder',))
+WRITE_FAILURES = metrics.REGISTRY.counter('picamserver_write_failures_total', 'Failed writes of a captured image to a destination', ('root_folder',))
+SPOOL_PENDING_BYTES = metrics.REGISTRY.gauge('picamserver_spool_pending_bytes', 'Bytes of captures waiting to be written to a destination', ('root_folder',))
+SPOOL_DROPPED = metrics.REGISTRY.counter('picamserver_spool_dropped_total', 'Captures dropped because the spool of a destination was full', ('root_folder',))
+FALLBACK_ACTIVATIONS = metrics.REGISTRY.counter('picamserver_fallback_activations_total', 'Number of times the fallback destinations were activated')
+FALLBACK_ACTIVE = metrics.REGISTRY.gauge('picamserver_fallback_active', 'Whether captures are currently also written to the fallback destinations')
+CAPTURES_LOST = metrics.REGISTRY.counter('picamserver_captures_lost_total', 'Captures that could not be written to any destination or fallback destination')
+CLIENT_SENT_BYTES = metrics.REGISTRY.counter('picamserver_client_sent_bytes_total', 'Bytes of video sent to a stream client', ('profile', 'client'))
+CLIENT_DROPPED_BYTES = metrics.REGISTRY.counter('picamserver_client_dropped_bytes_total', 'Bytes of video skipped because a stream client was lagging', ('profile', 'client'))
+CLIENT_BACKLOG_BYTES = metrics.REGISTRY.gauge('picamserver_client_backlog_bytes', 'Bytes of video queued for a stream client', ('profile', 'client'))
+STREAM_CLIENTS = metrics.REGISTRY.gauge('picamserver_stream_clients', 'Number of connected stream clients', ('profile',))
+STREAM_ENCODED_BYTES = metrics.REGISTRY.counter('picamserver_stream_encoded_bytes_total', 'Bytes of video produced by the encoder of a stream profile', ('profile',))
+STREAM_ENCODED_FRAMES = metrics.REGISTRY.counter('picamserver_stream_encoded_frames_total', 'Frames produced by the encoder of a stream profile', ('profile',))
+STREAM_ENCODER_LOAD = metrics.REGISTRY.gauge('picamserver_stream_encoder_load_ratio', 'Share of the hardware encoder capacity a stream profile needs', ('profile',))
+ENCODER_ERRORS = metrics.REGISTRY.counter('picamserver_encoder_errors_total', 'Errors raised by the video encoder', ('profile',))
+CLIP_BUFFER_BYTES = metrics.REGISTRY.gauge('picamserver_clip_buffer_bytes', 'Bytes of video held in the pre-event buffer')
+CLIP_BUFFER_SECONDS = metrics.REGISTRY.gauge('picamserver_clip_buffer_seconds', 'Seconds of video held in the pre-event buffer')
+CLIPS_WRITTEN = metrics.REGISTRY.counter('picamserver_clips_written_total', 'Clips written from the pre-event buffer')
+CAPTURE_INTERVAL = metrics.REGISTRY.gauge('picamserver_capture_interval_seconds', 'Current interval between time lapse captures')
+
+def counter_increase(value, reported):
+  # Counters mirrored from a total kept elsewhere only advance, a total that went back restarted from 0
+  return value - reported if value >= reported else value
+
+def encoder_load(resolution, framerate):
+  # Share of the hardware encoder's macroblock rate
+  macroblocks = ((resolution[0] + 15) // 16) * ((resolution[1] + 15) // 16)
+  return macroblocks * framerate / float(ENCODER_MACROBLOCKS_PER_SECOND)
+
+def h264_nal_type(b):
+  if len(b) > 4 and b[:4] == b'\x00\x00\x00\x01':
+    return b[4] & 0x1f
+  if len(b) > 3 and b[:3] == b'\x00\x00\x01':
+    return b[3] & 0x1f
+  return None
+
+class ClientBuffer:
+  def __init__(self, max_bytes, notify=None):
+    self.max_bytes = max_bytes
+    self.notify = notify
+    self.chunks = collections.deque()
+    self.queued_bytes = 0
+    self.dropped_bytes = 0
+    self.sent_bytes = 0
+    self.waiting_for_keyframe = True
+    self.closed = False
+    self.cond = threading.Condition()
+
+  def write(self, b, keyframe=False):
+    with self.cond:
+      if self.closed:
+        return
+      if self.queued_bytes + len(b) > self.max_bytes:
+        # Client is lagging: throw away its backlog and resume at the next keyframe
+        self.dropped_bytes += self.queued_bytes
+        self.chunks.clear()
+        self.queued_bytes = 0
+        self.waiting_for_keyframe = True
+      if self.waiting_for_keyframe:
+        if not keyframe or len(b) > self.max_bytes:
+          self.dropped_bytes += len(b)
+          return
+        self.waiting_for_keyframe = False
+      self.chunks.append(b)
+      self.queued_bytes += len(b)
+      self.cond.notify()
+    if self.notify is not None:
+      self.notify()
+
+  def get(self, timeout=None):
+    with self.cond:
+      if not self.chunks and not self.closed:
+        self.cond.wait(timeout)
+      chunks = list(self.chunks)
+      self.chunks.clear()
+      self.queued_bytes = 0
+      return chunks
+
+  def flush(self):
+    pass
+
+  def close(self):
+    with self.cond:
+      self.closed = True
+      self.chunks.clear()
+      self.queued_bytes = 0
+      self.cond.notify_all()
+
+  def stats(self):
+    with self.cond:
+      return {'queued_bytes': self.queued_bytes, 'dropped_bytes': self.dropped_bytes, 'sent_bytes': self.sent_bytes}
+
 class StreamTee:
-  def __init__(self, streams):
+  def __init__(self, streams=(), gop_cache_size=None):
     self.__streams = set(streams)
+    self.__lock = threading.Lock()
+    self.__gop_cache_size = gop_cache_size if gop_cache_size is not None else GOP_CACHE_SIZE
+    self.__headers = None
+    self.__gop = []
+    self.__gop_bytes = 0
+    self.__gop_complete = False
+    self.__last_was_headers = False
+    self.written_bytes = 0
+    self.written_frames = 0
+
+  def add(self, s):
+    with self.__lock:
+      # Replay the cached headers and current GOP so the new stream can start decoding right away
+      if self.__gop_complete:
+        for (i, b) in enumerate(self.__gop):
+          s.write(b, i == 0)
+      self.__streams.add(s)
+
+  def remove(self, s):
+    with self.__lock:
+      self.__streams.discard(s)
 
   def write(self, b):
-    for s in set(self.__streams):
-      try:
-        s.write(b)
-      except Exception:
-        self.__streams.discard(s)
+    nal_type = h264_nal_type(b)
+    with self.__lock:
+      self.written_bytes += len(b)
+      # Counts slices, which are frames because the Pi's encoder writes one slice per frame
+      if nal_type in (NAL_TYPE_NON_IDR, NAL_TYPE_IDR):
+        self.written_frames += 1
+      keyframe = self.__cache(b, nal_type)
+      for s in set(self.__streams):
         try:
-          s.close()
+          s.write(b, keyframe)
         except Exception:
-          pass
+          self.__streams.discard(s)
+          try:
+            s.close()
+          except Exception:
+            pass
+
+  def __cache(self, b, nal_type):
+    if nal_type == NAL_TYPE_SPS:
+      self.__headers = b
+      self.__start_gop([])
+      keyframe = True
+    elif nal_type == NAL_TYPE_IDR and not self.__last_was_headers:
+      # Keyframe without inline headers: prefix the GOP with the last headers seen
+      self.__start_gop([] if self.__headers is None else [self.__headers])
+      keyframe = True
+    else:
+      keyframe = False
+    self.__last_was_headers = nal_type == NAL_TYPE_SPS
+
+    if self.__gop_complete:
+      if self.__gop_bytes + len(b) > self.__gop_cache_size:
+        self.__start_gop(None)
+      else:
+        self.__gop.append(b)
+        self.__gop_bytes += len(b)
+    return keyframe
+
+  def __start_gop(self, chunks):
+    self.__gop = list(chunks or [])
+    self.__gop_bytes = sum(len(x) for x in self.__gop)
+    self.__gop_complete = chunks is not None
 
   def flush(self):
-    for s in set(self.__streams):
-      try:
-        s.flush()
-      except Exception:
-        self.__streams.discard(s)
+    with self.__lock:
+      for s in set(self.__streams):
+        try:
+          s.flush()
+        except Exception:
+          self.__streams.discard(s)
+          try:
+            s.close()
+          except Exception:
+            pass
+
+  def close(self):
+    with self.__lock:
+      for s in set(self.__streams):
         try:
           s.close()
         except Exception:
-          pass
+          self.__streams.discard(s)
+
+# Keeps recent video in memory for clips, whole GOPs are evicted so it always starts at a keyframe
+class PreEventBuffer:
+  def __init__(self, max_bytes, follower_queue_size=CLIP_FOLLOWER_QUEUE_SIZE):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.max_bytes = max_bytes
+    self.follower_queue_size = follower_queue_size
+    self.chunks = collections.deque() # (monotonic time, keyframe, bytes)
+    self.buffered_bytes = 0
+    self.headers = None
+    self.followers = set()
+    self.closed = False
+    self.lock = threading.Lock()
+
+  def write(self, b, keyframe=False):
+    now = time.monotonic()
+    with self.lock:
+      if self.closed:
+        return
+      if h264_nal_type(b) == NAL_TYPE_SPS:
+        self.headers = b
+      for follower in list(self.followers):
+        try:
+          follower.put_nowait(b)
+        except queue.Full:
+          # The encoder must never wait for a clip, one that can't keep up ends here
+          self.followers.discard(follower)
+          self.logger.warning("Cutting clip short because writing it fell %d NAL units behind", follower.qsize())
+      if not self.chunks and not keyframe:
+        return
+      self.chunks.append((now, keyframe, b))
+      self.buffered_bytes += len(b)
+      while self.buffered_bytes > self.max_bytes and self.chunks:
+        self.__drop_gop()
+
+  def flush(self):
+    pass
 
   def close(self):
-    for s in set(self.__streams):
-      try:
-        s.close()
-      except Exception:
-        self.__streams.discard(s)
+    with self.lock:
+      self.closed = True
+      for follower in self.followers:
+        follower.put(None)
+
+  def buffered_seconds(self):
+    with self.lock:
+      if not self.chunks:
+        return 0
+      return time.monotonic() - self.chunks[0][0]
+
+  def collect_metrics(self):
+    CLIP_BUFFER_BYTES.set(self.buffered_bytes)
+    CLIP_BUFFER_SECONDS.set(self.buffered_seconds())
+
+  def write_clip(self, path, before, after):
+    (chunks, follower) = self.__follow(before)
+    tmp_path = path + '.tmp'
+    done = False
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      size = 0
+      with open(tmp_path, 'wb') as f:
+        for b in chunks:
+          f.write(b)
+          size += len(b)
+        deadline = time.monotonic() + after
+        while True:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            break
+          try:
+            b = follower.get(timeout=min(remaining, 1))
+          except queue.Empty:
+            with self.lock:
+              if follower not in self.followers:
+                break
+            continue
+          if b is None:
+            break
+          f.write(b)
+          size += len(b)
+      os.replace(tmp_path, path)
+      done = True
+    finally:
+      with self.lock:
+        self.followers.discard(follower)
+      if not done:
+        try:
+          os.remove(tmp_path)
+        except OSError:
+          pass
+    CLIPS_WRITTEN.inc()
+    return size
+
+  def __follow(self, before):
+    # Taking the snapshot and registering the follower under one lock leaves no gap between the two
+    follower = queue.Queue(maxsize=self.follower_queue_size)
+    with self.lock:
+      start_time = time.monotonic() - before
+      start = 0
+      for (i, (t, keyframe, _)) in enumerate(self.chunks):
+        if t > start_time:
+          break
+        if keyframe:
+          start = i
+      chunks = [b for (_, _, b) in list(self.chunks)[start:]]
+      if chunks and h264_nal_type(chunks[0]) != NAL_TYPE_SPS and self.headers is not None:
+        chunks.insert(0, self.headers)
+      if self.closed:
+        follower.put(None)
+      self.followers.add(follower)
+    return (chunks, follower)
+
+  def __drop_gop(self):
+    (_, _, b) = self.chunks.popleft()
+    self.buffered_bytes -= len(b)
+    while self.chunks and not self.chunks[0][1]:
+      (_, _, b) = self.chunks.popleft()
+      self.buffered_bytes -= len(b)
 
 class TcpVideoStreamHandler(socketserver.StreamRequestHandler):
   def __init__(self, request, client_address, server):
@@ -83,31 +424,127 @@ class TcpVideoStreamHandler(socketserver.StreamRequestHandler):
 
   def handle(self):
     self.logger.info("Accepted new connection from %s, port %d", self.client_address[0], self.client_address[1])
-    self.server.add_output(self.wfile)
-    while self.server.keep_running and not self.wfile.closed:
-      time.sleep(1)
+    self.buffer = ClientBuffer(CLIENT_BUFFER_SIZE)
+    self.server.add_output(self.buffer, self.client_address)
+    try:
+      while self.server.keep_running and not self.buffer.closed:
+        for chunk in self.buffer.get(timeout=1):
+          self.wfile.write(chunk)
+          self.buffer.sent_bytes += len(chunk)
+    except OSError as e:
+      self.logger.info("Error sending to %s:%d: %s", self.client_address[0], self.client_address[1], str(e))
     
   def finish(self):
-    self.server.remove_output(self.wfile)
-    self.logger.info("Client %s:%d disconnected", self.client_address[0], self.client_address[1])
+    self.server.remove_output(self.buffer)
+    self.buffer.close()
+    stats = self.buffer.stats()
+    self.logger.info("Client %s:%d disconnected [sent: %d KB, dropped: %d KB]", self.client_address[0], self.client_address[1], stats['sent_bytes'] // 1024, stats['dropped_bytes'] // 1024)
 
-class TcpVideoStreamServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-  def __init__(self, camera, server_address, resolution, framerate, bitrate):
-    self.logger = logging.getLogger(type(self).__name__)
+class VideoStreamOutputsMixin:
+  def _init_outputs(self, camera, resolution, framerate, bitrate, motion_output=None, splitter_port=1, profile='main'):
     self.camera = camera
     self.camera.framerate = framerate
     self.resolution = resolution
     self.bitrate = bitrate
-    self.outputs = set()
+    self.motion_output = motion_output
+    self.splitter_port = splitter_port
+    self.profile = profile
+    self.tee = StreamTee()
+    self.output_addresses = {}
+    self.reported_clients = {}
+    self.reported_encoded = (0, 0)
+    self.last_recording_error = None
+    self.last_stream_stats = None
+
+  def _log_settings(self, server_address):
+    self.logger.info("Tcp video stream server for profile '%s' listening on %s:%d", self.profile, server_address[0], server_address[1])
+    self.logger.info("    Resolution: %d x %d", self.resolution[0], self.resolution[1])
+    self.logger.info("    Frame rate: %dfps", self.camera.framerate)
+    self.logger.info("      Bit rate: %dbps", self.bitrate)
+    self.logger.info("      Splitter: port %d", self.splitter_port)
+    self.logger.info("  Encoder load: %d%% [profile: %s]", self.encoder_load() * 100, self.profile)
+
+  def encoder_load(self):
+    return encoder_load(self.resolution, self.camera.framerate)
+
+  def _start_recording(self):
+    options = {}
+    if self.motion_output is not None:
+      options['motion_output'] = self.motion_output
+    self.last_stream_stats = (time.monotonic(), self.tee.written_bytes, self.tee.written_frames)
+    self.camera.start_recording(self.tee, format='h264', resize=self.resolution, splitter_port=self.splitter_port, bitrate=self.bitrate, intra_period=VIDEO_INTRA_PERIOD, inline_headers=True, **options)
+
+  def _stop_recording(self):
+    self.camera.stop_recording(splitter_port=self.splitter_port)
+
+  def poll_recording_errors(self):
+    try:
+      self.camera.wait_recording(splitter_port=self.splitter_port)
+    except Exception as e:
+      # picamera keeps raising the same exception until recording is restarted, only report it once
+      if e is not self.last_recording_error:
+        self.last_recording_error = e
+        ENCODER_ERRORS.inc(profile=self.profile)
+        self.logger.error("Video encoder error on profile '%s': %s", self.profile, str(e))
+      return e
+    return None
+
+  def collect_metrics(self):
+    clients = dict(('%s:%d' % address, stats) for (address, stats) in self.client_stats() if address is not None)
+    # Disconnected clients disappear from the output, other profiles' clients are left alone
+    for client in set(self.reported_clients) - set(clients):
+      for metric in (CLIENT_SENT_BYTES, CLIENT_DROPPED_BYTES, CLIENT_BACKLOG_BYTES):
+        metric.remove(profile=self.profile, client=client)
+    reported_clients = {}
+    for (client, stats) in clients.items():
+      (sent_bytes, dropped_bytes) = self.reported_clients.get(client, (0, 0))
+      CLIENT_SENT_BYTES.inc(counter_increase(stats['sent_bytes'], sent_bytes), profile=self.profile, client=client)
+      CLIENT_DROPPED_BYTES.inc(counter_increase(stats['dropped_bytes'], dropped_bytes), profile=self.profile, client=client)
+      CLIENT_BACKLOG_BYTES.set(stats['queued_bytes'], profile=self.profile, client=client)
+      reported_clients[client] = (stats['sent_bytes'], stats['dropped_bytes'])
+    self.reported_clients = reported_clients
+    STREAM_CLIENTS.set(len(clients), profile=self.profile)
+    (written_bytes, written_frames) = (self.tee.written_bytes, self.tee.written_frames)
+    STREAM_ENCODED_BYTES.inc(counter_increase(written_bytes, self.reported_encoded[0]), profile=self.profile)
+    STREAM_ENCODED_FRAMES.inc(counter_increase(written_frames, self.reported_encoded[1]), profile=self.profile)
+    self.reported_encoded = (written_bytes, written_frames)
+    STREAM_ENCODER_LOAD.set(self.encoder_load(), profile=self.profile)
+
+  def log_stream_stats(self, printfunc):
+    now = time.monotonic()
+    (written_bytes, written_frames) = (self.tee.written_bytes, self.tee.written_frames)
+    if self.last_stream_stats is not None:
+      (last_time, last_bytes, last_frames) = self.last_stream_stats
+      elapsed = max(now - last_time, 0.001)
+      printfunc(" Profile '%s': %d kbps, %.1f fps, encoder load %d%%, %d client(s)", self.profile, (written_bytes - last_bytes) * 8 / elapsed / 1000, (written_frames - last_frames) / elapsed, self.encoder_load() * 100, len([a for a in self.output_addresses.values() if a is not None]))
+    self.last_stream_stats = (now, written_bytes, written_frames)
+
+  def add_output(self, output, address=None):
+    self.output_addresses[output] = address
+    self.tee.add(output)
+
+  def remove_output(self, output):
+    self.tee.remove(output)
+    self.output_addresses.pop(output, None)
+
+  def client_stats(self):
+    return [(address, output.stats()) for (output, address) in list(self.output_addresses.items())]
+
+  def log_client_stats(self, printfunc):
+    for (address, stats) in self.client_stats():
+      if address is None: continue
+      printfunc(" Client %s:%d: queued %d KB, dropped %d KB, sent %d KB", address[0], address[1], stats['queued_bytes'] // 1024, stats['dropped_bytes'] // 1024, stats['sent_bytes'] // 1024)
+
+class TcpVideoStreamServer(VideoStreamOutputsMixin, socketserver.ThreadingMixIn, socketserver.TCPServer):
+  def __init__(self, camera, server_address, resolution, framerate, bitrate, motion_output=None, splitter_port=1, profile='main'):
+    self.logger = logging.getLogger(type(self).__name__)
+    self._init_outputs(camera, resolution, framerate, bitrate, motion_output, splitter_port, profile)
     type(self).allow_reuse_address = True
     super(TcpVideoStreamServer, self).__init__(server_address, TcpVideoStreamHandler)
-    self.logger.info("Tcp video stream server listening on %s:%d", self.server_address[0], self.server_address[1])
-    self.logger.info(" Resolution: %d x %d", self.resolution[0], self.resolution[1])
-    self.logger.info(" Frame rate: %dfps", self.camera.framerate)
-    self.logger.info("   Bit rate: %dbps", self.bitrate)
+    self._log_settings(self.server_address)
 
   def start(self):
-    self.camera.start_recording(StreamTee(self.outputs), format='h264', resize=self.resolution, bitrate=self.bitrate)
+    self._start_recording()
     server_thread = threading.Thread(target=self.serve_forever)
     server_thread.daemon = True
     self.keep_running = True
@@ -115,53 +552,478 @@ class TcpVideoStreamServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
   def stop(self):
     self.keep_running = False
-    self.camera.stop_recording()
+    self._stop_recording()
     self.shutdown()
 
-  def poll_recording_errors(self):
-    self.camera.wait_recording()
+class AsyncTcpVideoStreamServer(VideoStreamOutputsMixin):
+  def __init__(self, camera, server_address, resolution, framerate, bitrate, motion_output=None, splitter_port=1, profile='main'):
+    self.logger = logging.getLogger(type(self).__name__)
+    self._init_outputs(camera, resolution, framerate, bitrate, motion_output, splitter_port, profile)
+    self.keep_running = False
+    self.client_tasks = set()
+    self.client_writers = set()
+    self.loop = asyncio.new_event_loop()
+    self.server = self.loop.run_until_complete(asyncio.start_server(self._handle_client, server_address[0], server_address[1], reuse_address=True))
+    self.server_address = self.server.sockets[0].getsockname()[:2]
+    self._log_settings(self.server_address)
 
-  def add_output(self, output):
-    self.outputs.add(output)
-    self._outputs_changed()
+  def start(self):
+    self._start_recording()
+    self.keep_running = True
+    server_thread = threading.Thread(target=self.loop.run_forever)
+    server_thread.daemon = True
+    server_thread.start()
 
-  def remove_output(self, output):
-    self.outputs.discard(output)
-    self._outputs_changed()
+  def stop(self):
+    self.keep_running = False
+    self._stop_recording()
+    if self.loop.is_running():
+      asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=10)
+      self.loop.call_soon_threadsafe(self.loop.stop)
+
+  async def _shutdown(self):
+    self.server.close()
+    for task in list(self.client_tasks):
+      task.cancel()
+    for writer in list(self.client_writers):
+      writer.close()
+    # Since Python 3.12 this also waits for every open connection, so the clients are closed first
+    await self.server.wait_closed()
 
-  def _outputs_changed(self):
+  async def _handle_client(self, reader, writer):
+    address = writer.get_extra_info('peername')[:2]
+    self.logger.info("Accepted new connection from %s, port %d", address[0], address[1])
+    writer.transport.set_write_buffer_limits(high=CLIENT_SOCKET_BUFFER_SIZE)
+    wakeup = asyncio.Event()
+    buffer = ClientBuffer(CLIENT_BUFFER_SIZE, notify=partial(self.loop.call_soon_threadsafe, wakeup.set))
+    self.add_output(buffer, address)
+    self.client_writers.add(writer)
+    sender = self.loop.create_task(self._send(buffer, wakeup, writer))
+    receiver = self.loop.create_task(self._wait_for_eof(reader))
+    self.client_tasks.update((sender, receiver))
     try:
-      self.camera.split_recording(StreamTee(self.outputs))
-    except picamera.exc.PiCameraNotRecording:
+      (done, pending) = await asyncio.wait((sender, receiver), return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        if not task.cancelled() and task.exception() is not None:
+          self.logger.info("Error sending to %s:%d: %s", address[0], address[1], str(task.exception()))
+    finally:
+      sender.cancel()
+      receiver.cancel()
+      self.client_tasks.difference_update((sender, receiver))
+      self.client_writers.discard(writer)
+      self.remove_output(buffer)
+      buffer.close()
+      writer.close()
+      stats = buffer.stats()
+      self.logger.info("Client %s:%d disconnected [sent: %d KB, dropped: %d KB]", address[0], address[1], stats['sent_bytes'] // 1024, stats['dropped_bytes'] // 1024)
+
+  async def _send(self, buffer, wakeup, writer):
+    while self.keep_running:
+      await wakeup.wait()
+      wakeup.clear()
+      for chunk in buffer.get(timeout=0):
+        writer.write(chunk)
+        buffer.sent_bytes += len(chunk)
+      # While the socket is backed up, new chunks pile up in the ClientBuffer, which skips ahead on overflow
+      await writer.drain()
+
+  async def _wait_for_eof(self, reader):
+    while await reader.read(4096):
       pass
 
 
+class ClipCommandHandler(socketserver.StreamRequestHandler):
+  def __init__(self, request, client_address, server):
+    self.logger = logging.getLogger(type(self).__name__)
+    super(ClipCommandHandler, self).__init__(request, client_address, server)
+
+  def handle(self):
+    for line in self.rfile:
+      args = line.decode('utf-8', 'replace').split()
+      if not args:
+        continue
+      try:
+        reply = self.server.command(args)
+      except (ValueError, OSError) as e:
+        self.logger.error("Error handling command '%s': %s", ' '.join(args), str(e))
+        reply = 'ERROR %s' % str(e)
+      self.wfile.write((reply + '\n').encode('utf-8'))
+
+# Local command port for clips, e.g. 'echo clip 60 10 | nc 127.0.0.1 8001'
+class ClipCommandServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, server_address, pre_event_buffer, clip_folder, default_before=CLIP_DEFAULT_BEFORE, default_after=CLIP_DEFAULT_AFTER, max_after=CLIP_MAX_AFTER, max_folder_bytes=CLIP_FOLDER_MAX_BYTES):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.pre_event_buffer = pre_event_buffer
+    self.clip_folder = clip_folder
+    self.max_folder_bytes = max_folder_bytes
+    self.prune_lock = threading.Lock()
+    self.default_before = default_before
+    self.default_after = default_after
+    self.max_after = max_after
+    super(ClipCommandServer, self).__init__(server_address, ClipCommandHandler)
+    self.logger.info("Clip command server listening on %s:%d", self.server_address[0], self.server_address[1])
+
+  def start(self):
+    server_thread = threading.Thread(target=self.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+  def command(self, args):
+    if args[0] == 'status':
+      return 'OK %d bytes %.1f seconds' % (self.pre_event_buffer.buffered_bytes, self.pre_event_buffer.buffered_seconds())
+    if args[0] != 'clip' or len(args) > 3:
+      raise ValueError("Unknown command, expected 'clip [SECONDS_BEFORE [SECONDS_AFTER]]' or 'status'")
+    before = float(args[1]) if len(args) > 1 else self.default_before.total_seconds()
+    after = min(float(args[2]) if len(args) > 2 else self.default_after.total_seconds(), self.max_after.total_seconds())
+    if before < 0 or after < 0:
+      raise ValueError("Clip durations can't be negative")
+    path = self.clip_path(TZ.localize(datetime.now()))
+    self.logger.info("Writing clip of %d seconds before and %d seconds after now to '%s'", before, after, path)
+    try:
+      size = self.pre_event_buffer.write_clip(path, before, after)
+    except:
+      os.remove(path)
+      raise
+    self.logger.info("Wrote clip of %d KB to '%s'", size // 1024, path)
+    self.prune_clips()
+    return 'OK %s' % path
+
+  def prune_clips(self):
+    if self.max_folder_bytes is None:
+      return
+    with self.prune_lock:
+      clips = []
+      for entry in os.scandir(self.clip_folder):
+        if entry.name.startswith('clip_') and entry.name.endswith('.h264') and entry.is_file():
+          st = entry.stat()
+          # Empty files are the reserved names of clips still being written
+          if st.st_size > 0:
+            clips.append((st.st_mtime, entry.path, st.st_size))
+      clips.sort()
+      total = sum(size for (_, _, size) in clips)
+      # The newest clip is kept even when it alone exceeds the limit
+      for (_, path, size) in clips[:-1]:
+        if total <= self.max_folder_bytes:
+          break
+        os.remove(path)
+        total -= size
+        self.logger.info("Removed clip '%s' to keep '%s' below %d MB", path, self.clip_folder, self.max_folder_bytes // (1024*1024))
+
+  def clip_path(self, time):
+    # The name is reserved by creating it, so clips requested within the same second never share a file
+    os.makedirs(self.clip_folder, exist_ok=True)
+    path = os.path.join(self.clip_folder, 'clip_%s.h264' % time.strftime(DATETIMESTR_FORMAT))
+    suffix_int = 0
+    while True:
+      try:
+        with open(path, 'xb'):
+          return path
+      except FileExistsError:
+        suffix_int += 1
+        path = os.path.join(self.clip_folder, 'clip_%s_%d.h264' % (time.strftime(DATETIMESTR_FORMAT), suffix_int))
+
+
 class Timer:
   def __init__(self):
     self.logger = logging.getLogger(type(self).__name__)
     self.q = queue.Queue()
 
   def sleep(self, seconds):
+    # True when interrupted
     try:
       self.q.get(timeout=seconds)
       self.logger.debug("Timer sleep of %d seconds was interrupted", seconds)
+      return True
     except queue.Empty:
-      pass
+      return False
 
   def interrupt(self):
     self.q.put(None)
 
 
+class HashingBytesIO(io.BytesIO):
+  def __init__(self):
+    super(HashingBytesIO, self).__init__()
+    self.__md5 = hashlib.md5()
+    self.__hashed_bytes = 0
+
+  def write(self, b):
+    if self.__md5 is not None:
+      if self.tell() == self.__hashed_bytes:
+        self.__md5.update(b)
+        self.__hashed_bytes += len(b)
+      else:
+        self.__md5 = None
+    return super(HashingBytesIO, self).write(b)
+
+  def md5sum(self):
+    if self.__md5 is None or self.__hashed_bytes != len(self.getbuffer()):
+      return hashlib.md5(self.getbuffer()).hexdigest()
+    return self.__md5.hexdigest()
+
+
+class Capture:
+  def __init__(self, time, data, md5sum):
+    self.time = time
+    self.data = data
+    self.md5sum = md5sum
+    self.size = len(data)
+
+
+class SpoolItem:
+  def __init__(self, capture):
+    self.capture = capture
+    self.time = capture.time
+    self.md5sum = capture.md5sum
+    self.size = capture.size
+    self.enqueued_at = time.monotonic()
+    self.overflow_path = None
+
+
+class SpoolDestination:
+  DROP_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+  def __init__(self, root_folder, write_func, memory_size, overflow_folder, overflow_size, drop_policy, retry_interval):
+    self.logger = logging.getLogger(type(self).__name__)
+    if drop_policy not in self.DROP_POLICIES:
+      raise ValueError("Unknown drop policy '%s'" % drop_policy)
+    self.root_folder = root_folder
+    self.write_func = write_func
+    self.memory_size = memory_size
+    self.overflow_folder = os.path.join(overflow_folder, root_folder.strip(os.sep).replace(os.sep, '_')) if overflow_folder else None
+    self.overflow_size = overflow_size
+    self.drop_policy = drop_policy
+    self.retry_interval = retry_interval
+    self.items = collections.deque()
+    self.in_flight = None
+    self.memory_bytes = 0
+    self.overflow_bytes = 0
+    self.dropped = 0
+    self.healthy = True
+    self.keep_running = False
+    self.cond = threading.Condition()
+
+  def start(self):
+    self.keep_running = True
+    writer_thread = threading.Thread(target=self.__run)
+    writer_thread.daemon = True
+    writer_thread.start()
+
+  def stop(self, timeout):
+    deadline = time.monotonic() + timeout
+    with self.cond:
+      while (self.items or self.in_flight) and self.healthy and time.monotonic() < deadline:
+        self.cond.wait(deadline - time.monotonic())
+      self.keep_running = False
+      self.cond.notify_all()
+      if self.items or self.in_flight:
+        self.logger.warning("Stopping spool for '%s' with %d capture(s) not written", self.root_folder, len(self.items) + (1 if self.in_flight else 0))
+
+  def pending_bytes(self):
+    return self.memory_bytes + self.overflow_bytes
+
+  def is_lagging(self, max_latency, max_bytes):
+    with self.cond:
+      oldest = self.in_flight or (self.items[0] if self.items else None)
+      if not self.healthy:
+        return True
+      if self.pending_bytes() > max_bytes:
+        return True
+      return oldest is not None and time.monotonic() - oldest.enqueued_at > max_latency.total_seconds()
+
+  def put(self, capture, timeout=None):
+    item = SpoolItem(capture)
+    with self.cond:
+      if self.drop_policy == 'block':
+        deadline = time.monotonic() + (timeout or 0)
+        while not self.__has_room(item.size) and self.keep_running and time.monotonic() < deadline:
+          self.cond.wait(deadline - time.monotonic())
+      while self.drop_policy == 'drop_oldest' and not self.__has_room(item.size) and self.items:
+        self.__discard(self.items.popleft())
+      if not self.__store(item):
+        self.__drop(item)
+        return False
+      self.items.append(item)
+      self.cond.notify_all()
+      return True
+
+  def __has_room(self, size):
+    if self.memory_bytes + size <= self.memory_size:
+      return True
+    return self.overflow_folder is not None and self.overflow_bytes + size <= self.overflow_size
+
+  def __store(self, item):
+    size = item.size
+    if self.memory_bytes + size <= self.memory_size:
+      self.memory_bytes += size
+      return True
+    if self.overflow_folder is None or self.overflow_bytes + size > self.overflow_size:
+      return False
+    try:
+      os.makedirs(self.overflow_folder, exist_ok=True)
+      overflow_path = os.path.join(self.overflow_folder, '%s_%s.jpg' % (item.time.strftime(DATETIMESTR_FORMAT), item.md5sum))
+      with open(overflow_path, 'wb') as f:
+        f.write(item.capture.data)
+    except Exception as e:
+      self.logger.error("Unable to spill capture to overflow folder '%s': %s", self.overflow_folder, str(e))
+      return False
+    item.overflow_path = overflow_path
+    item.capture = None
+    self.overflow_bytes += size
+    return True
+
+  def __release(self, item):
+    if item.overflow_path is None:
+      self.memory_bytes -= item.size
+      return
+    self.overflow_bytes -= item.size
+    try:
+      os.remove(item.overflow_path)
+    except OSError as e:
+      self.logger.warning("Unable to remove overflow file '%s': %s", item.overflow_path, str(e))
+
+  def __discard(self, item, reason='its spool is full'):
+    self.__release(item)
+    self.__drop(item, reason)
+
+  def __drop(self, item, reason='its spool is full'):
+    self.dropped += 1
+    SPOOL_DROPPED.inc(root_folder=self.root_folder)
+    self.logger.warning("Dropped capture of %s for '%s' because %s (%d dropped so far)", item.time.strftime('%d-%m-%Y %H:%M:%S'), self.root_folder, reason, self.dropped)
+
+  def __load(self, item):
+    if item.overflow_path is None:
+      return item.capture
+    with open(item.overflow_path, 'rb') as f:
+      return Capture(item.time, f.read(), item.md5sum)
+
+  def __run(self):
+    while True:
+      with self.cond:
+        while not self.items and self.keep_running:
+          self.cond.wait()
+        if not self.keep_running:
+          return
+        self.in_flight = self.items.popleft()
+      item = self.in_flight
+      # A capture that cannot be read back from the overflow folder never will be, so it is dropped instead of retried
+      try:
+        capture = self.__load(item)
+      except OSError as e:
+        self.logger.error("Unable to load spooled capture '%s': %s", item.overflow_path, str(e))
+        with self.cond:
+          self.in_flight = None
+          self.__discard(item, 'its overflow file cannot be read')
+          self.cond.notify_all()
+        continue
+      try:
+        self.write_func(self.root_folder, capture)
+        success = True
+      except Exception as e:
+        success = False
+        if self.healthy:
+          self.logger.exception("Error writing spooled capture to '%s', will retry every %d seconds", self.root_folder, self.retry_interval.total_seconds())
+        else:
+          self.logger.debug("Still unable to write spooled capture to '%s': %s", self.root_folder, str(e))
+      with self.cond:
+        self.in_flight = None
+        if success:
+          if not self.healthy:
+            self.logger.info("Destination '%s' recovered, draining %d spooled capture(s)", self.root_folder, len(self.items))
+          self.healthy = True
+          self.__release(item)
+        else:
+          # Keep the capture at the head of the queue so it is written once the destination recovers
+          self.healthy = False
+          self.items.appendleft(item)
+          self.cond.wait(self.retry_interval.total_seconds())
+        self.cond.notify_all()
+
+
+class CaptureSpool:
+  def __init__(self, memory_size, overflow_folder, overflow_size, drop_policy, fallback_latency, fallback_size, retry_interval):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.memory_size = memory_size
+    self.overflow_folder = overflow_folder
+    self.overflow_size = overflow_size
+    self.drop_policy = drop_policy
+    self.fallback_latency = fallback_latency
+    self.fallback_size = fallback_size
+    self.retry_interval = retry_interval
+    self.destinations = {}
+    self.fallback_destinations = {}
+    self.fallback_active = False
+
+  def add_destination(self, root_folder, write_func, fallback=False):
+    destination = SpoolDestination(root_folder, write_func, self.memory_size, self.overflow_folder, self.overflow_size, self.drop_policy, self.retry_interval)
+    (self.fallback_destinations if fallback else self.destinations)[root_folder] = destination
+
+  def start(self):
+    for destination in self.__all_destinations():
+      destination.start()
+
+  def stop(self, timeout=10):
+    for destination in self.__all_destinations():
+      destination.stop(timeout)
+
+  def submit(self, capture, timeout=None):
+    lagging = [d.root_folder for d in self.destinations.values() if d.is_lagging(self.fallback_latency, self.fallback_size)]
+    stored = [d.put(capture, timeout) for d in self.destinations.values()]
+    use_fallback = bool(lagging) or not all(stored) or not self.destinations
+    if use_fallback != self.fallback_active:
+      self.fallback_active = use_fallback
+      FALLBACK_ACTIVE.set(int(use_fallback))
+      if use_fallback:
+        FALLBACK_ACTIVATIONS.inc()
+        self.logger.warning("Activating fallback destinations because %s is lagging", ', '.join("'%s'" % f for f in lagging) or 'the spool')
+      else:
+        self.logger.info("Deactivating fallback destinations")
+    if use_fallback:
+      for destination in self.fallback_destinations.values():
+        destination.put(capture, timeout)
+
+  def log_stats(self, printfunc):
+    for destination in self.__all_destinations():
+      printfunc(" Spool '%s': %d queued, %d KB in memory, %d KB in overflow, %d dropped", destination.root_folder, len(destination.items), destination.memory_bytes // 1024, destination.overflow_bytes // 1024, destination.dropped)
+
+  def collect_metrics(self):
+    for destination in self.__all_destinations():
+      SPOOL_PENDING_BYTES.set(destination.pending_bytes(), root_folder=destination.root_folder)
+
+  def __all_destinations(self):
+    return list(self.destinations.values()) + list(self.fallback_destinations.values())
+
+
 class Timelapse:
-  def __init__(self, camera, resolution, interval, location):
+  CAPTURE_MODES = ('still', 'video_port')
+
+  def __init__(self, camera, resolution, interval, location, capture_mode='still', splitter_port=0, spool=None, catalog=None, preview_generator=None, schedule=None):
     self.logger = logging.getLogger(type(self).__name__)
+    if capture_mode not in self.CAPTURE_MODES:
+      raise ValueError("Unknown capture mode '%s'" % capture_mode)
     self.camera = camera
     self.camera.resolution = resolution
     self.interval = interval
     self.location = location
+    self.sun_calendar = SunCalendar(location)
+    self.capture_mode = capture_mode
+    self.splitter_port = splitter_port
     self.root_folders = set()
     self.fallback_folders = set()
+    self.spool = spool
+    self.catalog = catalog
+    self.preview_generator = preview_generator
+    self.schedule = schedule
+    self.fallback_active = False
     self.timer = Timer()
+    self.next_capture_time = None
 
   def add_root_folder(self, folder):
     self.root_folders.add(folder)
@@ -214,6 +1076,13 @@ class Timelapse:
     self.logger.info("Starting time lapse with capture settings:")
     self.print_camera_settings(self.logger.info)
 
+    if self.spool is not None:
+      for f in self.root_folders:
+        self.spool.add_destination(f, self._write_capture)
+      for f in self.fallback_folders:
+        self.spool.add_destination(f, self._write_capture, fallback=True)
+      self.spool.start()
+
     server_thread = threading.Thread(target=self.__run)
     server_thread.daemon = True
     self.keep_running = True
@@ -222,61 +1091,123 @@ class Timelapse:
   def stop(self):
     self.keep_running = False
     self.timer.interrupt()
+    if self.spool is not None:
+      self.spool.stop()
+
+  def current_interval(self):
+    if self.schedule is None:
+      return self.interval
+    return self.schedule.interval()
+
+  def reschedule(self):
+    # Captures right away when activity shortened the interval below the time left
+    next_capture_time = self.next_capture_time
+    if next_capture_time is not None and next_capture_time - self._now() > self.current_interval():
+      self.timer.interrupt()
 
   def _is_night(self, time):
-    return time < self.location.dawn(date=time, local=True) or self.location.dusk(date=time, local=True) < time
+    return self.sun_calendar.is_night(time)
   
+  def _write_capture(self, root_folder, capture):
+    start_time = time.monotonic()
+    try:
+      filename = self.generate_filename(root_folder, capture.time, capture.md5sum)
+      os.makedirs(os.path.dirname(filename), exist_ok=True)
+      with open(filename, 'wb') as f:
+        f.write(capture.data)
+    except:
+      WRITE_FAILURES.inc(root_folder=root_folder)
+      raise
+    WRITE_DURATION.observe(time.monotonic() - start_time, root_folder=root_folder)
+    if self.catalog is not None:
+      self.catalog.add(root_folder, filename, capture.time, capture.md5sum, len(capture.data), self._is_night(capture.time))
+    if self.preview_generator is not None:
+      self.preview_generator.submit(os.path.relpath(filename, root_folder), capture.data)
+    self.logger.info("Wrote image to '%s'", filename)
+    return filename
+
   def _write_to_file(self, input, root_folders, now=None):
     if now is None: now = self._now()
-    success = True
-    for root_folder in set(root_folders):
-      try:
-        md5sum = self.__calc_md5sum(input)
-        filename = self.generate_filename(root_folder, now, md5sum)
-        dirname = os.path.dirname(filename)
-        os.makedirs(dirname, exist_ok=True)
-        input.seek(0)
-        with open(filename, 'wb') as f:
-          f.write(input.getvalue())
-        self.logger.info("Wrote image to '%s'", filename)
-      except:
-        success = False
-        self.logger.exception("Error writing captured image to file '%s'", filename)
-    return success
+    capture = Capture(now, input.getbuffer(), self.__calc_md5sum(input))
+    root_folders = list(set(root_folders))
+    if len(root_folders) > 1:
+      with ThreadPoolExecutor(max_workers=len(root_folders)) as executor:
+        results = list(executor.map(partial(self.__try_write_capture, capture), root_folders))
+    else:
+      results = [self.__try_write_capture(capture, f) for f in root_folders]
+    return all(results)
+
+  def __try_write_capture(self, capture, root_folder):
+    try:
+      self._write_capture(root_folder, capture)
+      return True
+    except:
+      self.logger.exception("Error writing captured image to folder '%s'", root_folder)
+      return False
   
   def _now(self):
     return TZ.localize(datetime.now())
 
   def __calc_md5sum(self, f):
-    d = hashlib.md5()
-    f.seek(0)
-    for buf in iter(partial(f.read, 4096), b''):
-      d.update(buf)
-    return d.hexdigest()
+    if isinstance(f, HashingBytesIO):
+      return f.md5sum()
+    return hashlib.md5(f.getbuffer()).hexdigest()
+
+  def _capture(self, output):
+    if self.capture_mode == 'video_port':
+      self.camera.capture(output, 'jpeg', use_video_port=True, splitter_port=self.splitter_port)
+    else:
+      self.camera.capture(output, 'jpeg')
 
   def __run(self):
     self.__wait_until_next_capture()
     while self.keep_running:
       self.logger.debug("Starting capture")
-      mem_stream = io.BytesIO()
-      self.print_camera_settings(self.logger.debug)
+      mem_stream = HashingBytesIO()
+      # Reading the settings queries the camera, so skip it unless it will actually be logged
+      if self.logger.isEnabledFor(logging.DEBUG):
+        self.print_camera_settings(self.logger.debug)
       now = self._now()
-      self.camera.capture(mem_stream, 'jpeg')
-      self.logger.debug("Captured image successfully")
-
-      success = self._write_to_file(mem_stream, self.root_folders, now)
-      for fallback_folder in self.fallback_folders:
-        if success: break;
-        success = self._write_to_file(mem_stream, self.fallback_folders, now)
-        
+      if self.next_capture_time is not None:
+        CAPTURE_JITTER.observe(abs((now - self.next_capture_time).total_seconds()))
+      start_time = time.monotonic()
+      self._capture(mem_stream)
+      capture_duration = time.monotonic() - start_time
+      CAPTURE_DURATION.observe(capture_duration)
+      self.logger.info("Captured image in %.3f seconds [capture mode: %s]", capture_duration, self.capture_mode)
+
+      if self.spool is not None:
+        self.spool.submit(Capture(now, mem_stream.getbuffer(), mem_stream.md5sum()), timeout=self.current_interval().total_seconds() / 2)
+      else:
+        success = self._write_to_file(mem_stream, self.root_folders, now)
+        self.__set_fallback_active(not success and bool(self.fallback_folders))
+        for fallback_folder in self.fallback_folders:
+          if success: break;
+          success = self._write_to_file(mem_stream, self.fallback_folders, now)
+        if not success:
+          CAPTURES_LOST.inc()
+          self.logger.error("Captured image of %s could not be written to any folder", now.strftime('%d-%m-%Y %H:%M:%S'))
+
       self.__wait_until_next_capture()
 
+  def __set_fallback_active(self, active):
+    if active != self.fallback_active:
+      self.fallback_active = active
+      FALLBACK_ACTIVE.set(int(active))
+      if active:
+        FALLBACK_ACTIVATIONS.inc()
+
   def __wait_until_next_capture(self):
     now = self._now()
-    next_instant = self.__floorTime(now + self.interval, self.interval)
+    interval = self.current_interval()
+    CAPTURE_INTERVAL.set(interval.total_seconds())
+    next_instant = self.__floorTime(now + interval, interval)
+    self.next_capture_time = next_instant
     delay = max(0, (next_instant - now).total_seconds())
     self.logger.info("Sleeping for %d seconds before next image capture at %s", delay, next_instant.strftime('%d-%m-%Y %H:%M:%S'))
-    self.timer.sleep(delay)
+    if self.timer.sleep(delay):
+      # Captures right away, the jitter against the abandoned schedule would be meaningless
+      self.next_capture_time = None
 
   def __floorTime(self, dt=None, delta=timedelta(minutes=1)):
     roundTo = delta.total_seconds()
@@ -286,9 +1217,20 @@ class Timelapse:
     return dt + timedelta(0, rounding - seconds, -dt.microsecond)
 
 
+def create_camera(camera_type=CAMERA_TYPE):
+  if camera_type == 'synthetic':
+    return SyntheticCamera(SYNTHETIC_CAMERA_VIDEO_FILE, SYNTHETIC_CAMERA_STILLS_FOLDER, motion_file=SYNTHETIC_CAMERA_MOTION_FILE)
+  if camera_type != 'picamera':
+    raise ValueError("Unknown camera type '%s'" % camera_type)
+  if picamera is None:
+    raise RuntimeError("picamera is not installed, set CAMERA_TYPE to 'synthetic' to run without a camera")
+  return picamera.PiCamera()
+
+
 class PiCamServer:
-  def __init__(self):
+  def __init__(self, camera_factory=create_camera):
     self.logger = logging.getLogger(type(self).__name__)
+    self.camera_factory = camera_factory
 
   def __warm_up(self, camera, seconds):
     self.logger.info("Warming up camera for %d seconds", seconds)
@@ -296,8 +1238,26 @@ class PiCamServer:
     time.sleep(seconds)
     self.logger.info("Done warming up camera")
 
+  def __profile(self, name):
+    for profile in STREAM_PROFILES:
+      if profile['name'] == name:
+        return profile
+    raise ValueError("Unknown stream profile '%s'" % name)
+
+  def __check_profiles(self, profiles):
+    splitter_ports = [p['splitter_port'] for p in profiles]
+    if TIMELAPSE_CAPTURE_MODE == 'video_port':
+      splitter_ports.append(TIMELAPSE_SPLITTER_PORT)
+    if len(set(splitter_ports)) != len(splitter_ports) or not all(0 <= p <= 3 for p in splitter_ports):
+      raise ValueError("Stream profiles and the time lapse need distinct splitter ports between 0 and 3: %s" % splitter_ports)
+    if len(set(p['name'] for p in profiles)) != len(profiles) or len(set(p['port'] for p in profiles)) != len(profiles):
+      raise ValueError("Stream profiles need distinct names and ports")
+    total_load = sum(encoder_load(p['resolution'], VIDEO_FRAMERATE) for p in profiles)
+    if total_load > 1:
+      self.logger.warning("Stream profiles need %d%% of the hardware encoder capacity, frames will be dropped", total_load * 100)
+
   def run(self):
-    camera = picamera.PiCamera()
+    camera = self.camera_factory()
     camera.rotation = 180
     self.__warm_up(camera, 3)
 
@@ -307,50 +1267,116 @@ class PiCamServer:
     camera.awb_gains = DAYTIME_AWB_GAINS
     camera.awb_mode = DAYTIME_AWB_MODE
     
-    self.logger.info("Creating video stream server")
-    video_server = TcpVideoStreamServer(camera, (BIND_ADDRESS, BIND_PORT), VIDEO_RESOLUTION, VIDEO_FRAMERATE, VIDEO_BITRATE)
+    schedule = None
+    motion_output = None
+    if TIMELAPSE_ADAPTIVE_INTERVAL:
+      if motion.numpy is None:
+        self.logger.warning("Not adapting the time lapse interval to motion because numpy is not available")
+      else:
+        schedule = motion.ActivitySchedule(TIMELAPSE_INTERVAL, TIMELAPSE_ACTIVE_INTERVAL, TIMELAPSE_IDLE_INTERVAL, TIMELAPSE_ACTIVITY_HOLD, TIMELAPSE_IDLE_AFTER)
+        motion_output = motion.MotionAnalyzer(self.__profile(MOTION_PROFILE)['resolution'], MOTION_REGIONS, schedule, vector_threshold=MOTION_VECTOR_THRESHOLD, max_fps=MOTION_MAX_FPS)
+        if MOTION_DUMP_FILE is not None:
+          motion_output = motion.MotionDumpWriter(motion_output, MOTION_DUMP_FILE)
+
+    self.logger.info("Creating video stream servers")
+    self.__check_profiles(STREAM_PROFILES)
+    video_server_class = AsyncTcpVideoStreamServer if VIDEO_SERVER_MODE == 'asyncio' else TcpVideoStreamServer
+    video_servers = {}
+    for profile in STREAM_PROFILES:
+      video_servers[profile['name']] = video_server_class(camera, (BIND_ADDRESS, profile['port']), profile['resolution'], VIDEO_FRAMERATE, profile['bitrate'], motion_output if profile['name'] == MOTION_PROFILE else None, profile['splitter_port'], profile['name'])
+
+    pre_event_buffer = None
+    clip_server = None
+    if CLIP_BUFFER_ENABLED:
+      pre_event_buffer = PreEventBuffer(CLIP_BUFFER_SIZE)
+      video_servers[self.__profile(CLIP_PROFILE)['name']].tee.add(pre_event_buffer)
+      clip_server = ClipCommandServer((CLIP_BIND_ADDRESS, CLIP_PORT), pre_event_buffer, CLIP_FOLDER)
 
     self.logger.info("Creating Astral location")
     location = TIMELAPSE_ASTRAL_LOCATION
     location.solar_depression = TIMELAPSE_ASTRAL_SOLAR_DEPRESSION
 
     self.logger.info("Creating time lapse")
-    timelapse = Timelapse(camera, STILL_RESOLUTION, TIMELAPSE_INTERVAL, location)
+    spool = None
+    if TIMELAPSE_SPOOL_ENABLED:
+      spool = CaptureSpool(TIMELAPSE_SPOOL_MEMORY_SIZE, TIMELAPSE_SPOOL_OVERFLOW_FOLDER, TIMELAPSE_SPOOL_OVERFLOW_SIZE, TIMELAPSE_SPOOL_DROP_POLICY, TIMELAPSE_SPOOL_FALLBACK_LATENCY, TIMELAPSE_SPOOL_FALLBACK_SIZE, TIMELAPSE_SPOOL_RETRY_INTERVAL)
+    catalog = None
+    if TIMELAPSE_CATALOG_FILE is not None:
+      catalog = CaptureCatalog(TIMELAPSE_CATALOG_FILE)
+      catalog.start()
+    preview_generator = None
+    if TIMELAPSE_PREVIEW_FOLDER is not None:
+      if previews.Image is None:
+        self.logger.warning("Not making previews because PIL is not available")
+      else:
+        preview_generator = previews.PreviewGenerator(TIMELAPSE_PREVIEW_FOLDER, max_age=TIMELAPSE_PREVIEW_MAX_AGE)
+        preview_generator.start()
+    timelapse = Timelapse(camera, STILL_RESOLUTION, TIMELAPSE_INTERVAL, location, TIMELAPSE_CAPTURE_MODE, TIMELAPSE_SPLITTER_PORT, spool, catalog, preview_generator, schedule)
+    if schedule is not None:
+      schedule.on_activity = timelapse.reschedule
     for f in TIMELAPSE_FOLDERS:
       timelapse.add_root_folder(f)
     for f in TIMELAPSE_FOLDERS_FALLBACK:
       timelapse.add_fallback_root_folder(f)
 
-    self.logger.info("Starting video server")
-    video_server.start()
+    metrics_server = None
+    if METRICS_ENABLED:
+      for video_server in video_servers.values():
+        metrics.REGISTRY.add_collector(video_server.collect_metrics)
+      if spool is not None:
+        metrics.REGISTRY.add_collector(spool.collect_metrics)
+      if pre_event_buffer is not None:
+        metrics.REGISTRY.add_collector(pre_event_buffer.collect_metrics)
+      metrics_server = metrics.MetricsServer((METRICS_BIND_ADDRESS, METRICS_PORT))
+      metrics_server.start()
+
+    self.logger.info("Starting video servers")
+    for video_server in video_servers.values():
+      video_server.start()
+    if clip_server is not None:
+      clip_server.start()
     
     self.logger.info("Starting time lapse")
     timelapse.start()
 
     try:
+      last_stats_time = time.monotonic()
       while True:
         time.sleep(1)
+        for video_server in video_servers.values():
+          video_server.poll_recording_errors()
+        if time.monotonic() - last_stats_time >= STATS_LOG_INTERVAL.total_seconds():
+          last_stats_time = time.monotonic()
+          self.logger.info("Video streams:")
+          for video_server in video_servers.values():
+            video_server.log_stream_stats(self.logger.info)
+            video_server.log_client_stats(self.logger.info)
+          if spool is not None:
+            self.logger.info("Capture spool:")
+            spool.log_stats(self.logger.info)
     except KeyboardInterrupt:
       self.logger.info("Caught keyboard interrupt. Shutting down server...")
     finally:
       timelapse.stop()
-      video_server.stop()
-      video_server.shutdown()
+      if preview_generator is not None:
+        preview_generator.stop()
+      if catalog is not None:
+        catalog.close()
+      if clip_server is not None:
+        clip_server.stop()
+      for video_server in video_servers.values():
+        video_server.stop()
+      if pre_event_buffer is not None:
+        pre_event_buffer.close()
+      if isinstance(motion_output, motion.MotionDumpWriter):
+        motion_output.close()
+      if metrics_server is not None:
+        metrics_server.stop()
       camera.close() 
 
 def setup_logging():
-  root_log = logging.getLogger('')
-  root_log.setLevel(logging.INFO)
-  formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(name)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+  logsetup.setup_logging(LOG_FILE, LOG_LEVEL)
 
-  stream_handler = logging.StreamHandler(sys.stdout)
-  stream_handler.setFormatter(formatter)
-  root_log.addHandler(stream_handler)
-
-  file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=(1024*1024*10), backupCount=7)
-  file_handler.setFormatter(formatter)
-  root_log.addHandler(file_handler)
- 
 def main():
   setup_logging()
  
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+import io
+import os
+import time
+import queue
+import logging
+import argparse
+import shutil
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logsetup
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+PREVIEW_SIZES = (960, 320) # widths in pixels
+PREVIEW_QUALITY = 80
+PREVIEW_WORKERS = 1
+PREVIEW_QUEUE_SIZE = 4 # captures waiting for previews, newer ones are dropped beyond this
+PREVIEW_NICE = 10
+PREVIEW_MAX_AGE = timedelta(days=3) # previews of older day folders are removed, None to keep them all
+PREVIEW_PRUNE_INTERVAL = timedelta(hours=1)
+BACKFILL_WORKERS = 2
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+
+def make_previews(data, sizes, quality=PREVIEW_QUALITY):
+  # Draft mode lets libjpeg scale down while decoding, smaller previews are resized from the bigger ones
+  image = Image.open(io.BytesIO(data))
+  widths = sorted(sizes, reverse=True)
+  (width, height) = image.size
+  image.draft('RGB', (widths[0], max(1, height * widths[0] // width)))
+  image = image.convert('RGB')
+  previews = {}
+  for w in widths:
+    if w < image.size[0]:
+      image = image.resize((w, max(1, image.size[1] * w // image.size[0])), Image.BILINEAR)
+    output = io.BytesIO()
+    image.save(output, 'jpeg', quality=quality)
+    previews[w] = output.getvalue()
+  return previews
+
+def preview_path(preview_folder, size, rel_path):
+  return os.path.join(preview_folder, str(size), rel_path)
+
+def write_previews(preview_folder, rel_path, previews):
+  for (size, data) in previews.items():
+    path = preview_path(preview_folder, size, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(data)
+    os.replace(tmp_path, path)
+
+def prune_previews(preview_folder, sizes, max_age, now=None):
+  # Day folders are judged by their mtime, which a new preview refreshes, so the layout of the subfolders does not matter
+  if now is None: now = time.time()
+  removed = []
+  for size in sizes:
+    size_folder = os.path.join(preview_folder, str(size))
+    try:
+      entries = list(os.scandir(size_folder))
+    except FileNotFoundError:
+      continue
+    for entry in entries:
+      if entry.is_dir(follow_symlinks=False) and now - entry.stat(follow_symlinks=False).st_mtime > max_age.total_seconds():
+        shutil.rmtree(entry.path, ignore_errors=True)
+        removed.append(entry.path)
+  return removed
+
+def lower_thread_priority(nice):
+  # On Linux the nice value is per thread, so this leaves the capture and encoder threads alone
+  try:
+    os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+  except (AttributeError, OSError):
+    pass
+
+# Captures are skipped rather than queued when the workers fall behind, backfill fills the gaps later
+class PreviewGenerator:
+  def __init__(self, preview_folder, sizes=PREVIEW_SIZES, quality=PREVIEW_QUALITY, workers=PREVIEW_WORKERS, queue_size=PREVIEW_QUEUE_SIZE, nice=PREVIEW_NICE, max_age=PREVIEW_MAX_AGE, prune_interval=PREVIEW_PRUNE_INTERVAL):
+    self.logger = logging.getLogger(type(self).__name__)
+    if Image is None:
+      raise RuntimeError("PIL is required to make previews")
+    self.preview_folder = preview_folder
+    self.sizes = sizes
+    self.quality = quality
+    self.workers = workers
+    self.nice = nice
+    self.max_age = max_age
+    self.prune_interval = prune_interval
+    self.next_prune = time.monotonic()
+    self.captures = queue.Queue(maxsize=queue_size)
+    self.recent = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.skipped = 0
+    self.generated = 0
+    self.threads = []
+
+  def start(self):
+    for _ in range(self.workers):
+      worker_thread = threading.Thread(target=self.__run)
+      worker_thread.daemon = True
+      worker_thread.start()
+      self.threads.append(worker_thread)
+
+  def stop(self):
+    for _ in self.threads:
+      self.captures.put(None)
+    for worker_thread in self.threads:
+      worker_thread.join()
+    self.threads = []
+
+  def submit(self, rel_path, data):
+    with self.lock:
+      # Every destination reports the same capture, only the first one counts
+      if rel_path in self.recent:
+        return False
+      self.recent[rel_path] = True
+      while len(self.recent) > 64:
+        self.recent.popitem(last=False)
+    try:
+      self.captures.put_nowait((rel_path, data))
+      return True
+    except queue.Full:
+      self.skipped += 1
+      self.logger.debug("Skipping previews of '%s' because %d captures are waiting", rel_path, self.captures.qsize())
+      return False
+
+  def __run(self):
+    lower_thread_priority(self.nice)
+    while True:
+      item = self.captures.get()
+      if item is None:
+        return
+      (rel_path, data) = item
+      start_time = time.monotonic()
+      try:
+        write_previews(self.preview_folder, rel_path, make_previews(data, self.sizes, self.quality))
+        self.generated += 1
+        self.logger.debug("Made previews of '%s' in %.3f seconds", rel_path, time.monotonic() - start_time)
+      except Exception:
+        self.logger.exception("Error making previews of '%s'", rel_path)
+      self.__prune()
+
+  def __prune(self):
+    if self.max_age is None:
+      return
+    with self.lock:
+      if time.monotonic() < self.next_prune:
+        return
+      self.next_prune = time.monotonic() + self.prune_interval.total_seconds()
+    try:
+      for path in prune_previews(self.preview_folder, self.sizes, self.max_age):
+        self.logger.info("Removed previews in '%s' because they are older than %s", path, str(self.max_age))
+    except Exception:
+      self.logger.exception("Error removing old previews from '%s'", self.preview_folder)
+
+def missing_previews(root_folder, preview_folder, sizes):
+  for (dirpath, dirnames, filenames) in os.walk(root_folder):
+    dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+    for filename in sorted(filenames):
+      if not filename.lower().endswith(IMAGE_EXTENSIONS):
+        continue
+      rel_path = os.path.relpath(os.path.join(dirpath, filename), root_folder)
+      if not all(os.path.exists(preview_path(preview_folder, size, rel_path)) for size in sizes):
+        yield rel_path
+
+def backfill(root_folder, preview_folder, sizes=PREVIEW_SIZES, quality=PREVIEW_QUALITY, workers=BACKFILL_WORKERS):
+  logger = logging.getLogger('backfill')
+
+  def make(rel_path):
+    lower_thread_priority(PREVIEW_NICE)
+    try:
+      with open(os.path.join(root_folder, rel_path), 'rb') as f:
+        write_previews(preview_folder, rel_path, make_previews(f.read(), sizes, quality))
+      return True
+    except Exception as e:
+      logger.error("Error making previews of '%s': %s", rel_path, str(e))
+      return False
+
+  start_time = time.monotonic()
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    results = list(executor.map(make, missing_previews(root_folder, preview_folder, sizes)))
+  logger.info("Made previews of %d captures in '%s' (%d failed) in %.1f seconds", sum(results), root_folder, len(results) - sum(results), time.monotonic() - start_time)
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description="Make the missing previews of an existing archive")
+  parser.add_argument('root_folder', help="folder with the captures, laid out by SUBDIR_TEMPLATE")
+  parser.add_argument('preview_folder', help="folder to write the previews to, one subfolder per size")
+  parser.add_argument('--sizes', type=int, nargs='+', default=list(PREVIEW_SIZES), help="preview widths in pixels (default: %(default)s)")
+  parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+  args = parser.parse_args()
+  logsetup.setup_logging(None, logging.INFO)
+  if Image is None:
+    parser.error("PIL is required to make previews")
+  backfill(args.root_folder, args.preview_folder, args.sizes, workers=args.workers)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,125 @@
+import os
+import json
+import math
+import logging
+import threading
+import collections
+from datetime import date, timedelta
+import astral
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+DEFAULT_CACHE_SIZE = 4096
+
+def location_solar_depression(location):
+  # astral 1.x raises until solar_depression was assigned, events are then computed with Astral's default
+  try:
+    return location.solar_depression
+  except AttributeError:
+    return astral.Astral().solar_depression
+
+class SunCalendar:
+  def __init__(self, location, solar_depression=None, cache_file=None, cache_size=DEFAULT_CACHE_SIZE):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.location = location
+    self.solar_depression = location_solar_depression(location) if solar_depression is None else solar_depression
+    self.cache_file = cache_file
+    self.cache_size = cache_size
+    self.days = collections.OrderedDict()
+    self.dirty = False
+    self.lock = threading.Lock()
+    if self.cache_file is not None:
+      self.load()
+
+  def key(self):
+    return '%s:%.4f:%.4f:%.2f' % (self.location.name, self.location.latitude, self.location.longitude, self.solar_depression)
+
+  def events(self, day):
+    with self.lock:
+      events = self.days.get(day)
+      if events is not None:
+        self.days.move_to_end(day)
+        return events
+      events = self.__compute(day)
+      self.days[day] = events
+      self.dirty = True
+      while len(self.days) > self.cache_size:
+        self.days.popitem(last=False)
+      return events
+
+  def precompute(self, first_day, last_day):
+    day = first_day
+    while day <= last_day:
+      self.events(day)
+      day += timedelta(days=1)
+
+  def is_night(self, time):
+    (dawn, dusk) = self.events(time.date())
+    timestamp = time.timestamp()
+    return timestamp < dawn or dusk < timestamp
+
+  def is_night_many(self, times):
+    times = list(times)
+    if not times:
+      return []
+    events = {day: self.events(day) for day in set(t.date() for t in times)}
+    if numpy is None:
+      return [self.__is_night_ts(t.timestamp(), events[t.date()]) for t in times]
+    timestamps = numpy.fromiter((t.timestamp() for t in times), dtype=numpy.float64, count=len(times))
+    day_events = numpy.array([events[t.date()] for t in times], dtype=numpy.float64)
+    return ((timestamps < day_events[:, 0]) | (day_events[:, 1] < timestamps)).tolist()
+
+  def load(self):
+    try:
+      with open(self.cache_file, 'r') as f:
+        entries = json.load(f).get(self.key(), {})
+    except FileNotFoundError:
+      return
+    except Exception as e:
+      self.logger.warning("Ignoring unreadable sun calendar cache '%s': %s", self.cache_file, str(e))
+      return
+    with self.lock:
+      for (day_str, (dawn, dusk)) in entries.items():
+        day = date(*map(int, day_str.split('-')))
+        self.days[day] = (-math.inf if dawn is None else dawn, math.inf if dusk is None else dusk)
+    self.logger.debug("Loaded %d sun calendar entries from '%s'", len(entries), self.cache_file)
+
+  def save(self):
+    if self.cache_file is None or not self.dirty:
+      return
+    try:
+      with open(self.cache_file, 'r') as f:
+        content = json.load(f)
+    except Exception:
+      content = {}
+    with self.lock:
+      content[self.key()] = {day.isoformat(): [None if math.isinf(dawn) else dawn, None if math.isinf(dusk) else dusk] for (day, (dawn, dusk)) in self.days.items()}
+      self.dirty = False
+    os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+    tmp_file = self.cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+      json.dump(content, f)
+    os.replace(tmp_file, self.cache_file)
+    self.logger.debug("Saved sun calendar cache to '%s'", self.cache_file)
+
+  def __is_night_ts(self, timestamp, events):
+    return timestamp < events[0] or events[1] < timestamp
+
+  def __compute(self, day):
+    saved_depression = location_solar_depression(self.location)
+    self.location.solar_depression = self.solar_depression
+    try:
+      dawn = self.__event_timestamp(self.location.dawn, day, -math.inf)
+      dusk = self.__event_timestamp(self.location.dusk, day, math.inf)
+    finally:
+      self.location.solar_depression = saved_depression
+    return (dawn, dusk)
+
+  def __event_timestamp(self, event_func, day, default):
+    try:
+      return event_func(date=day, local=True).timestamp()
+    except astral.AstralError:
+      # The sun does not reach the solar depression on this day, so it never gets dark enough
+      return default
@@ -0,0 +1,223 @@
+import io
+import os
+import time
+import random
+import logging
+import threading
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+NAL_TYPE_NON_IDR = 1
+NAL_TYPE_IDR = 5
+NAL_TYPE_SEI = 6
+NAL_TYPE_SPS = 7
+NAL_TYPE_PPS = 8
+NAL_TYPE_AUD = 9
+VCL_NAL_TYPES = (NAL_TYPE_NON_IDR, NAL_TYPE_IDR)
+
+START_CODE = b'\x00\x00\x00\x01'
+
+def split_nal_units(data):
+  starts = []
+  i = data.find(b'\x00\x00\x01')
+  while i >= 0:
+    starts.append(i - 1 if i > 0 and data[i-1] == 0 else i)
+    i = data.find(b'\x00\x00\x01', i + 3)
+  return [data[start:end] for (start, end) in zip(starts, starts[1:] + [len(data)])]
+
+def nal_type(unit):
+  offset = 4 if unit[:4] == START_CODE else 3
+  return unit[offset] & 0x1f if len(unit) > offset else None
+
+def group_frames(units):
+  # Headers in one write and every picture in its own, like picamera hands them to an output
+  frames = []
+  pending = []
+  for unit in units:
+    t = nal_type(unit)
+    if t in VCL_NAL_TYPES:
+      if pending:
+        frames.append(b''.join(pending))
+        pending = []
+      frames.append(unit)
+    elif t in (NAL_TYPE_SPS, NAL_TYPE_PPS, NAL_TYPE_SEI):
+      pending.append(unit)
+  return frames
+
+def generate_h264_frames(count, framerate, bitrate, intra_period):
+  # Shaped like the encoder output without real picture data
+  frame_size = max(16, bitrate // 8 // max(1, framerate))
+  frames = []
+  for i in range(count):
+    if i % intra_period == 0:
+      frames.append(START_CODE + bytes([0x67]) + os.urandom(12) + START_CODE + bytes([0x68]) + os.urandom(4))
+      frames.append(START_CODE + bytes([0x65]) + os.urandom(frame_size * 4))
+    else:
+      frames.append(START_CODE + bytes([0x41]) + os.urandom(frame_size))
+  return frames
+
+def generate_jpeg(resolution, seed):
+  rng = random.Random(seed)
+  if Image is None:
+    # Not decodable, but the right size and framing for anything that only stores or hashes stills
+    return b'\xff\xd8' + os.urandom(resolution[0] * resolution[1] // 8) + b'\xff\xd9'
+  image = Image.new('RGB', resolution, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+  image.putdata([(rng.randrange(256),) * 3 for _ in range(resolution[0] * 16)])
+  output = io.BytesIO()
+  image.save(output, 'jpeg', quality=85)
+  return output.getvalue()
+
+# Stands in for picamera.PiCamera off a Pi, replaying recorded (or generated) video, stills and motion vectors
+class SyntheticCamera:
+  def __init__(self, video_file=None, stills_folder=None, capture_delay=0.0, speed=1.0, motion_file=None):
+    self.logger = logging.getLogger(type(self).__name__)
+    self.video_file = video_file
+    self.motion_file = motion_file
+    self.stills_folder = stills_folder
+    self.capture_delay = capture_delay
+    self.speed = speed
+    self.resolution = (1640, 1232)
+    self.framerate = 30
+    self.rotation = 0
+    self.meter_mode = 'average'
+    self.exposure_mode = 'auto'
+    self.awb_mode = 'auto'
+    self.awb_gains = (1.0, 1.0)
+    self.analog_gain = 1.0
+    self.digital_gain = 1.0
+    self.iso = 0
+    self.shutter_speed = 0
+    self.exposure_speed = 10000
+    self.closed = False
+    self.recordings = {}
+    self.stills = None
+    self.still_index = 0
+    self.lock = threading.Lock()
+
+  def start_preview(self):
+    pass
+
+  def stop_preview(self):
+    pass
+
+  def start_recording(self, output, format='h264', resize=None, splitter_port=1, bitrate=17000000, intra_period=None, inline_headers=True, motion_output=None, **options):
+    if format != 'h264':
+      raise ValueError("SyntheticCamera only records h264, not '%s'" % format)
+    with self.lock:
+      if splitter_port in self.recordings:
+        raise RuntimeError("The camera is already recording on port %d" % splitter_port)
+      recording = {'stop': threading.Event(), 'exception': None, 'frames': self.__load_video(bitrate, intra_period or self.framerate)}
+      if motion_output is not None:
+        recording['motion_frames'] = self.__load_motion(resize or self.resolution)
+      recording['thread'] = threading.Thread(target=self.__record, args=(output, recording, motion_output))
+      recording['thread'].daemon = True
+      self.recordings[splitter_port] = recording
+    recording['thread'].start()
+
+  def wait_recording(self, timeout=0, splitter_port=1):
+    recording = self.recordings.get(splitter_port)
+    if recording is None:
+      raise RuntimeError("The camera is not recording on port %d" % splitter_port)
+    recording['stop'].wait(timeout)
+    if recording['exception'] is not None:
+      raise recording['exception']
+
+  def stop_recording(self, splitter_port=1):
+    with self.lock:
+      recording = self.recordings.pop(splitter_port, None)
+    if recording is None:
+      return
+    recording['stop'].set()
+    recording['thread'].join()
+    if recording['exception'] is not None:
+      raise recording['exception']
+
+  def capture(self, output, format='jpeg', use_video_port=False, splitter_port=0, **options):
+    if format != 'jpeg':
+      raise ValueError("SyntheticCamera only captures jpeg, not '%s'" % format)
+    if self.capture_delay:
+      time.sleep(self.capture_delay / self.speed)
+    with self.lock:
+      if self.stills is None:
+        self.stills = self.__load_stills()
+      data = self.stills[self.still_index % len(self.stills)]
+      self.still_index += 1
+    if hasattr(output, 'write'):
+      output.write(data)
+    else:
+      with open(output, 'wb') as f:
+        f.write(data)
+
+  def close(self):
+    for splitter_port in list(self.recordings):
+      self.stop_recording(splitter_port)
+    self.closed = True
+
+  def __load_video(self, bitrate, intra_period):
+    if self.video_file is None:
+      return generate_h264_frames(intra_period * 4, self.framerate, bitrate, intra_period)
+    with open(self.video_file, 'rb') as f:
+      frames = group_frames(split_nal_units(f.read()))
+    if not frames:
+      raise ValueError("No H.264 pictures found in '%s'" % self.video_file)
+    self.logger.debug("Replaying %d frames from '%s'", len(frames), self.video_file)
+    return frames
+
+  def __load_motion(self, resolution):
+    (width, height) = resolution
+    # One (x, y, sad) record of 4 bytes per macroblock, plus an extra column per row, like the encoder
+    frame_bytes = ((height + 15) // 16) * ((width + 15) // 16 + 1) * 4
+    if self.motion_file is None:
+      return [bytes(frame_bytes)]
+    with open(self.motion_file, 'rb') as f:
+      data = f.read()
+    frames = [data[i:i + frame_bytes] for i in range(0, len(data) - frame_bytes + 1, frame_bytes)]
+    if not frames:
+      raise ValueError("No motion vectors for %dx%d found in '%s'" % (width, height, self.motion_file))
+    return frames
+
+  def __load_stills(self):
+    if self.stills_folder is None:
+      return [generate_jpeg(self.resolution, seed) for seed in range(4)]
+    stills = []
+    for name in sorted(os.listdir(self.stills_folder)):
+      if name.lower().endswith(('.jpg', '.jpeg')):
+        with open(os.path.join(self.stills_folder, name), 'rb') as f:
+          stills.append(f.read())
+    if not stills:
+      raise ValueError("No JPEG stills found in '%s'" % self.stills_folder)
+    return stills
+
+  def __record(self, output, recording, motion_output=None):
+    frames = recording['frames']
+    motion_frames = recording.get('motion_frames')
+    motion_index = 0
+    frame_interval = 1.0 / (self.framerate * self.speed)
+    next_frame = time.monotonic()
+    i = 0
+    try:
+      while not recording['stop'].is_set():
+        frame = frames[i % len(frames)]
+        output.write(frame)
+        i += 1
+        if nal_type(frame) in VCL_NAL_TYPES:
+          if motion_output is not None:
+            motion_output.write(motion_frames[motion_index % len(motion_frames)])
+            motion_index += 1
+          next_frame += frame_interval
+          delay = next_frame - time.monotonic()
+          if delay > 0:
+            recording['stop'].wait(delay)
+          elif delay < -1:
+            # Fell more than a second behind (e.g. a blocking output): don't try to catch up in a burst
+            next_frame = time.monotonic()
+    except Exception as e:
+      recording['exception'] = e
+    finally:
+      if hasattr(output, 'flush'):
+        try:
+          output.flush()
+        except Exception:
+          pass
@@ -0,0 +1,44 @@
+from datetime import timedelta
+import motion
+
+class Clock:
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+def make_schedule(monkeypatch):
+  clock = Clock()
+  monkeypatch.setattr(motion.time, 'monotonic', clock)
+  schedule = motion.ActivitySchedule(timedelta(minutes=5), timedelta(seconds=30), timedelta(minutes=30), timedelta(minutes=2), timedelta(hours=1))
+  return (schedule, clock)
+
+def test_activity_schedule_intervals(monkeypatch):
+  (schedule, clock) = make_schedule(monkeypatch)
+  assert schedule.interval() == timedelta(minutes=5)
+  schedule.activity(True)
+  assert schedule.interval() == timedelta(seconds=30)
+  clock.now += 119
+  assert schedule.is_active()
+  clock.now += 2
+  assert schedule.interval() == timedelta(minutes=5)
+  clock.now += 3600
+  assert schedule.interval() == timedelta(minutes=30)
+
+def test_activity_schedule_idle_from_start(monkeypatch):
+  (schedule, clock) = make_schedule(monkeypatch)
+  schedule.activity(False)
+  clock.now += 3601
+  assert schedule.interval() == timedelta(minutes=30)
+
+def test_activity_schedule_notifies_only_when_activity_starts(monkeypatch):
+  (schedule, clock) = make_schedule(monkeypatch)
+  calls = []
+  schedule.on_activity = lambda: calls.append(clock.now)
+  schedule.activity(True)
+  clock.now += 10
+  schedule.activity(True)
+  clock.now += 200
+  schedule.activity(True)
+  assert calls == [1000.0, 1210.0]
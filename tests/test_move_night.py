@@ -0,0 +1,51 @@
+import os
+import pytest
+
+pytest.importorskip('pytz')
+pytest.importorskip('astral')
+import move_night
+
+DAY = '20240621'
+NOON = 'img_20240621_120000.jpg'
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+  monkeypatch.setattr(move_night.CALENDAR, 'cache_file', None)
+  day_path = tmp_path / DAY
+  day_path.mkdir()
+  (day_path / NOON).write_bytes(b'x')
+  return tmp_path
+
+def run(archive):
+  journal_file = str(archive / 'journal.json')
+  move_night.run(incremental=True, src_path=str(archive), journal_file=journal_file)
+  return move_night.load_journal(journal_file)
+
+def test_dir_files_includes_night(archive):
+  (archive / DAY / 'night').mkdir()
+  (archive / DAY / 'night' / 'img_20240621_230000.jpg').write_bytes(b'x')
+  assert move_night.dir_files(str(archive / DAY)) == {NOON, 'img_20240621_230000.jpg'}
+
+def test_journal_records_handled_day(archive):
+  journal = run(archive)
+  assert journal[DAY] == move_night.dir_state(str(archive / DAY))
+
+def test_journal_skips_unchanged_day(archive, monkeypatch):
+  run(archive)
+  handled = []
+  monkeypatch.setattr(move_night, 'plan_moves', lambda day, path, base_dir: handled.append(path) or [])
+  run(archive)
+  assert handled == []
+
+def test_journal_ignores_day_changed_while_handled(archive, monkeypatch):
+  apply_moves = move_night.apply_moves
+  def apply_moves_racing(moves, catalog=None):
+    (archive / DAY / 'img_20240621_120100.jpg').write_bytes(b'x')
+    apply_moves(moves, catalog)
+  monkeypatch.setattr(move_night, 'apply_moves', apply_moves_racing)
+  assert DAY not in run(archive)
+
+def test_unreadable_journal_is_ignored(tmp_path):
+  journal_file = tmp_path / 'journal.json'
+  journal_file.write_text('{')
+  assert move_night.load_journal(str(journal_file)) == {}
@@ -0,0 +1,67 @@
+import hashlib
+import pytest
+import moveimages
+
+DATA = b'captured image'
+MD5 = hashlib.md5(DATA).hexdigest()
+
+@pytest.fixture
+def copy(tmp_path):
+  src = tmp_path / 'src'
+  dst = tmp_path / 'dst'
+  src.mkdir()
+  dst.mkdir()
+  (src / 'img.jpg').write_bytes(DATA)
+  (dst / 'img.jpg').write_bytes(DATA)
+  return (src, dst)
+
+def make_mover(copy, verify_mode):
+  (src, dst) = copy
+  mover = moveimages.FileMover([str(src)], [str(dst)], [], verify_mode=verify_mode)
+  mover._open_manifests()
+  return mover
+
+def verify(mover, copy, hashed=False):
+  (src, dst) = copy
+  return mover._verify_copy(str(src / 'img.jpg'), MD5, str(dst / 'img.jpg'), len(DATA), hashed)
+
+def recorded(mover, copy):
+  (_, dst) = copy
+  return mover.manifests[str(dst)].lookup(str(dst / 'img.jpg'))
+
+def test_md5_mode_records_verified_copy(copy):
+  mover = make_mover(copy, 'md5')
+  try:
+    assert verify(mover, copy)
+    assert recorded(mover, copy) == MD5
+  finally:
+    mover._close_manifests()
+
+def test_md5_mode_rejects_corrupt_copy(copy):
+  (_, dst) = copy
+  (dst / 'img.jpg').write_bytes(DATA.upper())
+  mover = make_mover(copy, 'md5')
+  try:
+    assert not verify(mover, copy)
+    assert recorded(mover, copy) is None
+  finally:
+    mover._close_manifests()
+
+def test_size_mode_only_records_hashed_copies(copy):
+  mover = make_mover(copy, 'size')
+  try:
+    assert verify(mover, copy)
+    assert recorded(mover, copy) is None
+    assert verify(mover, copy, hashed=True)
+    assert recorded(mover, copy) == MD5
+  finally:
+    mover._close_manifests()
+
+def test_size_mode_rejects_truncated_copy(copy):
+  (_, dst) = copy
+  (dst / 'img.jpg').write_bytes(DATA[:-1])
+  mover = make_mover(copy, 'size')
+  try:
+    assert not verify(mover, copy)
+  finally:
+    mover._close_manifests()
@@ -0,0 +1,160 @@
+import os
+import datetime
+import time
+import threading
+import pytest
+
+pytest.importorskip('pytz')
+pytest.importorskip('astral')
+import picamserver
+
+# picamera hands the inline headers (SPS and PPS) over in one write
+SPS = b'\x00\x00\x00\x01\x67sps\x00\x00\x00\x01\x68pps'
+IDR = b'\x00\x00\x00\x01\x65idr'
+P = b'\x00\x00\x00\x01\x41p'
+
+def test_h264_nal_type():
+  assert picamserver.h264_nal_type(SPS) == picamserver.NAL_TYPE_SPS
+  assert picamserver.h264_nal_type(IDR) == picamserver.NAL_TYPE_IDR
+  assert picamserver.h264_nal_type(b'\x00\x00\x01\x41p') == picamserver.NAL_TYPE_NON_IDR
+  assert picamserver.h264_nal_type(b'\x00\x00\x00\x01') is None
+  assert picamserver.h264_nal_type(b'garbage') is None
+
+def test_client_buffer_starts_at_keyframe():
+  buf = picamserver.ClientBuffer(1024)
+  buf.write(P)
+  buf.write(SPS, True)
+  buf.write(P)
+  assert buf.get(timeout=0) == [SPS, P]
+  assert buf.stats()['dropped_bytes'] == len(P)
+
+def test_client_buffer_drops_backlog_of_lagging_client():
+  buf = picamserver.ClientBuffer(len(SPS) + len(P))
+  buf.write(SPS, True)
+  buf.write(P)
+  buf.write(P)
+  buf.write(P)
+  assert buf.get(timeout=0) == []
+  assert buf.stats()['dropped_bytes'] == len(SPS) + 3 * len(P)
+  buf.write(SPS, True)
+  assert buf.get(timeout=0) == [SPS]
+
+class Recorder:
+  def __init__(self):
+    self.writes = []
+
+  def write(self, b, keyframe=False):
+    self.writes.append((b, keyframe))
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+def test_stream_tee_replays_current_gop_to_new_stream():
+  tee = picamserver.StreamTee()
+  for b in (SPS, IDR, P, P):
+    tee.write(b)
+  late = Recorder()
+  tee.add(late)
+  assert late.writes == [(SPS, True), (IDR, False), (P, False), (P, False)]
+  tee.write(P)
+  assert late.writes[-1] == (P, False)
+
+def test_stream_tee_prefixes_keyframe_without_headers():
+  tee = picamserver.StreamTee()
+  for b in (SPS, IDR, P, IDR, P):
+    tee.write(b)
+  late = Recorder()
+  tee.add(late)
+  assert late.writes == [(SPS, True), (IDR, False), (P, False)]
+
+def test_stream_tee_without_gop_waits_for_next_keyframe():
+  tee = picamserver.StreamTee(gop_cache_size=10)
+  for b in (SPS, IDR, P):
+    tee.write(b)
+  late = Recorder()
+  tee.add(late)
+  assert late.writes == []
+
+def test_pre_event_buffer_starts_at_keyframe_and_evicts_whole_gops():
+  gop = [(SPS, True), (IDR, False), (P, False), (P, False)]
+  gop_bytes = sum(len(b) for (b, _) in gop)
+  buf = picamserver.PreEventBuffer(2 * gop_bytes)
+  buf.write(P)
+  assert buf.buffered_bytes == 0
+  for _ in range(3):
+    for (b, keyframe) in gop:
+      buf.write(b, keyframe)
+  assert buf.buffered_bytes == 2 * gop_bytes
+  assert buf.chunks[0][1] and buf.chunks[0][2] == SPS
+  buf.write(P)
+  assert buf.buffered_bytes == gop_bytes + len(P)
+  assert buf.chunks[0][1]
+
+def test_pre_event_buffer_writes_clip(tmp_path):
+  buf = picamserver.PreEventBuffer(1024)
+  for (b, keyframe) in ((SPS, True), (IDR, False), (P, False)):
+    buf.write(b, keyframe)
+  path = str(tmp_path / 'clips' / 'clip.h264')
+  assert buf.write_clip(path, 60, 0) == len(SPS) + len(IDR) + len(P)
+  with open(path, 'rb') as f:
+    assert f.read() == SPS + IDR + P
+  assert not buf.followers
+
+def test_pre_event_buffer_cuts_short_a_clip_that_falls_behind(tmp_path):
+  buf = picamserver.PreEventBuffer(1024, follower_queue_size=2)
+  buf.write(SPS, True)
+  path = str(tmp_path / 'clip.h264')
+  # Opening a FIFO blocks until it is read, which stalls the clip writer after it started following
+  os.mkfifo(path + '.tmp')
+  result = {}
+  writer = threading.Thread(target=lambda: result.update(size=buf.write_clip(path, 60, 30)))
+  writer.start()
+  while not buf.followers:
+    time.sleep(0.01)
+  for _ in range(3):
+    buf.write(P)
+  assert not buf.followers
+  start_time = time.monotonic()
+  with open(path + '.tmp', 'rb') as f:
+    data = f.read()
+  writer.join(10)
+  assert time.monotonic() - start_time < 10
+  assert data == SPS + P + P
+  assert result['size'] == len(data)
+
+def test_clip_path_reserves_name(tmp_path):
+  server = picamserver.ClipCommandServer(('127.0.0.1', 0), picamserver.PreEventBuffer(1024), str(tmp_path / 'clips'))
+  try:
+    now = datetime.datetime(2024, 6, 21, 12)
+    paths = [server.clip_path(now) for _ in range(3)]
+  finally:
+    server.server_close()
+  assert len(set(paths)) == 3
+  assert all(os.path.exists(path) for path in paths)
+
+def test_encoder_load():
+  assert picamserver.encoder_load((1920, 1080), 30) == pytest.approx(120 * 68 * 30 / 244800.0)
+  # Partial macroblocks count as whole ones
+  assert picamserver.encoder_load((17, 17), 1) == pytest.approx(4 / 244800.0)
+
+def test_stream_tee_counts_frames_and_bytes():
+  tee = picamserver.StreamTee()
+  for b in (SPS, IDR, P, P):
+    tee.write(b)
+  assert (tee.written_frames, tee.written_bytes) == (3, len(SPS) + len(IDR) + 2 * len(P))
+
+def test_spool_drops_unreadable_overflow_capture(tmp_path):
+  written = []
+  spool = picamserver.SpoolDestination(str(tmp_path / 'dst'), lambda root_folder, capture: written.append(capture.data), 0, str(tmp_path / 'overflow'), 1024, 'drop_newest', datetime.timedelta(seconds=60))
+  now = datetime.datetime.now()
+  spool.put(picamserver.Capture(now, b'lost', 'a'))
+  spool.put(picamserver.Capture(now, b'kept', 'b'))
+  os.remove(spool.items[0].overflow_path)
+  spool.start()
+  spool.stop(5)
+  assert written == [b'kept']
+  assert spool.dropped == 1
+  assert spool.pending_bytes() == 0
@@ -0,0 +1,18 @@
+import datetime
+import pytest
+
+astral = pytest.importorskip('astral')
+pytest.importorskip('pytz')
+import suncalendar
+
+def location():
+  return astral.Location(('Eksel', 'Europe', 51.15, 5.3833, 'Europe/Brussels', 0))
+
+def test_unset_solar_depression_uses_astral_default():
+  calendar = suncalendar.SunCalendar(location())
+  assert calendar.solar_depression == astral.Astral().solar_depression
+
+def test_events_match_unset_location():
+  day = datetime.date(2024, 6, 21)
+  calendar = suncalendar.SunCalendar(location())
+  assert calendar.events(day)[0] == location().dawn(date=day).timestamp()